@@ -0,0 +1,125 @@
+"""
+Microbenchmarks of python-postmark's hot paths.
+
+    python benchmarks.py [name ...]
+
+Runs every benchmark when no name is given. Nothing is sent over the network.
+"""
+import sys
+import timeit
+
+from django.conf import settings
+
+
+def bench_construction(number=100000):
+    '''
+    Cost of building one PMMail, the Django settings it reads included.
+    '''
+    from postmark.core import PMMail
+
+    def build():
+        PMMail(sender='from@example.com', to='to@example.com', subject='Subject', text_body='Body')
+    return min(timeit.repeat(build, number=number, repeat=5)) / number * 1e6, 'us per message'
+
+
+def bench_message_size(number=10000):
+    '''
+    Memory held by one PMMail, as measured by tracemalloc.
+    '''
+    import tracemalloc
+    from postmark.core import PMMail
+
+    # Resolve the configuration outside of the measurement
+    PMMail()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [PMMail(sender='from@example.com', to='to@example.com', subject='Subject', text_body='Body')
+                for i in range(number)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del messages
+    return size / number, 'bytes per message'
+
+
+def _encode_batch(batch):
+    batch._check_values()
+    for chunk in batch._chunk_requests(False):
+        pass
+
+
+def _time_encoding(build, count, repeat=5):
+    '''
+    Best time per message of encoding the batch returned by build(), built
+    afresh outside the timing for each repeat so no encoding cached by a
+    previous run is reused.
+    '''
+    batch = [None]
+
+    def setup():
+        batch[0] = None
+        batch[0] = build()
+    return min(timeit.repeat(lambda: _encode_batch(batch[0]), setup=setup, number=1, repeat=repeat)) / count * 1e6
+
+
+def bench_batch_encoding(count=5000):
+    '''
+    Cost of validating and encoding one message of a PMBatchMail of
+    otherwise identical messages.
+    '''
+    from postmark.core import PMBatchMail, PMMail
+
+    def build():
+        return PMBatchMail(messages=[
+            PMMail(sender='from@example.com', to='to%d@example.com' % i, subject='Subject',
+                   html_body='<p>Body</p>' * 100, tag='news', metadata={'row': str(i)})
+            for i in range(count)])
+    return _time_encoding(build, count), 'us per message'
+
+
+def bench_merge_encoding(count=5000):
+    '''
+    Same as batch_encoding, with the messages given as a PMMergeBatchMail.
+    '''
+    from postmark.core import PMMail, PMMergeBatchMail
+
+    def build():
+        shared = PMMail(sender='from@example.com', subject='Subject', html_body='<p>Body</p>' * 100, tag='news')
+        return PMMergeBatchMail(shared=shared, to=['to%d@example.com' % i for i in range(count)],
+                                metadata=[{'row': str(i)} for i in range(count)])
+    return _time_encoding(build, count), 'us per message'
+
+
+def bench_validation(number=5, count=100000):
+    '''
+    Cost per message of validating a PMBatchMail, one message in ten
+    tracking opens without an HTML body.
+    '''
+    import io
+    from contextlib import redirect_stdout
+    from postmark.core import PMBatchMail, PMMail
+
+    batch = PMBatchMail(messages=[
+        PMMail(sender='from@example.com', to='to%d@example.com' % i, subject='Subject', text_body='Body',
+               track_opens=not i % 10)
+        for i in range(count)])
+    with redirect_stdout(io.StringIO()):
+        duration = min(timeit.repeat(batch._check_values, number=number, repeat=5))
+    return duration / number / count * 1e6, 'us per message'
+
+
+BENCHMARKS = {
+    'batch_encoding': bench_batch_encoding,
+    'merge_encoding': bench_merge_encoding,
+    'construction': bench_construction,
+    'message_size': bench_message_size,
+    'validation': bench_validation,
+}
+
+
+if __name__ == '__main__':
+    if not settings.configured:
+        settings.configure(POSTMARK_API_KEY='dummy')
+
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        value, unit = BENCHMARKS[name]()
+        print('%-20s %10.2f %s' % (name, value, unit))
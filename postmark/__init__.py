@@ -57,6 +57,10 @@ __doc__ = '''
         PMMailMissingValueException(Exception):
             One of the required values for attempting a send request is missing
 
+        PMMailBatchValidationException(PMMailMissingValueException):
+            Messages of a batch are missing required values. errors lists
+            the (index, reason) of each of them.
+
         PMMailSendException(Exception):
             Base Postmark send exception
 
@@ -82,6 +86,10 @@ __doc__ = '''
             inactive. If this was a batch operation, the rest of the messages were
             still sent.
 
+        PMMailCircuitOpenException(PMMailSendException):
+            The request was not sent because the circuit breaker is open: Postmark
+            failed too many times in a row recently.
+
     TODO:
         Add automatic multipart emails via regex stripping of HTML tags from html_body
         if the .multipart property is set to True
@@ -0,0 +1,412 @@
+"""
+asyncio counterparts of PMMail, PMBatchMail and PMBounceManager.
+
+The objects take the same arguments and raise the same exceptions as the ones
+in postmark.core, but their send() (and bounce API) methods are coroutines
+performing I/O over keep-alive connections opened with the standard library's
+asyncio streams, so many sends can be in flight on a single event loop:
+
+    message = AsyncPMMail(api_key='...', sender='...', to='...',
+                          subject='...', text_body='...')
+    await message.send()
+"""
+import asyncio
+import ssl
+import time
+import weakref
+from collections import deque
+from http.client import parse_headers
+from io import BytesIO
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+from postmark.core import (
+    PMMail, PMBatchMail, PMBatchResult, PMBounceManager, PMResponse,
+    PMStreamingBatchMail, get_default_circuit_breaker, get_default_rate_limiter,
+    _coerce_timeout, _raise_send_exception, _remaining
+)
+
+
+class AsyncPMPooledTransport(object):
+    '''
+    An asyncio transport keeping persistent (keep-alive) HTTP/1.1 connections
+    to the Postmark API.
+
+    open() is a coroutine with the same contract as PMTransport.open(): it
+    takes a urllib Request and a PMTimeout and returns a PMResponse, raising
+    HTTPError for non-2xx responses and URLError for connection problems.
+    The read timeout bounds the whole exchange of a request and its response.
+
+    A transport (and its connections) belongs to the event loop it is first
+    used on.
+
+    Keyword arguments are:
+    maxsize:        Maximum number of connections open at once per host.
+                    Further requests wait for a connection to be released.
+    idle_timeout:   Seconds an idle connection may sit in the pool before it
+                    is discarded instead of reused.
+    max_requests:   Number of requests served by one connection before it is
+                    closed and replaced.
+    '''
+
+    def __init__(self, maxsize=100, idle_timeout=30, max_requests=1000):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.__ssl_context = None
+        # (scheme, netloc) -> list of [reader, writer, last_used, request_count]
+        self.__idle = {}
+        # (scheme, netloc) -> asyncio.Semaphore bounding open connections
+        self.__slots = {}
+
+    async def _new_connection(self, scheme, netloc):
+        parts = urlsplit('%s://%s' % (scheme, netloc))
+        if scheme == 'https':
+            if self.__ssl_context is None:
+                self.__ssl_context = ssl.create_default_context()
+            reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 443, ssl=self.__ssl_context)
+        else:
+            reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        return [reader, writer, asyncio.get_running_loop().time(), 0]
+
+    async def _acquire(self, key, timeout=None):
+        now = asyncio.get_running_loop().time()
+        idle = self.__idle.get(key)
+        while idle:
+            entry = idle.pop()
+            if now - entry[2] <= self.idle_timeout and not entry[0].at_eof():
+                return entry, True
+            entry[1].close()
+        return await asyncio.wait_for(self._new_connection(*key), timeout and timeout.connect), False
+
+    def _release(self, key, entry):
+        entry[2] = asyncio.get_running_loop().time()
+        self.__idle.setdefault(key, []).append(entry)
+
+    async def _write_request(self, entry, method, netloc, path, headers, body):
+        '''
+        Write one request on a connection.
+        '''
+        writer = entry[1]
+
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % netloc]
+        for name, value in headers:
+            lines.append('%s: %s' % (name, value))
+        if body is not None and not any(name.lower() == 'content-length' for name, value in headers):
+            lines.append('Content-Length: %d' % len(body))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if isinstance(body, bytes):
+            writer.write(body)
+        elif body is not None:
+            # A PMJSONBody: write its fragments without joining them
+            for piece in body:
+                writer.write(piece)
+                await writer.drain()
+        await writer.drain()
+
+    async def _read_response(self, entry, method):
+        '''
+        Read back the response to the request written on a connection.
+        Returns (status, reason, headers, body, will_close).
+        '''
+        reader = entry[0]
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by Postmark')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        status = int(status)
+
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        response_headers = parse_headers(BytesIO(b''.join(header_lines)))
+
+        will_close = version == 'HTTP/1.0' or 'close' in response_headers.get('Connection', '').lower()
+        if 'chunked' in response_headers.get('Transfer-Encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    # Skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            response_body = b''.join(chunks)
+        elif response_headers.get('Content-Length') is not None:
+            response_body = await reader.readexactly(int(response_headers['Content-Length']))
+        elif status in (204, 304) or method == 'HEAD':
+            response_body = b''
+        else:
+            response_body = await reader.read()
+            will_close = True
+
+        return status, reason, response_headers, response_body, will_close
+
+    async def open(self, req, timeout=None):
+        parts = urlsplit(req.get_full_url())
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        method = req.get_method()
+        headers = req.header_items()
+
+        slots = self.__slots.get(key)
+        if slots is None:
+            slots = self.__slots[key] = asyncio.Semaphore(self.maxsize)
+
+        async with slots:
+            try:
+                entry, reused = await self._acquire(key, timeout)
+            except (OSError, asyncio.TimeoutError) as err:
+                raise URLError(err)
+            while True:
+                try:
+                    await asyncio.wait_for(self._write_request(entry, method, parts.netloc, path, headers, req.data),
+                                           timeout and timeout.read)
+                    break
+                except (ConnectionResetError, BrokenPipeError) as err:
+                    entry[1].close()
+                    if reused:
+                        # The keep-alive connection was closed by the server
+                        # while idle. Retry once on a fresh connection; not
+                        # once the request was written, as Postmark may have
+                        # accepted it already.
+                        try:
+                            entry, reused = await asyncio.wait_for(self._new_connection(*key),
+                                                                   timeout and timeout.connect), False
+                        except (OSError, asyncio.TimeoutError) as err:
+                            raise URLError(err)
+                        continue
+                    raise URLError(err)
+                except (OSError, asyncio.TimeoutError) as err:
+                    entry[1].close()
+                    raise URLError(err)
+                except BaseException:
+                    # Cancelled mid-request: the connection state is unknown.
+                    entry[1].close()
+                    raise
+            try:
+                status, reason, response_headers, body, will_close = await asyncio.wait_for(
+                    self._read_response(entry, method), timeout and timeout.read)
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as err:
+                entry[1].close()
+                raise URLError(err)
+            except BaseException:
+                entry[1].close()
+                raise
+
+            entry[3] += 1
+            if will_close or entry[3] >= self.max_requests:
+                entry[1].close()
+            else:
+                self._release(key, entry)
+
+        if 200 <= status < 300:
+            return PMResponse(status, reason, response_headers, body)
+        raise HTTPError(req.get_full_url(), status, reason, response_headers, BytesIO(body))
+
+    def close(self):
+        '''
+        Close every idle connection held by the transport.
+        '''
+        idle, self.__idle = self.__idle, {}
+        for entries in idle.values():
+            for entry in entries:
+                entry[1].close()
+
+
+# One default transport per event loop, as asyncio connections cannot be
+# shared between loops.
+_default_transports = weakref.WeakKeyDictionary()
+
+
+def get_default_async_transport():
+    '''
+    Returns the AsyncPMPooledTransport shared by the async objects created
+    without an explicit transport on the running event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    transport = _default_transports.get(loop)
+    if transport is None:
+        transport = _default_transports[loop] = AsyncPMPooledTransport()
+    return transport
+
+
+async def _open_request(transport, req, retry=None, rate_limiter=None, messages=1, timeout=None, deadline=None):
+    '''
+    Send req over an async transport, retrying transient failures according
+    to the PMRetryPolicy retry and waiting for the PMRateLimiter
+    rate_limiter without blocking the event loop. See
+    postmark.core._open_request().
+    '''
+    circuit_breaker = get_default_circuit_breaker()
+    attempt = 1
+    while True:
+        _remaining(deadline)
+        if circuit_breaker is not None:
+            circuit_breaker.before_request()
+        try:
+            if rate_limiter is not None:
+                wait = rate_limiter._reserve(messages)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            # The deadline running out locally is not a failure of Postmark
+            remaining = _remaining(deadline)
+        except BaseException:
+            if circuit_breaker is not None:
+                circuit_breaker.release()
+            raise
+        try:
+            result = await transport.open(req, timeout.capped(remaining) if timeout is not None else None)
+        except URLError as err:
+            if circuit_breaker is not None:
+                circuit_breaker.record(err)
+            if retry is None or not retry.should_retry(err, attempt):
+                raise
+            delay = retry.delay(attempt, err)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        except BaseException:
+            if circuit_breaker is not None:
+                circuit_breaker.release()
+            raise
+        if circuit_breaker is not None:
+            circuit_breaker.record(None)
+        return result
+
+
+class AsyncPMMail(PMMail):
+    '''
+    A PMMail whose send() is a coroutine.
+    '''
+
+    __slots__ = ()
+
+    _get_default_transport = staticmethod(get_default_async_transport)
+
+    async def send(self, test=None, return_json=None, retry=None, rate_limiter=None, timeout=None):
+        '''
+        Send the email through the Postmark system.
+        See PMMail.send().
+        '''
+        prepared = self._prepare_send(test, return_json)
+        if prepared is None:
+            return
+        req, return_json = prepared
+        timeout = _coerce_timeout(timeout) or self.timeout
+
+        try:
+            result = await _open_request(self.transport, req, retry, rate_limiter or get_default_rate_limiter(),
+                                         timeout=timeout, deadline=timeout and timeout.start())
+        except URLError as err:
+            _raise_send_exception(err)
+            return
+        return self._handle_result(result, return_json)
+
+
+class AsyncPMBatchMail(PMBatchMail):
+    '''
+    A PMBatchMail whose send() is a coroutine.
+    '''
+
+    _get_default_transport = staticmethod(get_default_async_transport)
+
+    async def send(self, test=None, return_json=None, concurrency=None, retry=None, rate_limiter=None, timeout=None):
+        '''
+        Send the messages through the Postmark batch API.
+        See PMBatchMail.send(); concurrency is the number of chunks in
+        flight at once on the event loop.
+        '''
+        return_json = self._prepare_send(return_json)
+        batch_result = PMBatchResult()
+        json_results = [] if return_json else None
+        rate_limiter = rate_limiter or get_default_rate_limiter()
+        timeout = _coerce_timeout(timeout) or self.timeout
+        deadline = timeout and timeout.start()
+
+        # Has one of the messages caused an inactive recipient error?
+        inactive_recipient = False
+        pending = deque()
+        concurrency = max(concurrency or 1, 1)
+
+        try:
+            for chunk in self._chunk_requests(test):
+                pending.append(asyncio.ensure_future(self._dispatch(chunk, retry, rate_limiter, timeout, deadline)))
+                if len(pending) >= concurrency:
+                    outcome = await pending.popleft()
+                    inactive_recipient = self._collect(outcome, batch_result, json_results) or inactive_recipient
+            while pending:
+                outcome = await pending.popleft()
+                inactive_recipient = self._collect(outcome, batch_result, json_results) or inactive_recipient
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            raise
+        finally:
+            # The outcome of the chunks sent before an error stopped the batch
+            self._store_result(batch_result)
+
+        return self._finish(batch_result, json_results, inactive_recipient)
+
+    async def _dispatch(self, chunk, retry=None, rate_limiter=None, timeout=None, deadline=None):
+        messages, req = chunk[:2]
+        if req is None:
+            # Every message of the chunk was rejected before sending
+            return chunk, [], None
+        try:
+            results = self._handle_result(await _open_request(self.transport, req, retry, rate_limiter, len(messages),
+                                                              timeout, deadline), messages)
+        except URLError as err:
+            return chunk, None, err
+
+        if retry is not None:
+            attempt = 1
+            failed = retry.failed_indexes(results)
+            while failed and attempt < retry.max_attempts:
+                delay = retry.delay(attempt)
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    break
+                await asyncio.sleep(delay)
+                attempt += 1
+                try:
+                    retried = self._handle_result(await _open_request(self.transport, self._retry_request(chunk, failed),
+                                                                      rate_limiter=rate_limiter, messages=len(failed),
+                                                                      timeout=timeout, deadline=deadline),
+                                                  [messages[i] for i in failed])
+                except URLError:
+                    break
+                failed = self._merge_retried(results, failed, retried, retry)
+        return chunk, results, None
+
+
+class AsyncPMStreamingBatchMail(AsyncPMBatchMail, PMStreamingBatchMail):
+    '''
+    A PMStreamingBatchMail whose send() is a coroutine.
+    '''
+    pass
+
+
+class AsyncPMBounceManager(PMBounceManager):
+    '''
+    A PMBounceManager whose bounce API methods return coroutines.
+    '''
+
+    _get_default_transport = staticmethod(get_default_async_transport)
+
+    async def _open(self, req):
+        try:
+            timeout = self.timeout
+            result = await _open_request(self.transport, req, self.retry, timeout=timeout,
+                                         deadline=timeout and timeout.start())
+        except HTTPError as err:
+            return err
+        return PMBounceManager._parse_result(result)
@@ -1,6 +1,12 @@
 #
 # Imports (JSON library based on import try)
+import copy
 import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from postmark import __version__
 
@@ -10,39 +16,1091 @@ except ImportError as e:
     from email import MIMEBase
 
 if sys.version_info[0] < 3:
-    from urllib2 import Request, urlopen, HTTPError, URLError
-    from httplib import HTTPConnection
+    from urllib2 import Request, urlopen, getproxies, HTTPError, URLError
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
     from urllib import urlencode
+    from urlparse import urlsplit
+    from StringIO import StringIO as BytesIO
 else:
-    from urllib.request import Request, urlopen
+    from urllib.request import Request, urlopen, getproxies
     from urllib.error import HTTPError, URLError
-    from http.client import HTTPConnection
-    from urllib.parse import urlencode
-
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlencode, urlsplit
+    from io import BytesIO
+
+import base64
+import hashlib
+import json
+import mimetypes
+import mmap
+import os
+import random
+import re
 from contextlib import closing
-
-try:
-    import simplejson as json
-except ImportError:
-    try:
-        # Try django first, for speedups, since we support the backend
-        from django.utils import simplejson as json
-    except ImportError:
-        import json
+from datetime import datetime, timezone
+from email.utils import getaddresses, parsedate_to_datetime
+from functools import lru_cache
 
 
 #
-#
+# JSON serialization
+
+def _json_default(o):
+    '''
+    Serialize lazy strings (e.g. Django's gettext_lazy) as text, and
+    PMAttachment contents as their base64 text.
+    '''
+    if hasattr(o, '_proxy____cast') or hasattr(o, '_proxy____unicode_cast'):
+        return str(o)
+    if isinstance(o, PMAttachment):
+        # Only reached when a message is not encoded by _encode_json_message
+        return b''.join(o).decode('ascii')
+    raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
 class PMJSONEncoder(json.JSONEncoder):
     def default(self, o):
-        if hasattr(o, '_proxy____unicode_cast'):
-            return unicode(o)
-        return super(PMJSONEncoder, self).default(o)
+        try:
+            return _json_default(o)
+        except TypeError:
+            return super(PMJSONEncoder, self).default(o)
+
+
+class PMJSONSerializer(object):
+    '''
+    Base class for the JSON libraries used to encode request bodies and
+    parse Postmark's responses. dumps() returns UTF-8 encoded bytes and
+    loads() accepts str or bytes.
+
+    Subclasses import their library in __init__, raising ImportError when
+    it is not installed.
+    '''
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class PMStdlibJSONSerializer(PMJSONSerializer):
+    '''
+    The standard library json module.
+    '''
+
+    def dumps(self, obj):
+        return json.dumps(obj, cls=PMJSONEncoder).encode('utf8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class PMSimplejsonSerializer(PMJSONSerializer):
+    '''
+    simplejson (https://pypi.org/project/simplejson/), with its C speedups.
+    '''
+
+    def __init__(self):
+        import simplejson
+        self.__simplejson = simplejson
+
+    def dumps(self, obj):
+        return self.__simplejson.dumps(obj, default=_json_default).encode('utf8')
+
+    def loads(self, data):
+        return self.__simplejson.loads(data)
+
+
+class PMOrjsonSerializer(PMJSONSerializer):
+    '''
+    orjson (https://pypi.org/project/orjson/).
+    '''
+
+    def __init__(self):
+        import orjson
+        self.__orjson = orjson
+        # Metadata may use integer keys
+        self.__option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        return self.__orjson.dumps(obj, default=_json_default, option=self.__option)
+
+    def loads(self, data):
+        return self.__orjson.loads(data)
+
+
+class PMUjsonSerializer(PMJSONSerializer):
+    '''
+    ujson (https://pypi.org/project/ujson/), version 5 or later.
+    '''
+
+    def __init__(self):
+        import ujson
+        self.__ujson = ujson
+
+    def dumps(self, obj):
+        return self.__ujson.dumps(obj, ensure_ascii=False, default=_json_default).encode('utf8')
+
+    def loads(self, data):
+        return self.__ujson.loads(data)
+
+
+# name -> PMJSONSerializer subclass
+_serializers = {
+    'json': PMStdlibJSONSerializer,
+    'simplejson': PMSimplejsonSerializer,
+    'orjson': PMOrjsonSerializer,
+    'ujson': PMUjsonSerializer,
+}
+
+# Order in which installed libraries are picked when none is configured
+_serializer_preference = ('orjson', 'ujson', 'simplejson', 'json')
+
+_serializer = None
+
+
+def register_serializer(name, serializer_class):
+    '''
+    Make a PMJSONSerializer subclass selectable by name.
+    '''
+    _serializers[name] = serializer_class
+
+
+def set_serializer(name):
+    '''
+    Select the JSON library by registered name, e.g. set_serializer('json').
+    Raises ImportError if the library is not installed.
+    '''
+    global _serializer
+    if name not in _serializers:
+        raise ValueError('Unknown JSON serializer %r, choose one of: %s' % (name, ', '.join(sorted(_serializers))))
+    _serializer = _serializers[name]()
+
+
+def get_serializer():
+    '''
+    Returns the PMJSONSerializer in use. It is selected once, on first use,
+    from the POSTMARK_JSON_BACKEND environment variable, then the
+    POSTMARK_JSON_BACKEND Django setting, then the fastest installed library.
+    '''
+    if _serializer is None:
+        name = os.environ.get('POSTMARK_JSON_BACKEND') or _django_setting('POSTMARK_JSON_BACKEND', None)
+        if name:
+            set_serializer(name)
+        else:
+            for name in _serializer_preference:
+                try:
+                    set_serializer(name)
+                    break
+                except ImportError:
+                    pass
+    return _serializer
+
+
 #
 #
 __POSTMARK_URL__ = 'https://api.postmarkapp.com/'
 
 
+#
+# Configuration
+
+_missing = object()
+
+
+class PMConfig(object):
+    '''
+    A snapshot of what the library reads from its environment: the
+    user-agent sent to Postmark and the Django settings, each looked up once.
+
+    It is built on first use and shared by the whole process. Call
+    reload_config() after changing settings at runtime; with Django, this
+    happens automatically when a setting is changed through
+    override_settings() or the setting_changed signal.
+    '''
+
+    def __init__(self):
+        self.user_agent = 'Python/%s (python-postmark library version %s)' % ('_'.join([str(var) for var in sys.version_info]), __version__)
+        self.__settings = None
+        self.__values = {}
+        try:
+            from django import VERSION
+            from django.conf import settings as django_settings
+        except ImportError:
+            return
+        self.user_agent = '%s (Django %s)' % (self.user_agent, '_'.join([str(var) for var in VERSION]))
+        self.__settings = django_settings
+        _watch_django_settings()
+
+    def setting(self, name, default=None):
+        '''
+        Returns the Django setting name, or default if it is not set or
+        Django is not installed.
+        '''
+        try:
+            value = self.__values[name]
+        except KeyError:
+            value = self.__values[name] = getattr(self.__settings, name, _missing) if self.__settings is not None else _missing
+        return default if value is _missing else value
+
+
+_config = None
+_watching_django_settings = False
+
+
+def get_config():
+    '''
+    Returns the PMConfig of the process.
+    '''
+    global _config
+    config = _config
+    if config is None:
+        config = _config = PMConfig()
+    return config
+
+
+def reload_config(**kwargs):
+    '''
+    Discard the PMConfig snapshot, so settings are read again on next use.
+    Accepts (and ignores) the arguments of Django's setting_changed signal.
+    '''
+    global _config
+    _config = None
+
+
+def _watch_django_settings():
+    global _watching_django_settings
+    if not _watching_django_settings:
+        from django.core.signals import setting_changed
+        setting_changed.connect(reload_config, weak=False)
+        _watching_django_settings = True
+
+
+#
+# Transports
+
+class PMTransport(object):
+    '''
+    Base class for the HTTP transports used by PMMail, PMBatchMail and
+    PMBounceManager.
+
+    A transport takes a urllib Request and a PMTimeout (or None for no
+    timeout) and returns a response object with .code, .msg, .headers, .read()
+    and .close(). Non-2xx responses raise HTTPError and connection problems,
+    timeouts included, raise URLError, exactly like urlopen(), so the calling
+    code handles errors the same way whatever transport is used.
+    '''
+
+    def open(self, req, timeout=None):
+        raise NotImplementedError
+
+    def close(self):
+        '''
+        Release any resources (e.g. open connections) held by the transport.
+        '''
+        pass
+
+
+class PMUrllibTransport(PMTransport):
+    '''
+    The original transport: one urlopen() call, and therefore one TCP + TLS
+    handshake, per request. Honours the proxy environment variables.
+
+    urlopen() applies a single socket timeout to connecting and reading, so
+    the larger of the connect and read timeouts is used.
+    '''
+
+    def open(self, req, timeout=None):
+        if timeout is None or timeout.longest is None:
+            return urlopen(req)
+        return urlopen(req, timeout=timeout.longest)
+
+
+class PMResponse(object):
+    '''
+    A fully read HTTP response returned by PMPooledTransport.
+    '''
+
+    def __init__(self, code, msg, headers, body):
+        self.code = code
+        self.status = code
+        self.msg = msg
+        self.headers = headers
+        self.__body = body
+
+    def read(self):
+        return self.__body
+
+    def getcode(self):
+        return self.code
+
+    def close(self):
+        pass
+
+
+class PMPooledTransport(PMTransport):
+    '''
+    A transport keeping persistent (keep-alive) HTTPS connections to the
+    Postmark API so consecutive requests skip the TCP + TLS handshake.
+
+    Keyword arguments are:
+    maxsize:        Maximum number of idle connections kept per host. Extra
+                    concurrent requests open a connection that is closed
+                    once the request completes.
+    idle_timeout:   Seconds an idle connection may sit in the pool before it
+                    is discarded instead of reused.
+    max_requests:   Number of requests served by one connection before it is
+                    closed and replaced.
+    '''
+
+    # Errors raised when a reused keep-alive connection was closed by the
+    # server while idle. The request is retried once on a fresh connection if
+    # it could not be written; once written, Postmark may have accepted it and
+    # sending it again could duplicate the email.
+    _STALE_ERRORS = (ConnectionResetError, BrokenPipeError)
+
+    def __init__(self, maxsize=10, idle_timeout=30, max_requests=1000):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.__lock = threading.Lock()
+        # (scheme, netloc) -> list of [connection, last_used, request_count]
+        self.__idle = {}
+
+    def _new_connection(self, scheme, netloc):
+        if scheme == 'http':
+            return HTTPConnection(netloc)
+        return HTTPSConnection(netloc)
+
+    def _acquire(self, key):
+        now = time.monotonic()
+        with self.__lock:
+            idle = self.__idle.get(key)
+            while idle:
+                entry = idle.pop()
+                if now - entry[1] <= self.idle_timeout:
+                    return entry, True
+                entry[0].close()
+        return [self._new_connection(*key), now, 0], False
+
+    def _release(self, key, entry):
+        entry[1] = time.monotonic()
+        with self.__lock:
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(entry)
+                return
+        entry[0].close()
+
+    def _set_timeouts(self, conn, timeout):
+        '''
+        Connect conn within the connect timeout if needed, then apply the
+        read timeout to its socket.
+        '''
+        if conn.sock is None:
+            conn.timeout = timeout.connect
+            conn.connect()
+        conn.sock.settimeout(timeout.read)
+
+    def open(self, req, timeout=None):
+        parts = urlsplit(req.get_full_url())
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(req.header_items())
+
+        entry, reused = self._acquire(key)
+        while True:
+            conn = entry[0]
+            try:
+                if timeout is not None:
+                    self._set_timeouts(conn, timeout)
+                conn.request(req.get_method(), path, req.data, headers)
+                break
+            except self._STALE_ERRORS as err:
+                conn.close()
+                if reused:
+                    entry, reused = [self._new_connection(*key), time.monotonic(), 0], False
+                    continue
+                raise URLError(err)
+            except (OSError, HTTPException) as err:
+                conn.close()
+                raise URLError(err)
+        try:
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, HTTPException) as err:
+            conn.close()
+            raise URLError(err)
+
+        entry[2] += 1
+        if response.will_close or entry[2] >= self.max_requests:
+            conn.close()
+        else:
+            self._release(key, entry)
+
+        if 200 <= response.status < 300:
+            return PMResponse(response.status, response.reason, response.msg, body)
+        raise HTTPError(req.get_full_url(), response.status, response.reason, response.msg, BytesIO(body))
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for entries in idle.values():
+            for entry in entries:
+                entry[0].close()
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport():
+    '''
+    Returns the transport shared by every PMMail, PMBatchMail and
+    PMBounceManager created without an explicit transport. This is a
+    PMPooledTransport, unless an HTTPS proxy is configured in the environment,
+    in which case the urlopen() based PMUrllibTransport is used.
+    '''
+    global _default_transport
+    if _default_transport is None:
+        with _default_transport_lock:
+            if _default_transport is None:
+                _default_transport = new_transport()
+    return _default_transport
+
+
+def new_transport():
+    '''
+    Returns a new PMPooledTransport, or a PMUrllibTransport if an HTTPS
+    proxy is configured in the environment.
+    '''
+    if getproxies().get('https'):
+        return PMUrllibTransport()
+    return PMPooledTransport()
+
+
+def set_default_transport(transport):
+    '''
+    Replace the shared default transport. Pass None to go back to the
+    automatically selected one.
+    '''
+    global _default_transport
+    previous, _default_transport = _default_transport, transport
+    if previous is not None and previous is not transport:
+        previous.close()
+
+
+#
+# Timeouts
+
+class PMTimeout(object):
+    '''
+    Time limits, in seconds, of requests to Postmark. None means no limit.
+
+    Keyword arguments are:
+    connect:    Seconds allowed to open a connection (TCP + TLS handshake).
+    read:       Seconds to wait for the response, between any two reads of
+                the socket.
+    deadline:   Seconds allowed for a whole send() or bounce API call: every
+                retry, rate limiter wait and batch chunk included. Once it
+                has passed, no further request is started and a
+                PMMailURLException is raised; requests still running have
+                their connect and read timeouts shortened to fit in it.
+    '''
+
+    def __init__(self, connect=10, read=30, deadline=None):
+        self.connect = connect
+        self.read = read
+        self.deadline = deadline
+
+    def __repr__(self):
+        return 'PMTimeout(connect=%r, read=%r, deadline=%r)' % (self.connect, self.read, self.deadline)
+
+    @property
+    def longest(self):
+        '''
+        The larger of the connect and read timeouts, None if one is unlimited.
+        '''
+        if self.connect is None or self.read is None:
+            return None
+        return max(self.connect, self.read)
+
+    def start(self):
+        '''
+        Returns the time.monotonic() value at which the deadline of a call
+        starting now expires, or None.
+        '''
+        if self.deadline is None:
+            return None
+        return time.monotonic() + self.deadline
+
+    def capped(self, remaining):
+        '''
+        Returns a PMTimeout whose connect and read timeouts do not exceed
+        `remaining` seconds.
+        '''
+        if remaining is None:
+            return self
+        return PMTimeout(remaining if self.connect is None else min(self.connect, remaining),
+                         remaining if self.read is None else min(self.read, remaining))
+
+
+def _coerce_timeout(value):
+    '''
+    Turn a PMTimeout, a number of seconds (used for both the connect and the
+    read timeout) or a (connect, read) tuple into a PMTimeout.
+    '''
+    if value is None or isinstance(value, PMTimeout):
+        return value
+    if isinstance(value, tuple):
+        return PMTimeout(*value)
+    return PMTimeout(value, value)
+
+
+def _remaining(deadline):
+    '''
+    Seconds left before the time.monotonic() deadline, or None without one.
+    Raises URLError once the deadline has passed.
+    '''
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise URLError(TimeoutError('Deadline exceeded before the request to Postmark could complete'))
+    return remaining
+
+
+_default_timeout = PMTimeout()
+
+
+def get_default_timeout():
+    '''
+    Returns the PMTimeout used by objects created without a timeout.
+    '''
+    return _default_timeout
+
+
+def set_default_timeout(timeout):
+    '''
+    Set the PMTimeout (or number of seconds) used by objects created without
+    a timeout. Pass None to disable timeouts.
+    '''
+    global _default_timeout
+    _default_timeout = _coerce_timeout(timeout)
+
+
+#
+# Retries
+
+class PMRetryPolicy(object):
+    '''
+    Describes how transient Postmark failures are retried.
+
+    Keyword arguments are:
+    max_attempts:               Total number of attempts, the first one included.
+    backoff:                    Delay in seconds before the first retry.
+    multiplier:                 Factor applied to the delay after each retry.
+    max_backoff:                Upper bound of the computed delay, in seconds.
+    jitter:                     Pick each delay at random between 0 and the computed
+                                delay, so clients retrying together spread out.
+    retry_statuses:             HTTP status codes that are retried.
+    retry_connection_errors:    Whether failing to reach Postmark is retried.
+    retry_error_codes:          Postmark ErrorCodes of individual messages in a batch
+                                response that are retried. Only those messages are
+                                sent again.
+    respect_retry_after:        Wait as long as the Retry-After response header asks,
+                                when it is present. A request asked to wait longer
+                                than max_backoff is not retried.
+    '''
+
+    def __init__(self, max_attempts=3, backoff=0.5, multiplier=2, max_backoff=30, jitter=True,
+                 retry_statuses=(429, 500, 502, 503, 504), retry_connection_errors=True,
+                 retry_error_codes=(), respect_retry_after=True):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = frozenset(retry_statuses)
+        self.retry_connection_errors = retry_connection_errors
+        self.retry_error_codes = frozenset(retry_error_codes)
+        self.respect_retry_after = respect_retry_after
+
+    def should_retry(self, err, attempt):
+        '''
+        Whether a request that failed with err on its attempt-th try is
+        tried again.
+        '''
+        if attempt >= self.max_attempts:
+            return False
+        if isinstance(err, HTTPError):
+            if self.respect_retry_after:
+                retry_after = _retry_after(err)
+                if retry_after is not None and retry_after > self.max_backoff:
+                    return False
+            return err.code in self.retry_statuses
+        return self.retry_connection_errors
+
+    def failed_indexes(self, results):
+        '''
+        Indexes of the messages of a batch response to send again.
+        '''
+        if not self.retry_error_codes:
+            return []
+        return [i for i, res in enumerate(results) if res.get('ErrorCode') in self.retry_error_codes]
+
+    def delay(self, attempt, err=None):
+        '''
+        Seconds to wait before the retry following the attempt-th try.
+        '''
+        if self.respect_retry_after and err is not None:
+            retry_after = _retry_after(err)
+            if retry_after is not None:
+                return min(self.max_backoff, retry_after)
+        delay = min(self.max_backoff, self.backoff * self.multiplier ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+def _retry_after(err):
+    '''
+    Returns the delay in seconds asked by the Retry-After header of an
+    HTTPError, or None.
+    '''
+    headers = getattr(err, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+#
+# Rate limiting
+
+class PMRateLimiter(object):
+    '''
+    A thread-safe token bucket keeping requests to Postmark under a number
+    of requests and/or messages per second, shared by everything using it
+    in this process.
+
+    Keyword arguments are:
+    requests_per_second:    Maximum sustained number of API requests per second.
+    messages_per_second:    Maximum sustained number of messages per second. A batch
+                            request counts for each message it carries.
+    burst:                  Number of seconds worth of tokens that can be spent at
+                            once after a quiet period. Defaults to 1 second.
+    '''
+
+    def __init__(self, requests_per_second=None, messages_per_second=None, burst=1):
+        self.requests_per_second = requests_per_second
+        self.messages_per_second = messages_per_second
+        self.burst = burst
+        self.__lock = threading.Lock()
+        self.__state = None
+
+    def _now(self):
+        return time.monotonic()
+
+    def _take(self, state, now, messages):
+        '''
+        Refill the buckets described by state, a (request_tokens,
+        message_tokens, timestamp) tuple or None, and take the tokens of one
+        request carrying `messages` messages. Returns the new state and the
+        number of seconds to wait before sending.
+
+        Buckets may go negative: tokens are reserved up front and the caller
+        waits until the debt is paid back, so waiters are served in order.
+        '''
+        rps, mps = self.requests_per_second, self.messages_per_second
+        if state is None:
+            state = ((rps or 0) * self.burst, (mps or 0) * self.burst, now)
+        request_tokens, message_tokens, last = state
+        elapsed = max(0.0, now - last)
+        wait = 0.0
+        if rps:
+            request_tokens = min(rps * self.burst, request_tokens + elapsed * rps) - 1
+            wait = max(wait, -request_tokens / rps)
+        if mps:
+            message_tokens = min(mps * self.burst, message_tokens + elapsed * mps) - messages
+            wait = max(wait, -message_tokens / mps)
+        return (request_tokens, message_tokens, now), wait
+
+    def _reserve(self, messages=1):
+        '''
+        Take the tokens of one request and return the seconds to wait
+        before sending it.
+        '''
+        with self.__lock:
+            self.__state, wait = self._take(self.__state, self._now(), messages)
+        return wait
+
+    def acquire(self, messages=1):
+        '''
+        Block until a request carrying `messages` messages may be sent.
+        '''
+        wait = self._reserve(messages)
+        if wait > 0:
+            self.sleep(wait)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class PMFileRateLimiter(PMRateLimiter):
+    '''
+    A PMRateLimiter whose buckets are stored in a small file, locked with
+    flock(), so every process on the host using the same path shares them.
+    POSIX only.
+
+    Takes the path of the state file, then the PMRateLimiter keyword
+    arguments.
+    '''
+
+    def __init__(self, path, **kwargs):
+        super(PMFileRateLimiter, self).__init__(**kwargs)
+        import fcntl
+        self.__fcntl = fcntl
+        self.path = path
+        self.__lock = threading.Lock()
+
+    def _now(self):
+        # Monotonic clocks are not comparable across processes
+        return time.time()
+
+    def _reserve(self, messages=1):
+        with self.__lock:
+            with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b') as state_file:
+                self.__fcntl.flock(state_file, self.__fcntl.LOCK_EX)
+                try:
+                    state = tuple(float(value) for value in state_file.read().split())
+                    if len(state) != 3:
+                        state = None
+                except ValueError:
+                    state = None
+                state, wait = self._take(state, self._now(), messages)
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(('%r %r %r' % state).encode('ascii'))
+                state_file.flush()
+        return wait
+
+
+_default_rate_limiter = None
+
+
+def get_default_rate_limiter():
+    '''
+    Returns the PMRateLimiter applied to sends that do not pass their own,
+    or None.
+    '''
+    return _default_rate_limiter
+
+
+def set_default_rate_limiter(rate_limiter):
+    '''
+    Apply a PMRateLimiter to every PMMail and PMBatchMail send by default.
+    Pass None to stop rate limiting.
+    '''
+    global _default_rate_limiter
+    _default_rate_limiter = rate_limiter
+
+
+#
+# Circuit breaker
+
+class PMCircuitBreaker(object):
+    '''
+    Stops sending to Postmark for a while after it failed several times in a
+    row, so callers fail fast with PMMailCircuitOpenException during an
+    outage instead of each waiting for a socket timeout.
+
+    Connection errors and HTTP 5xx responses count as failures; any other
+    response, errors included, shows Postmark is up and resets the count.
+    Once reset_timeout has elapsed, the breaker is half-open: a single probe
+    request is let through, and its outcome closes or re-opens the breaker.
+
+    Keyword arguments are:
+    failure_threshold:  Number of consecutive failures opening the breaker.
+    reset_timeout:      Seconds the breaker stays open before probing.
+    on_state_change:    Optional callable(old_state, new_state), e.g. to feed metrics.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, on_state_change=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_state_change = on_state_change
+        self.__lock = threading.Lock()
+        self.__state = self.CLOSED
+        self.__failures = 0
+        self.__opened_at = None
+        self.__probing = False
+        self.__trips = 0
+        self.__rejected = 0
+
+    def _now(self):
+        return time.monotonic()
+
+    def _set_state(self, state):
+        # Called with the lock held; returns the (old, new) transition or None
+        if state == self.__state:
+            return None
+        old, self.__state = self.__state, state
+        return old, state
+
+    def _notify(self, transition):
+        if transition is not None and self.on_state_change is not None:
+            self.on_state_change(*transition)
+
+    @property
+    def state(self):
+        '''
+        One of CLOSED, OPEN or HALF_OPEN.
+        '''
+        with self.__lock:
+            if self.__state == self.OPEN and self._now() - self.__opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self.__state
+
+    def stats(self):
+        '''
+        Returns a dict describing the breaker, for metrics.
+        '''
+        return {
+            'state': self.state,
+            'consecutive_failures': self.__failures,
+            'trips': self.__trips,
+            'rejected': self.__rejected,
+        }
+
+    def before_request(self):
+        '''
+        Called before each request. Raises PMMailCircuitOpenException if the
+        request may not be sent.
+        '''
+        transition = None
+        with self.__lock:
+            if self.__state == self.OPEN:
+                remaining = self.reset_timeout - (self._now() - self.__opened_at)
+                if remaining > 0:
+                    self.__rejected += 1
+                    raise PMMailCircuitOpenException(
+                        'Circuit breaker open after %d consecutive failures to reach Postmark; '
+                        'next attempt in %.1f seconds.' % (self.__failures, remaining))
+                transition = self._set_state(self.HALF_OPEN)
+            if self.__state == self.HALF_OPEN:
+                if self.__probing:
+                    self.__rejected += 1
+                    raise PMMailCircuitOpenException('Circuit breaker half-open: waiting for the probe request to Postmark to complete.')
+                self.__probing = True
+        self._notify(transition)
+
+    def record(self, err):
+        '''
+        Record the outcome of a request: err is the URLError/HTTPError it
+        raised, or None if it succeeded.
+        '''
+        failed = err is not None and (not isinstance(err, HTTPError) or err.code >= 500)
+        with self.__lock:
+            self.__probing = False
+            if not failed:
+                self.__failures = 0
+                transition = self._set_state(self.CLOSED)
+            else:
+                self.__failures += 1
+                transition = None
+                if self.__state == self.HALF_OPEN or self.__failures >= self.failure_threshold:
+                    self.__opened_at = self._now()
+                    transition = self._set_state(self.OPEN)
+                    if transition is not None:
+                        self.__trips += 1
+        self._notify(transition)
+
+    def release(self):
+        '''
+        Called when a request ended without an outcome (e.g. it was
+        cancelled), so a half-open breaker can send another probe.
+        '''
+        with self.__lock:
+            self.__probing = False
+
+
+_default_circuit_breaker = None
+
+
+def get_default_circuit_breaker():
+    '''
+    Returns the PMCircuitBreaker guarding requests to Postmark, or None.
+    '''
+    return _default_circuit_breaker
+
+
+def set_default_circuit_breaker(circuit_breaker):
+    '''
+    Guard every request to Postmark with a PMCircuitBreaker. Pass None to
+    remove it.
+    '''
+    global _default_circuit_breaker
+    _default_circuit_breaker = circuit_breaker
+
+
+def _open_request(transport, req, retry=None, rate_limiter=None, messages=1, timeout=None, deadline=None):
+    '''
+    Send req over transport, retrying transient failures according to the
+    PMRetryPolicy retry. The request, and so its already encoded body, is
+    reused for every attempt. Each attempt first checks the default
+    PMCircuitBreaker, then waits for the PMRateLimiter rate_limiter,
+    counting `messages` messages.
+
+    Each attempt is bounded by the PMTimeout timeout, and no attempt or
+    retry is made past the time.monotonic() deadline.
+    '''
+    circuit_breaker = _default_circuit_breaker
+    attempt = 1
+    while True:
+        _remaining(deadline)
+        if circuit_breaker is not None:
+            circuit_breaker.before_request()
+        try:
+            if rate_limiter is not None:
+                rate_limiter.acquire(messages)
+            # The deadline running out locally is not a failure of Postmark
+            remaining = _remaining(deadline)
+        except BaseException:
+            if circuit_breaker is not None:
+                circuit_breaker.release()
+            raise
+        try:
+            result = transport.open(req, timeout.capped(remaining) if timeout is not None else None)
+        except URLError as err:
+            if circuit_breaker is not None:
+                circuit_breaker.record(err)
+            if retry is None or not retry.should_retry(err, attempt):
+                raise
+            delay = retry.delay(attempt, err)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            retry.sleep(delay)
+            attempt += 1
+            continue
+        except BaseException:
+            if circuit_breaker is not None:
+                circuit_breaker.release()
+            raise
+        if circuit_breaker is not None:
+            circuit_breaker.record(None)
+        return result
+
+
+#
+# Addresses
+
+# Recipients Postmark accepts in each of To, Cc and Bcc
+MAX_RECIPIENTS = 50
+
+_address_pattern = re.compile(r'[^@\s,<>"]+@[^@\s,<>".]+(?:\.[^@\s,<>".]+)+')
+# Characters that need a display name to be quoted
+_name_specials = re.compile(r'[][\\()<>@,:;".]')
+
+
+@lru_cache(maxsize=4096)
+def _parse_address_list(value):
+    '''
+    Returns the (name, address) pairs of a comma separated str, as parsed by
+    email.utils.getaddresses. Cached: the same recipients come back often.
+    '''
+    return tuple(getaddresses([value]))
+
+
+def parse_addresses(value):
+    '''
+    Returns the (name, address) pairs of a recipient field, given as a
+    comma separated str ("a@example.com, B <b@example.com>") or a list of
+    them. Addresses are stripped, their domain is lowercased, empty items
+    and duplicates (compared case-insensitively) are dropped.
+    '''
+    if not value:
+        return []
+    if isinstance(value, str):
+        pairs = _parse_address_list(value)
+    else:
+        pairs = [pair for item in value for pair in _parse_address_list(item)]
+
+    seen = set()
+    addresses = []
+    for name, address in pairs:
+        if not name and not address.strip():
+            # An empty item, e.g. after a trailing comma
+            continue
+        local, at, domain = address.strip().rpartition('@')
+        address = local + at + domain.lower() if at else domain
+        key = address.lower()
+        if key not in seen:
+            seen.add(key)
+            addresses.append((name, address))
+    return addresses
+
+
+def format_addresses(value):
+    '''
+    Returns a recipient field normalized by parse_addresses(), as a comma
+    separated str.
+    '''
+    return ', '.join(_format_address(name, address) for name, address in parse_addresses(value))
+
+
+def _format_address(name, address):
+    if not name:
+        return address
+    if _name_specials.search(name):
+        name = '"%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+    return '%s <%s>' % (name, address)
+
+
+def _recipient_field(value):
+    '''
+    Returns a recipient field as sent to Postmark: the comma separated str
+    of its addresses, duplicates dropped, as checked by _address_error().
+    '''
+    if not value or isinstance(value, str) and _address_pattern.fullmatch(value):
+        # A single plain address, the usual case
+        return value
+    return format_addresses(value)
+
+
+def _address_error(field, value):
+    '''
+    Returns why a recipient field cannot be sent, or None.
+    '''
+    if not value or isinstance(value, str) and _address_pattern.fullmatch(value):
+        # A single plain address, the usual case
+        return None
+    addresses = parse_addresses(value)
+    for name, address in addresses:
+        if not _address_pattern.fullmatch(address):
+            return 'Invalid e-mail address in .%s field: %r' % (field, address or value)
+    if len(addresses) > MAX_RECIPIENTS:
+        return 'Cannot send an e-mail to more than %d recipients in the .%s field (%d given)' % (
+            MAX_RECIPIENTS, field, len(addresses))
+    return None
+
+
 #
 #
 class PMMail(object):
@@ -50,6 +1108,18 @@ class PMMail(object):
     The Postmark Mail object.
     '''
 
+    # Transport used when none is passed in
+    _get_default_transport = staticmethod(get_default_transport)
+
+    # Slots rather than a per-instance __dict__ keep large batches compact.
+    # Subclasses should declare __slots__ too.
+    __slots__ = (
+        '__api_key', '__sender', '__reply_to', '__to', '__cc', '__bcc', '__subject', '__tag',
+        '__html_body', '__text_body', '__track_opens', '__custom_headers', '__attachments',
+        '__message_id', '__metadata', '__template_id', '__template_alias', '__template_model',
+        '__message_stream', '__transport', '__timeout', '__json_message', '__encoded',
+    )
+
     def __init__(self, **kwargs):
         '''
         Keyword arguments are:
@@ -58,13 +1128,13 @@ class PMMail(object):
                         "name@email.com" or "First Last <name@email.com>" format
         to:             Who to send the email to, in either
                         "name@email.com" or "First Last <name@email.com>" format
-                        Can be multiple values separated by commas (limit 20)
+                        Can be multiple values separated by commas (limit 50)
         cc:             Who to copy the email to, in either
                         "name@email.com" or "First Last <name@email.com>" format
-                        Can be multiple values separated by commas (limit 20)
+                        Can be multiple values separated by commas (limit 50)
         bcc:            Who to blind copy the email to, in either
                         "name@email.com" or "First Last <name@email.com>" format
-                        Can be multiple values separated by commas (limit 20)
+                        Can be multiple values separated by commas (limit 50)
         subject:        Subject of the email, ignored if using Postmark templates
         tag:            Use for adding categorizations to your email
         html_body:      Email message in HTML
@@ -77,6 +1147,8 @@ class PMMail(object):
         template_alias: alias of a Postmark template. See: https://postmarkapp.com/support/article/1117-how-do-i-use-a-template-alias
         template_model: a dictionary containing the values to be loaded into the template
         message_stream: Message stream ID that's used for sending. If not provided, message will default to the "outbound" transactional stream.
+        transport:      A PMTransport used to talk to Postmark. Defaults to the shared pooled transport (see get_default_transport()).
+        timeout:        A PMTimeout, or a number of seconds, limiting requests to Postmark. Defaults to get_default_timeout().
         '''
         # initialize properties
         self.__api_key = None
@@ -90,15 +1162,21 @@ class PMMail(object):
         self.__html_body = None
         self.__text_body = None
         self.__track_opens = False
-        self.__custom_headers = {}
-        self.__attachments = []
+        # Empty headers, attachments and metadata are only allocated on access
+        self.__custom_headers = None
+        self.__attachments = None
         self.__message_id = None
         # self.__multipart = False
-        self.__metadata = {}
+        self.__metadata = None
         self.__template_id = None
         self.__template_alias = None
         self.__template_model = None
         self.__message_stream = None
+        self.__transport = None
+        self.__timeout = None
+        # to_json_message() and its encoding, until a field changes
+        self.__json_message = None
+        self.__encoded = None
 
         acceptable_keys = (
             'api_key',
@@ -119,7 +1197,9 @@ class PMMail(object):
             'template_id',
             'template_alias',
             'template_model',
-            'message_stream'
+            'message_stream',
+            'transport',
+            'timeout'
         )
 
         for key in kwargs:
@@ -129,22 +1209,14 @@ class PMMail(object):
                 else:
                     setattr(self, key, kwargs[key])
 
-        # Set up the user-agent
-        self.__user_agent = 'Python/%s (python-postmark library version %s)' % ('_'.join([str(var) for var in sys.version_info]), __version__)
-
         # Try to pull in the API key from Django
-        try:
-            from django import VERSION
-            from django.conf import settings as django_settings
-            self.__user_agent = '%s (Django %s)' % (self.__user_agent, '_'.join([str(var) for var in VERSION]))
-            if not self.__api_key and hasattr(django_settings, 'POSTMARK_API_KEY'):
-                self.__api_key = django_settings.POSTMARK_API_KEY
-            if not self.__sender and hasattr(django_settings, 'POSTMARK_SENDER'):
-                self.__sender = django_settings.POSTMARK_SENDER
-            if not self.__track_opens and hasattr(django_settings, 'POSTMARK_TRACK_OPENS'):
-                self.__track_opens = django_settings.POSTMARK_TRACK_OPENS
-        except ImportError:
-            pass
+        config = get_config()
+        if not self.__api_key:
+            self.__api_key = config.setting('POSTMARK_API_KEY', self.__api_key)
+        if not self.__sender:
+            self.__sender = config.setting('POSTMARK_SENDER', self.__sender)
+        if not self.__track_opens:
+            self.__track_opens = config.setting('POSTMARK_TRACK_OPENS', self.__track_opens)
 
     @property
     def messages(self):
@@ -154,43 +1226,81 @@ class PMMail(object):
     #
     # Properties
 
+    def _changed(self, name, value):
+        '''
+        Set a field sent to Postmark, dropping the cached to_json_message()
+        '''
+        setattr(self, name, value)
+        self.__json_message = None
+        self.__encoded = None
+
+    def _get_custom_headers(self):
+        # The caller may change it in place
+        self.__json_message = None
+        self.__encoded = None
+        if self.__custom_headers is None:
+            self.__custom_headers = {}
+        return self.__custom_headers
+
     def _set_custom_headers(self, value):
         '''
         A special set function to ensure
         we're setting with a dictionary
         '''
         if value is None:
-            setattr(self, '_PMMail__custom_headers', {})
+            self._changed('_PMMail__custom_headers', None)
         elif isinstance(value, dict):
-            setattr(self, '_PMMail__custom_headers', value)
+            self._changed('_PMMail__custom_headers', value)
         else:
             raise TypeError('Custom headers must be a dictionary of key-value pairs')
 
+    def _get_metadata(self):
+        # The caller may change it in place
+        self.__json_message = None
+        self.__encoded = None
+        if self.__metadata is None:
+            self.__metadata = {}
+        return self.__metadata
+
     def _set_metadata(self, value):
         '''
         A special set function to ensure
         we're setting with a dictionary
         '''
         if value is None:
-            setattr(self, '_PMMail__metadata', {})
+            self._changed('_PMMail__metadata', None)
         elif isinstance(value, dict):
             for k, v in value.items():
                 if (not isinstance(k, str) and not isinstance(k, int)) \
                     or (not isinstance(v, str) and not isinstance(v, int)):
                     raise TypeError('Metadata keys and values can only be strings or integers')
-            setattr(self, '_PMMail__metadata', value)
+            self._changed('_PMMail__metadata', value)
         else:
             raise TypeError('Metadata must be a dictionary of key-value pairs')
 
+    def _get_template_model(self):
+        # The caller may change it in place
+        self.__json_message = None
+        self.__encoded = None
+        return self.__template_model
+
+    def _get_attachments(self):
+        # The caller may change it in place
+        self.__json_message = None
+        self.__encoded = None
+        if self.__attachments is None:
+            self.__attachments = []
+        return self.__attachments
+
     def _set_attachments(self, value):
         '''
         A special set function to ensure
         we're setting with a list
         '''
         if value is None:
-            setattr(self, '_PMMail__attachments', [])
+            self._changed('_PMMail__attachments', None)
         elif isinstance(value, list):
-            setattr(self, '_PMMail__attachments', value)
+            self._changed('_PMMail__attachments', value)
         else:
             raise TypeError('Attachments must be a list')
 
@@ -206,8 +1316,8 @@ class PMMail(object):
     # "from" is a reserved word
     sender = property(
         lambda self: self.__sender,
-        lambda self, value: setattr(self, '_PMMail__sender', value),
-        lambda self: setattr(self, '_PMMail__sender', None),
+        lambda self, value: self._changed('_PMMail__sender', value),
+        lambda self: self._changed('_PMMail__sender', None),
         '''
         The sender, in either "name@email.com" or "First Last <name@email.com>" formats.
         The address should match one of your Sender Signatures in Postmark.
@@ -218,8 +1328,8 @@ class PMMail(object):
 
     reply_to = property(
         lambda self: self.__reply_to,
-        lambda self, value: setattr(self, '_PMMail__reply_to', value),
-        lambda self: setattr(self, '_PMMail__reply_to', None),
+        lambda self, value: self._changed('_PMMail__reply_to', value),
+        lambda self: self._changed('_PMMail__reply_to', None),
         '''
         A reply-to address, in either "name@email.com" or "First Last <name@email.com>"
         format. The reply-to address does not have to be one of your Sender Signatures in Postmark.
@@ -229,8 +1339,8 @@ class PMMail(object):
 
     to = property(
         lambda self: self.__to,
-        lambda self, value: setattr(self, '_PMMail__to', value),
-        lambda self: setattr(self, '_PMMail__to', None),
+        lambda self, value: self._changed('_PMMail__to', value),
+        lambda self: self._changed('_PMMail__to', None),
         '''
         The recipients, in either "name@email.com" or "First Last <name@email.com>" formats
         '''
@@ -238,8 +1348,8 @@ class PMMail(object):
 
     cc = property(
         lambda self: self.__cc,
-        lambda self, value: setattr(self, '_PMMail__cc', value),
-        lambda self: setattr(self, '_PMMail__cc', None),
+        lambda self, value: self._changed('_PMMail__cc', value),
+        lambda self: self._changed('_PMMail__cc', None),
         '''
         The cc recipients, in either "name@email.com" or "First Last <name@email.com>" formats
         '''
@@ -247,8 +1357,8 @@ class PMMail(object):
 
     bcc = property(
         lambda self: self.__bcc,
-        lambda self, value: setattr(self, '_PMMail__bcc', value),
-        lambda self: setattr(self, '_PMMail__bcc', None),
+        lambda self, value: self._changed('_PMMail__bcc', value),
+        lambda self: self._changed('_PMMail__bcc', None),
         '''
         The bcc recipients, in either "name@email.com" or "First Last <name@email.com>" formats
         '''
@@ -256,8 +1366,8 @@ class PMMail(object):
 
     subject = property(
         lambda self: self.__subject,
-        lambda self, value: setattr(self, '_PMMail__subject', value),
-        lambda self: setattr(self, '_PMMail__subject', None),
+        lambda self, value: self._changed('_PMMail__subject', value),
+        lambda self: self._changed('_PMMail__subject', None),
         '''
         The subject of your email message
         '''
@@ -265,8 +1375,8 @@ class PMMail(object):
 
     tag = property(
         lambda self: self.__tag,
-        lambda self, value: setattr(self, '_PMMail__tag', value),
-        lambda self: setattr(self, '_PMMail__tag', None),
+        lambda self, value: self._changed('_PMMail__tag', value),
+        lambda self: self._changed('_PMMail__tag', None),
         '''
         You can categorize outgoing email using the optional Tag property.
         If you use different tags for the different types of emails your application generates,
@@ -276,8 +1386,8 @@ class PMMail(object):
 
     html_body = property(
         lambda self: self.__html_body,
-        lambda self, value: setattr(self, '_PMMail__html_body', value),
-        lambda self: setattr(self, '_PMMail__html_body', None),
+        lambda self, value: self._changed('_PMMail__html_body', value),
+        lambda self: self._changed('_PMMail__html_body', None),
         '''
         The email message body, in html format
         '''
@@ -285,8 +1395,8 @@ class PMMail(object):
 
     text_body = property(
         lambda self: self.__text_body,
-        lambda self, value: setattr(self, '_PMMail__text_body', value),
-        lambda self: setattr(self, '_PMMail__text_body', None),
+        lambda self, value: self._changed('_PMMail__text_body', value),
+        lambda self: self._changed('_PMMail__text_body', None),
         '''
         The email message body, in text format
         '''
@@ -294,8 +1404,8 @@ class PMMail(object):
 
     track_opens = property(
         lambda self: self.__track_opens,
-        lambda self, value: setattr(self, '_PMMail__track_opens', value),
-        lambda self: setattr(self, '_PMMail__track_opens', None),
+        lambda self, value: self._changed('_PMMail__track_opens', value),
+        lambda self: self._changed('_PMMail__track_opens', None),
         '''
         Whether or not to track opens
         NOTE: Requires html_body to be set to work
@@ -303,9 +1413,9 @@ class PMMail(object):
     )
 
     custom_headers = property(
-        lambda self: self.__custom_headers,
+        _get_custom_headers,
         _set_custom_headers,
-        lambda self: setattr(self, '_PMMail__custom_headers', {}),
+        lambda self: self._changed('_PMMail__custom_headers', None),
         '''
         Custom headers in a standard dictionary.
         NOTE: To change the reply to address, use the .reply_to
@@ -314,9 +1424,9 @@ class PMMail(object):
     )
 
     attachments = property(
-        lambda self: self.__attachments,
+        _get_attachments,
         _set_attachments,
-        lambda self: setattr(self, '_PMMail__attachments', []),
+        lambda self: self._changed('_PMMail__attachments', None),
         '''
         Attachments, Base64 encoded, in a list.
         '''
@@ -329,9 +1439,9 @@ class PMMail(object):
     # )
 
     metadata = property(
-        lambda self: self.__metadata,
+        _get_metadata,
         _set_metadata,
-        lambda self: setattr(self, '_PMMail_metadata', {}),
+        lambda self: self._changed('_PMMail__metadata', None),
         '''
         Custom metadata key/value pairs returned by webhooks.
         '''
@@ -339,26 +1449,44 @@ class PMMail(object):
 
     template_id = property(
         lambda self: self.__template_id,
-        lambda self, value: setattr(self, '_PMMail__template_id', value),
-        lambda self: setattr(self, '_PMMail__template_id', {}),
+        lambda self, value: self._changed('_PMMail__template_id', value),
+        lambda self: self._changed('_PMMail__template_id', {}),
     )
 
     template_alias = property(
         lambda self: self.__template_alias,
-        lambda self, value: setattr(self, '_PMMail__template_alias', value),
-        lambda self: setattr(self, '_PMMail__template_alias', None),
+        lambda self, value: self._changed('_PMMail__template_alias', value),
+        lambda self: self._changed('_PMMail__template_alias', None),
     )
 
     template_model = property(
-        lambda self: self.__template_model,
-        lambda self, value: setattr(self, '_PMMail__template_model', value),
-        lambda self: setattr(self, '_PMMail__template_model', {}),
+        _get_template_model,
+        lambda self, value: self._changed('_PMMail__template_model', value),
+        lambda self: self._changed('_PMMail__template_model', {}),
     )
 
     message_stream = property(
         lambda self: self.__message_stream,
-        lambda self, value: setattr(self, '_PMMail__message_stream', value),
-        lambda self: setattr(self, '_PMMail__message_stream', None),
+        lambda self, value: self._changed('_PMMail__message_stream', value),
+        lambda self: self._changed('_PMMail__message_stream', None),
+    )
+
+    transport = property(
+        lambda self: self.__transport or self._get_default_transport(),
+        lambda self, value: setattr(self, '_PMMail__transport', value),
+        lambda self: setattr(self, '_PMMail__transport', None),
+        '''
+        The PMTransport used to send this message
+        '''
+    )
+
+    timeout = property(
+        lambda self: self.__timeout or _default_timeout,
+        lambda self, value: setattr(self, '_PMMail__timeout', _coerce_timeout(value)),
+        lambda self: setattr(self, '_PMMail__timeout', None),
+        '''
+        The PMTimeout limiting requests sending this message
+        '''
     )
 
     message_id = property(
@@ -378,8 +1506,8 @@ class PMMail(object):
 
     recipient = property(
         lambda self: self.__to,
-        lambda self, value: setattr(self, '_PMMail__to', value),
-        lambda self: setattr(self, '_PMMail__to', None),
+        lambda self, value: self._changed('_PMMail__to', value),
+        lambda self: self._changed('_PMMail__to', None),
         '''
         The recipients, in either "name@email.com" or "First Last <name@email.com>" formats
         '''
@@ -396,43 +1524,110 @@ class PMMail(object):
         Make sure all values are of the appropriate
         type and are not missing.
         '''
-        if not self.__api_key:
-            raise PMMailMissingValueException('Cannot send an e-mail without a Postmark API Key')
-        elif not self.__sender:
-            raise PMMailMissingValueException('Cannot send an e-mail without a sender (.sender field)')
-        elif not self.__to and not self.__bcc:
-            raise PMMailMissingValueException('Cannot send an e-mail without at least one recipient (.to field or .bcc field)')
-        elif self.__template_id and not all([self.__template_id, self.__template_model]):
-            raise PMMailMissingValueException(
-                'Cannot send a template e-mail without a both template_id and template_model set')
-        elif self.__template_alias and not all([self.__template_alias, self.__template_model]):
-            raise PMMailMissingValueException(
-                'Cannot send a template e-mail without both a template_alias and template_model set')
-        elif self.__template_model and not any([self.__template_id, self.__template_alias]):
-            raise PMMailMissingValueException(
-                'Cannot send a template e-mail without either a template_id or template_alias set')
-        elif not any([self.__template_id, self.__template_alias, self.__template_model, self.__subject]):
-            raise PMMailMissingValueException('Cannot send an e-mail without a subject')
-        elif not self.__html_body and not self.__text_body and not (self.__template_id or self.__template_alias):
-            raise PMMailMissingValueException('Cannot send an e-mail without either an HTML or text version of your e-mail body')
+        error = self._validation_error()
+        if error is not None:
+            raise PMMailMissingValueException(error)
         if self.__track_opens and not self.__html_body:
             print('WARNING: .track_opens set to True with no .html_body set. Tracking opens will not work; message will still send.')
 
+    def _validation_error(self):
+        '''
+        Returns why the message cannot be sent, or None.
+        '''
+        if not self.__api_key:
+            return 'Cannot send an e-mail without a Postmark API Key'
+        if not self.__sender:
+            return 'Cannot send an e-mail without a sender (.sender field)'
+        if not self.__to and not self.__bcc:
+            return 'Cannot send an e-mail without at least one recipient (.to field or .bcc field)'
+        error = (_address_error('to', self.__to) or _address_error('cc', self.__cc)
+                 or _address_error('bcc', self.__bcc) or _address_error('reply_to', self.__reply_to))
+        if error is not None:
+            return error
+        template = self.__template_id or self.__template_alias
+        if template or self.__template_model:
+            if self.__template_id and not self.__template_model:
+                return 'Cannot send a template e-mail without a both template_id and template_model set'
+            if self.__template_alias and not self.__template_model:
+                return 'Cannot send a template e-mail without both a template_alias and template_model set'
+            if not template:
+                return 'Cannot send a template e-mail without either a template_id or template_alias set'
+            return None
+        if not self.__subject:
+            return 'Cannot send an e-mail without a subject'
+        if not self.__html_body and not self.__text_body:
+            return 'Cannot send an e-mail without either an HTML or text version of your e-mail body'
+        return None
+
+    def _tracks_opens_without_html(self):
+        return bool(self.__track_opens) and not self.__html_body
+
+    def _batch_check(self):
+        '''
+        Returns the _validation_error() of the message, whether it uses a
+        template and whether it tracks opens without an HTML body, for
+        PMBatchMail.validate().
+        '''
+        return (self._validation_error(), bool(self.__template_id or self.__template_model),
+                bool(self.__track_opens) and not self.__html_body)
+
     def to_json_message(self):
+        '''
+        Returns the message as a dict in the Postmark API format. It is built
+        once and reused until a field of the message is set, so dicts and
+        lists changed in place must be set again (custom_headers, metadata,
+        template_model and attachments read through the message are taken
+        into account).
+
+        The dict and its Headers, Attachments, Metadata and TemplateModel are
+        copies that can be changed freely.
+        '''
+        json_message = dict(self._json_message())
+        for key in ('Headers', 'Attachments'):
+            if key in json_message:
+                json_message[key] = [dict(item) for item in json_message[key]]
+        if 'Metadata' in json_message:
+            json_message['Metadata'] = dict(json_message['Metadata'])
+        if 'TemplateModel' in json_message:
+            json_message['TemplateModel'] = copy.deepcopy(json_message['TemplateModel'])
+        return json_message
+
+    def _json_message(self):
+        '''
+        Returns the cached to_json_message() dict itself, built from copies of
+        the message's fields, for encoding without copying it.
+        '''
+        if self.__json_message is None:
+            self.__json_message = self._build_json_message()
+        return self.__json_message
+
+    def _encode(self):
+        '''
+        Returns the JSON encoding of to_json_message(), cached like it unless
+        PMAttachment contents are streamed into it.
+        '''
+        encoded = self.__encoded
+        if encoded is None:
+            encoded = _encode_json_message(self._json_message())
+            if isinstance(encoded, bytes):
+                self.__encoded = encoded
+        return encoded
+
+    def _build_json_message(self):
         json_message = {
             'From': self.__sender,
-            'To': self.__to,
+            'To': _recipient_field(self.__to),
             'Subject': self.__subject,
         }
 
         if self.__reply_to:
-            json_message['ReplyTo'] = self.__reply_to
+            json_message['ReplyTo'] = _recipient_field(self.__reply_to)
 
         if self.__cc:
-            json_message['Cc'] = self.__cc
+            json_message['Cc'] = _recipient_field(self.__cc)
 
         if self.__bcc:
-            json_message['Bcc'] = self.__bcc
+            json_message['Bcc'] = _recipient_field(self.__bcc)
 
         if self.__tag:
             json_message['Tag'] = self.__tag
@@ -450,12 +1645,12 @@ class PMMail(object):
             json_message['TemplateAlias'] = self.__template_alias
 
         if self.__template_model:
-            json_message['TemplateModel'] = self.__template_model
+            json_message['TemplateModel'] = copy.deepcopy(self.__template_model)
 
         if self.__track_opens:
             json_message['TrackOpens'] = True
 
-        if len(self.__custom_headers) > 0:
+        if self.__custom_headers:
             cust_headers = []
             for key, value in self.__custom_headers.items():
                 cust_headers.append({
@@ -464,10 +1659,10 @@ class PMMail(object):
                 })
             json_message['Headers'] = cust_headers
 
-        if len(self.__metadata) > 0:
-            json_message['Metadata'] = self.__metadata
+        if self.__metadata:
+            json_message['Metadata'] = dict(self.__metadata)
 
-        if len(self.__attachments) > 0:
+        if self.__attachments:
             attachments = []
             for attachment in self.__attachments:
                 if isinstance(attachment, tuple):
@@ -494,6 +1689,15 @@ class PMMail(object):
                         if (attachment.get("Content-Disposition") or "").startswith("inline"):
                             content_id = "cid:%s" % content_id
                         file_item["ContentID"] = content_id
+                elif isinstance(attachment, PMAttachment):
+                    # Encoded into the request body when it is written
+                    file_item = {
+                        "Name": attachment.name,
+                        "Content": attachment,
+                        "ContentType": attachment.content_type,
+                    }
+                    if attachment.content_id:
+                        file_item["ContentID"] = attachment.content_id
                 else:
                     continue
                 attachments.append(file_item)
@@ -504,16 +1708,85 @@ class PMMail(object):
 
         return json_message
 
-    def send(self, test=None, return_json=None):
+    def _build_request(self, payload):
+        '''
+        Build the urllib Request sending the encoded message to Postmark.
+        '''
+        if self.__template_id or self.__template_alias:
+            endpoint_url = __POSTMARK_URL__ + 'email/withTemplate/'
+        else:
+            endpoint_url = __POSTMARK_URL__ + 'email'
+
+        return Request(
+            endpoint_url,
+            payload,
+            {
+                'Accept': 'application/json',
+                'Content-Type': 'application/json',
+                'Content-Length': str(len(payload)),
+                'X-Postmark-Server-Token': self.__api_key,
+                'User-agent': get_config().user_agent
+            }
+        )
+
+    def _handle_result(self, result, return_json):
+        '''
+        Process a response returned by the transport.
+        '''
+        jsontxt = result.read().decode('utf8')
+        result.close()
+        if result.code == 200:
+            parsed = get_serializer().loads(jsontxt)
+            self.message_id = parsed.get("MessageID", None)
+            return parsed if return_json else True
+        else:
+            raise PMMailSendException('Return code %d: %s' % (result.code, result.msg))
+
+    def send(self, test=None, return_json=None, retry=None, rate_limiter=None, timeout=None):
         '''
         Send the email through the Postmark system.
         Pass test=True to just print out the resulting
         JSON message being sent to Postmark
+
+        Args:
+            return_json (bool | None):
+                True  -> return parsed JSON
+                False -> return True/False
+                None  -> fallback to settings.POSTMARK_RETURN_JSON (default False)
+            retry (PMRetryPolicy | None):
+                Retry transient failures according to this policy.
+            rate_limiter (PMRateLimiter | None):
+                Wait for this rate limiter before sending. Defaults to
+                get_default_rate_limiter().
+            timeout (PMTimeout | float | None):
+                Time limits of this call. Defaults to .timeout.
+        '''
+        prepared = self._prepare_send(test, return_json)
+        if prepared is None:
+            return
+        req, return_json = prepared
+        timeout = _coerce_timeout(timeout) or self.timeout
+
+        # Attempt send
+        try:
+            # print 'sending request to postmark: %s' % json_message
+            result = _open_request(self.transport, req, retry, rate_limiter or _default_rate_limiter,
+                                   timeout=timeout, deadline=timeout and timeout.start())
+        except URLError as err:
+            _raise_send_exception(err)
+            return
+        return self._handle_result(result, return_json)
+
+    def _prepare_send(self, test, return_json):
+        '''
+        Validate the message and build its request for send().
+        Returns (request, return_json), or None if the message was only
+        printed because of test mode.
         '''
         self._check_values()
 
-        # Set up message dictionary
-        json_message = self.to_json_message()
+        # Set up the encoded message
+        payload = self._encode()
 
         # if (self.__html_body and not self.__text_body) and self.__multipart:
         #     # TODO: Set up regex to strip html
@@ -521,124 +1794,485 @@ class PMMail(object):
 
         # If test is not specified, attempt to read the Django setting
         if test is None:
-            try:
-                from django.conf import settings as django_settings
-                test = getattr(django_settings, "POSTMARK_TEST_MODE", None)
-            except ImportError:
-                pass
+            test = _django_setting('POSTMARK_TEST_MODE', None)
 
         # If this is a test, just print the message
         if test:
-            print('JSON message is:\n%s' % json.dumps(json_message, cls=PMJSONEncoder))
-            return
-
-        if self.__template_id or self.__template_alias:
-            endpoint_url = __POSTMARK_URL__ + 'email/withTemplate/'
-        else:
-            endpoint_url = __POSTMARK_URL__ + 'email'
-
-        """
-        Args:
-            return_json (bool | None):
-                True  -> return parsed JSON
-                False -> return True/False
-                None  -> fallback to settings.POSTMARK_RETURN_JSON (default False)
-        """
+            print('JSON message is:\n%s' % bytes(payload).decode('utf8'))
+            return None
 
         if return_json is None:
-            try:
-                from django.conf import settings as django_settings
-                return_json = getattr(django_settings, "POSTMARK_RETURN_JSON", False)
-            except ImportError:
-                return_json = False
+            return_json = _django_setting('POSTMARK_RETURN_JSON', False)
 
         # Set up the url Request
-        req = Request(
-            endpoint_url,
-            json.dumps(json_message, cls=PMJSONEncoder).encode('utf8'),
-            {
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
-                'X-Postmark-Server-Token': self.__api_key,
-                'User-agent': self.__user_agent
-            }
-        )
+        return self._build_request(payload), return_json
 
-        # Attempt send
-        try:
-            # print 'sending request to postmark: %s' % json_message
-            result = urlopen(req)
-            jsontxt = result.read().decode('utf8')
-            result.close()
-            if result.code == 200:
-                parsed = json.loads(jsontxt)
-                self.message_id = parsed.get("MessageID", None)
-                return parsed if return_json else True
-            else:
-                raise PMMailSendException('Return code %d: %s' % (result.code, result.msg))
-        except HTTPError as err:
-            if err.code == 401:
-                raise PMMailUnauthorizedException('Sending Unauthorized - incorrect API key.', err)
-            elif err.code == 422:
-                try:
-                    jsontxt = err.read().decode('utf8')
-                    jsonobj = json.loads(jsontxt)
-                    desc = jsonobj['Message']
-                    error_code = jsonobj['ErrorCode']
-                except KeyError:
-                    raise PMMailUnprocessableEntityException('Unprocessable Entity: Description not given')
-
-                if error_code == 406:
-                    raise PMMailInactiveRecipientException('You tried to send email to a recipient that has been marked as inactive.')
-
-                raise PMMailUnprocessableEntityException('Unprocessable Entity: %s' % desc)
-            elif err.code == 500:
-                raise PMMailServerErrorException('Internal server error at Postmark. Admins have been alerted.', err)
-        except URLError as err:
-            if hasattr(err, 'reason'):
-                raise PMMailURLException('URLError: Failed to reach the server: %s (See "inner_exception" for details)' % err.reason, err)
-            elif hasattr(err, 'code'):
-                raise PMMailURLException('URLError: %d: The server couldn\'t fufill the request. (See "inner_exception" for details)' % err.code, err)
+
+def _django_setting(name, default):
+    '''
+    Read a setting from the Django settings file, if Django is installed.
+    '''
+    return get_config().setting(name, default)
+
+
+def _unprocessable_entity(err):
+    '''
+    Returns the (Message, ErrorCode) pair from the body of a 422 HTTPError.
+    '''
+    try:
+        jsontxt = err.read().decode('utf8')
+        jsonobj = get_serializer().loads(jsontxt)
+        return jsonobj['Message'], jsonobj['ErrorCode']
+    except KeyError:
+        raise PMMailUnprocessableEntityException('Unprocessable Entity: Description not given')
+
+
+def _raise_send_exception(err, inactive_recipient=True):
+    '''
+    Translate an HTTPError/URLError raised by a transport into the matching
+    PMMailSendException. HTTP codes without a dedicated exception are ignored.
+
+    When inactive_recipient is False, a 406 "inactive recipient" error is
+    returned as True instead of raised, so batch sends can carry on with the
+    remaining chunks.
+    '''
+    if isinstance(err, HTTPError):
+        if err.code == 401:
+            raise PMMailUnauthorizedException('Sending Unauthorized - incorrect API key.', err)
+        elif err.code == 422:
+            desc, error_code = _unprocessable_entity(err)
+
+            if error_code == 406:
+                if not inactive_recipient:
+                    return True
+                raise PMMailInactiveRecipientException('You tried to send email to a recipient that has been marked as inactive.')
+
+            raise PMMailUnprocessableEntityException('Unprocessable Entity: %s' % desc)
+        elif err.code == 500:
+            raise PMMailServerErrorException('Internal server error at Postmark. Admins have been alerted.', err)
+    elif hasattr(err, 'reason'):
+        raise PMMailURLException('URLError: Failed to reach the server: %s (See "inner_exception" for details)' % err.reason, err)
+    elif hasattr(err, 'code'):
+        raise PMMailURLException('URLError: %d: The server couldn\'t fufill the request. (See "inner_exception" for details)' % err.code, err)
+    else:
+        raise PMMailURLException('URLError: The server couldn\'t fufill the request. (See "inner_exception" for details)', err)
+    return False
+
+
+class PMJSONBody(object):
+    '''
+    A request body made of already encoded JSON fragments. Transports write
+    the fragments one after the other, so the body is never joined into a
+    single bytes object; bytes(body) does join them when needed.
+
+    A fragment is either bytes or an iterable of bytes with a len(), such as
+    another PMJSONBody or a PMAttachment, which is read again each time the
+    body is written.
+    '''
+
+    def __init__(self, pieces, size=None):
+        self.pieces = pieces
+        self.size = sum(len(piece) for piece in pieces) if size is None else size
+
+    def __iter__(self):
+        for piece in self.pieces:
+            if isinstance(piece, bytes):
+                yield piece
             else:
-                raise PMMailURLException('URLError: The server couldn\'t fufill the request. (See "inner_exception" for details)', err)
+                for data in piece:
+                    yield data
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return b''.join(self)
+
+
+class PMAttachment(object):
+    '''
+    An attachment read from a file, a file object or a buffer only when its
+    message is sent, and base64 encoded a piece at a time straight into the
+    request body. The content is never held whole in memory, nor as a base64
+    str:
+
+        message.attachments = [PMAttachment('/srv/reports/2024.pdf')]
+
+    Unless a PMAttachmentCache is installed with set_default_attachment_cache():
+    contents it can hold are then read whole and encoded once, to be shared
+    by every message attaching them.
+
+    Keyword arguments are:
+    source:         A path, a seekable binary file object, read from its
+                    current position, or a bytes-like object such as bytes or
+                    an mmap. Read the content of pipes and sockets into bytes
+                    first.
+    name:           File name shown to recipients. Defaults to the base name of
+                    a path or of the file object's name.
+    content_type:   MIME type of the content. Guessed from the name by default.
+    content_id:     Content-ID of an inline attachment, e.g. "cid:logo.png".
+    '''
+
+    # Read in multiples of 3 bytes so pieces are encoded without padding
+    CHUNK_SIZE = 3 * 64 * 1024
+
+    def __init__(self, source, name=None, content_type=None, content_id=None):
+        self.source = source
+        self.__path = None
+        self.__offset = None
+        if isinstance(source, str) or hasattr(source, '__fspath__'):
+            self.__path = os.fspath(source)
+            path = self.__path
+        elif hasattr(source, 'read') and not isinstance(source, mmap.mmap):
+            # The content is measured and may be read again on retries
+            if not getattr(source, 'seekable', lambda: True)():
+                raise TypeError('PMAttachment needs a seekable file object, not %r' % (source,))
+            self.__offset = source.tell()
+            path = getattr(source, 'name', None)
+        else:
+            path = None
+        if name is None and isinstance(path, str):
+            name = os.path.basename(path)
+        self.name = name
+        self.content_type = content_type or (name and mimetypes.guess_type(name)[0]) or 'application/octet-stream'
+        self.content_id = content_id
+
+    def _size(self):
+        '''
+        Number of bytes of content.
+        '''
+        if self.__path is not None:
+            return os.path.getsize(self.__path)
+        if self.__offset is not None:
+            self.source.seek(0, os.SEEK_END)
+            end = self.source.tell()
+            self.source.seek(self.__offset)
+            return end - self.__offset
+        return memoryview(self.source).nbytes
+
+    def _chunks(self):
+        '''
+        Yields the content in pieces of CHUNK_SIZE bytes.
+        '''
+        if self.__path is not None:
+            with open(self.__path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                    yield chunk
+        elif self.__offset is not None:
+            self.source.seek(self.__offset)
+            for chunk in iter(lambda: self.source.read(self.CHUNK_SIZE), b''):
+                yield chunk
+        else:
+            view = memoryview(self.source).cast('B')
+            for start in range(0, len(view), self.CHUNK_SIZE):
+                yield view[start:start + self.CHUNK_SIZE]
+
+    def __len__(self):
+        '''
+        Length of the base64 encoded content.
+        '''
+        return (self._size() + 2) // 3 * 4
+
+    def _cached(self, cache):
+        '''
+        Returns the base64 encoded content from cache, encoding it if needed,
+        or None when it is too large to be cached.
+        '''
+        size = self._size()
+        if size > cache.max_entry_size // 4 * 3:
+            return None
+        if self.__path is not None:
+            stat = os.stat(self.__path)
+            key = (self.__path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            digest = cache._file_digest(key)
+            if digest is not None:
+                encoded = cache._get(digest)
+                if encoded is not None:
+                    return encoded
+            with open(self.__path, 'rb') as f:
+                content = f.read()
+            digest = cache._digest(content)
+            cache._set_file_digest(key, digest)
+            return cache.encode(content, digest)
+        if self.__offset is not None:
+            self.source.seek(self.__offset)
+            return cache.encode(self.source.read())
+        return cache.encode(self.source)
+
+    def __iter__(self):
+        '''
+        Yields the base64 encoded content, a piece at a time, or in one piece
+        shared with identical attachments through the default
+        PMAttachmentCache.
+        '''
+        cache = _default_attachment_cache
+        if cache is not None:
+            encoded = self._cached(cache)
+            if encoded is not None:
+                yield encoded
+                return
+
+        rest = b''
+        for chunk in self._chunks():
+            if rest:
+                chunk = rest + chunk
+            # A short read must not end a piece with padding
+            cut = len(chunk) - len(chunk) % 3
+            rest = bytes(chunk[cut:])
+            if cut:
+                yield base64.b64encode(chunk[:cut])
+        if rest:
+            yield base64.b64encode(rest)
+
+
+class PMAttachmentCache(object):
+    '''
+    The base64 encoding of recently sent PMAttachment contents, keyed by a
+    hash of the content, so an attachment repeated across messages (terms and
+    conditions, a logo...) is encoded once and the same bytes are written in
+    every message and chunk that carries it.
+
+    Least recently used encodings are evicted once they total more than
+    max_bytes. Files are hashed again only when their size or modification
+    time change.
+
+    No cache is used by default, so attachments are streamed. Install one
+    with set_default_attachment_cache() when the same attachments are sent
+    many times; contents up to max_entry_size are then read whole in memory.
+
+    Keyword arguments are:
+    max_bytes:      Total size of the encodings kept, in bytes.
+    max_entry_size: Size of the largest encoding kept. Larger attachments are
+                    streamed without being cached. Defaults to a quarter of
+                    max_bytes.
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_size=None):
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_bytes // 4 if max_entry_size is None else max_entry_size
+        self.hits = 0
+        self.misses = 0
+        self.__size = 0
+        self.__entries = OrderedDict()
+        # (path, inode, size, mtime) -> digest of the file's content
+        self.__digests = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def _digest(content):
+        return hashlib.sha256(content).digest()
+
+    def _file_digest(self, key):
+        with self.__lock:
+            return self.__digests.get(key)
+
+    def _set_file_digest(self, key, digest):
+        with self.__lock:
+            self.__digests[key] = digest
+            if len(self.__digests) > 1024:
+                self.__digests.popitem(last=False)
+
+    def _get(self, digest):
+        with self.__lock:
+            encoded = self.__entries.get(digest)
+            if encoded is not None:
+                self.__entries.move_to_end(digest)
+                self.hits += 1
+            return encoded
+
+    def encode(self, content, digest=None):
+        '''
+        Returns the base64 encoding of content, as bytes.
+        '''
+        if digest is None:
+            digest = self._digest(content)
+        encoded = self._get(digest)
+        if encoded is not None:
+            return encoded
+
+        encoded = base64.b64encode(content)
+        with self.__lock:
+            self.misses += 1
+            if len(encoded) <= self.max_entry_size and digest not in self.__entries:
+                self.__entries[digest] = encoded
+                self.__size += len(encoded)
+                while self.__size > self.max_bytes:
+                    self.__size -= len(self.__entries.popitem(last=False)[1])
+        return encoded
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__digests.clear()
+            self.__size = 0
+
+    def stats(self):
+        '''
+        Returns the number of encodings kept, their total size, hits and misses.
+        '''
+        with self.__lock:
+            return {'entries': len(self.__entries), 'bytes': self.__size, 'hits': self.hits, 'misses': self.misses}
+
+
+_default_attachment_cache = None
+
+
+def get_default_attachment_cache():
+    '''
+    Returns the PMAttachmentCache used when sending PMAttachment contents,
+    or None (the default) when they are streamed.
+    '''
+    return _default_attachment_cache
+
+
+def set_default_attachment_cache(cache):
+    '''
+    Replace the PMAttachmentCache used when sending PMAttachment contents.
+    Pass None to always stream them.
+    '''
+    global _default_attachment_cache
+    _default_attachment_cache = cache
+
+
+# Stands for PMAttachment contents in the JSON encoding of a message, until
+# they are spliced into its body.
+_attachment_marker = 'pm-attachment-' + os.urandom(8).hex()
+
+
+def _encode_json_message(json_message):
+    '''
+    Returns the JSON encoding of a message from to_json_message(): bytes, or
+    a PMJSONBody when PMAttachment contents are spliced into it.
+    '''
+    attachments = json_message.get('Attachments')
+    if not attachments or not any(isinstance(item.get('Content'), PMAttachment) for item in attachments):
+        return get_serializer().dumps(json_message)
+
+    streamed = []
+    placeholders = []
+    for item in attachments:
+        if isinstance(item.get('Content'), PMAttachment):
+            streamed.append(item['Content'])
+            item = dict(item, Content=_attachment_marker)
+        placeholders.append(item)
+    encoded = get_serializer().dumps(dict(json_message, Attachments=placeholders))
+
+    parts = encoded.split(_attachment_marker.encode('ascii'))
+    pieces = [parts[0]]
+    for attachment, part in zip(streamed, parts[1:]):
+        pieces.append(attachment)
+        pieces.append(part)
+    return PMJSONBody(pieces)
+
+
+class PMBatchResult(object):
+    '''
+    The per-message outcome of a PMBatchMail send, in the same order as the
+    batch's messages, across every chunk sent.
+
+    Outcomes are stored column-wise (message_ids, error_codes and
+    error_messages) rather than as one dict per message, so results of very
+    large batches stay compact. Indexing returns a dict shaped like Postmark's
+    response for that message. When a whole chunk is rejected, each of its
+    messages gets the Postmark error code (406 for inactive recipients, the
+    HTTP status otherwise) and no message ID.
+    '''
+
+    def __init__(self):
+        self.message_ids = []
+        self.error_codes = array('l')
+        self.error_messages = []
+        # Number of messages of chunks rejected as a whole
+        self.rejected = 0
+        # Response messages are almost always the same few strings ("OK"),
+        # keep a single copy of each.
+        self.__strings = {}
+
+    def _intern(self, value):
+        return self.__strings.setdefault(value, value)
+
+    def add(self, results):
+        '''
+        Append the parsed per-message results of one chunk.
+        '''
+        for res in results:
+            self.message_ids.append(res.get('MessageID'))
+            self.error_codes.append(res.get('ErrorCode') or 0)
+            self.error_messages.append(self._intern(res.get('Message')))
+
+    def add_error(self, count, error_code, message):
+        '''
+        Record that `count` messages were rejected as a whole.
+        '''
+        self.message_ids.extend([None] * count)
+        self.error_codes.extend([error_code] * count)
+        self.error_messages.extend([self._intern(message)] * count)
+        self.rejected += count
 
+    @property
+    def failed(self):
+        '''
+        Indexes of the messages Postmark did not accept.
+        '''
+        return [i for i, code in enumerate(self.error_codes) if code]
+
+    @property
+    def sent(self):
+        '''
+        Number of messages Postmark accepted.
+        '''
+        return len(self.error_codes) - len(self.failed)
+
+    def __len__(self):
+        return len(self.error_codes)
 
-# Simple utility that returns a generator to chunk up a list into equal parts
-def _chunks(l, n):
-    return (l[i:i + n] for i in range(0, len(l), n))
+    def __getitem__(self, index):
+        return {
+            'MessageID': self.message_ids[index],
+            'ErrorCode': self.error_codes[index],
+            'Message': self.error_messages[index],
+        }
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
 
 
 class PMBatchMail(object):
     # Maximum number of messages to be sent at once.
     # Ref: http://developer.postmarkapp.com/developer-build.html#batching-messages
     MAX_MESSAGES = 500
+    # Maximum size of one batch request, and of a single message in it.
+    # Ref: https://postmarkapp.com/developer/user-guide/send-email-with-api/batch-emails
+    MAX_BATCH_SIZE = 50 * 1024 * 1024
+    MAX_MESSAGE_SIZE = 10 * 1024 * 1024
+
+    # Transport used when none is passed in
+    _get_default_transport = staticmethod(get_default_transport)
 
     def __init__(self, **kwargs):
         self.__api_key = None
         self.__messages = []
         self.__template = False
+        self.__transport = None
+        self.__timeout = None
+        self.__result = None
 
         acceptable_keys = (
             'api_key',
-            'messages'
+            'messages',
+            'transport',
+            'timeout'
         )
 
         for key in kwargs:
             if key in acceptable_keys:
                 setattr(self, '_PMBatchMail__%s' % key, kwargs[key])
-
-        # Set up the user-agent
-        self.__user_agent = 'Python/%s (python-postmark library version %s)' % ('_'.join([str(var) for var in sys.version_info]), __version__)
+        self.__timeout = _coerce_timeout(self.__timeout)
 
         # Try to pull in the API key from Django
-        try:
-            from django import VERSION
-            from django.conf import settings as django_settings
-            self.__user_agent = '%s (Django %s)' % (self.__user_agent, '_'.join([str(var) for var in VERSION]))
-            if not self.__api_key and hasattr(django_settings, 'POSTMARK_API_KEY'):
-                self.__api_key = django_settings.POSTMARK_API_KEY
-        except ImportError:
-            pass
+        if not self.__api_key:
+            self.__api_key = get_config().setting('POSTMARK_API_KEY', self.__api_key)
 
     api_key = property(
         lambda self: self.__api_key,
@@ -667,6 +2301,32 @@ class PMBatchMail(object):
         '''
     )
 
+    transport = property(
+        lambda self: self.__transport or self._get_default_transport(),
+        lambda self, value: setattr(self, '_PMBatchMail__transport', value),
+        lambda self: setattr(self, '_PMBatchMail__transport', None),
+        '''
+        The PMTransport used to send the batch
+        '''
+    )
+
+    timeout = property(
+        lambda self: self.__timeout or _default_timeout,
+        lambda self, value: setattr(self, '_PMBatchMail__timeout', _coerce_timeout(value)),
+        lambda self: setattr(self, '_PMBatchMail__timeout', None),
+        '''
+        The PMTimeout limiting requests sending the batch. Its deadline
+        bounds a whole send(), every chunk included.
+        '''
+    )
+
+    result = property(
+        lambda self: self.__result,
+        doc='''
+        The PMBatchResult of the last send()
+        '''
+    )
+
     def add_message(self, message):
         '''
         Add a message to the batch
@@ -685,118 +2345,627 @@ class PMBatchMail(object):
         Make sure all values are of the appropriate
         type and are not missing.
         '''
-        for message in self.__messages:
+        errors, warnings = self.validate()
+        for warning in warnings:
+            print('WARNING: %s' % warning)
+        if errors:
+            raise PMMailBatchValidationException(errors)
+
+    def validate(self):
+        '''
+        Check every message of the batch in one pass, without raising.
+        Returns (errors, warnings): errors is a list of (index, reason) for
+        each message that cannot be sent, warnings a list of messages about
+        the batch as a whole.
+        '''
+        errors = []
+        no_html = 0
+        template = self.__template
+        for index, message in enumerate(self.__messages):
+            error, uses_template, tracks_without_html = message._batch_check()
             # Check list of messages to see if sending using templates
-            if not self.__template and (message.template_id or message.template_model):
-                self.__template = True
+            template = template or uses_template
+            if error is not None:
+                errors.append((index, error))
+            elif tracks_without_html:
+                no_html += 1
+        self.__template = template
+
+        warnings = []
+        if no_html:
+            warnings.append('.track_opens set to True with no .html_body set on %d message(s). '
+                            'Tracking opens will not work; messages will still send.' % no_html)
+        return errors, warnings
+
+    def _encode_chunk(self, encoded_messages, template):
+        '''
+        Assemble the JSON body of one chunk from the already encoded
+        messages, without serializing or copying them again.
+        '''
+        pieces = [b'{"Messages": [' if template else b'[']
+        for encoded in encoded_messages:
+            pieces.append(encoded)
+            pieces.append(b', ')
+        if encoded_messages:
+            pieces.pop()
+        pieces.append(b']}' if template else b']')
+        return PMJSONBody(pieces)
+
+    def _build_request(self, payload, template):
+        '''
+        Build the urllib Request sending one chunk of messages to Postmark.
+        '''
+        if not template:
+            endpoint_url = __POSTMARK_URL__ + 'email/batch'
+        else:
+            endpoint_url = __POSTMARK_URL__ + 'email/batchWithTemplates'
 
-            message._check_values()
+        return Request(
+            endpoint_url,
+            payload,
+            {
+                'Accept': 'application/json',
+                'Content-Type': 'application/json',
+                'Content-Length': str(len(payload)),
+                'X-Postmark-Server-Token': self.__api_key,
+                'User-agent': get_config().user_agent
+            }
+        )
 
-    def send(self, test=None, return_json=None):
-        # Has one of the messages caused an inactive recipient error?
-        inactive_recipient = False
+    def _handle_result(self, result, messages):
+        '''
+        Process the response to one chunk of messages returned by the
+        transport. Returns the parsed per-message results.
+        '''
+        jsontxt = result.read().decode()
+        result.close()
+        if result.code == 200:
+            results = get_serializer().loads(jsontxt)
+            for message, res in zip(messages, results):
+                if isinstance(message, PMMail):
+                    message.message_id = res.get("MessageID", None)
+            return results
+        else:
+            raise PMMailSendException('Return code %d: %s' % (result.code, result.msg))
 
-        # Check messages for completeness prior to attempting to send
-        self._check_values()
+    def send(self, test=None, return_json=None, concurrency=None, retry=None, rate_limiter=None, timeout=None):
+        '''
+        Send the messages through the Postmark batch API.
+        Pass test=True to just print out the resulting
+        JSON messages being sent to Postmark
 
-        # If test is not specified, attempt to read the Django setting
-        if test is None:
-            try:
-                from django.conf import settings as django_settings
-                test = getattr(django_settings, "POSTMARK_TEST_MODE", None)
-            except ImportError:
-                pass
+        Every chunk of MAX_MESSAGES messages is sent, and the per-message
+        outcome of the whole batch is available as .result afterwards. When
+        an exception stops the batch, .result holds the outcome of the chunks
+        sent before it. Returns False (unless returning JSON) when a chunk was
+        rejected as a whole, e.g. while Postmark was unavailable.
 
-        """
         Args:
             return_json (bool | None):
                 True  -> return parsed JSON
                 False -> return True/False
                 None  -> fallback to settings.POSTMARK_RETURN_JSON (default False)
-        """
+            concurrency (int | None):
+                Number of chunks of MAX_MESSAGES messages posted in parallel
+                over a thread pool. Defaults to sending chunks one at a time.
+            retry (PMRetryPolicy | None):
+                Retry transient failures according to this policy. A chunk
+                that failed as a whole is sent again; when only some of its
+                messages failed with one of the policy's retry_error_codes,
+                only those messages are.
+            rate_limiter (PMRateLimiter | None):
+                Wait for this rate limiter before each request, counting
+                every message it carries. Defaults to
+                get_default_rate_limiter().
+            timeout (PMTimeout | float | None):
+                Time limits of this call. Defaults to .timeout. Once its
+                deadline has passed, the chunks not sent yet are not.
+        '''
+        return_json = self._prepare_send(return_json)
+        batch_result = PMBatchResult()
+        json_results = [] if return_json else None
+        rate_limiter = rate_limiter or _default_rate_limiter
+        timeout = _coerce_timeout(timeout) or self.timeout
+        deadline = timeout and timeout.start()
 
-        if return_json is None:
-            try:
-                from django.conf import settings as django_settings
-                return_json = getattr(django_settings, "POSTMARK_RETURN_JSON", False)
-            except ImportError:
-                return_json = False
-
-        # Split up into groups of 500 messages for sending
-        for messages in _chunks(self.messages, PMBatchMail.MAX_MESSAGES):
-            json_message = []
-            for message in messages:
-                json_message.append(message.to_json_message())
-
-            if not self.__template:
-                endpoint_url = __POSTMARK_URL__ + 'email/batch'
-                payload = json.dumps(json_message, cls=PMJSONEncoder).encode('utf8')
+        try:
+            if concurrency and concurrency > 1:
+                inactive_recipient = self._send_concurrently(test, concurrency, retry, rate_limiter, batch_result,
+                                                             json_results, timeout, deadline)
+            else:
+                # Has one of the messages caused an inactive recipient error?
+                inactive_recipient = False
+                for chunk in self._chunk_requests(test):
+                    outcome = self._dispatch(chunk, retry, rate_limiter, timeout, deadline)
+                    inactive_recipient = self._collect(outcome, batch_result, json_results) or inactive_recipient
+        finally:
+            # The outcome of the chunks sent before an error stopped the batch
+            self._store_result(batch_result)
+
+        return self._finish(batch_result, json_results, inactive_recipient)
+
+    def _dispatch(self, chunk, retry=None, rate_limiter=None, timeout=None, deadline=None):
+        '''
+        Post one chunk from _chunk_requests(). Returns (chunk, results, error)
+        so errors raised on a worker thread are handled by the calling thread.
+        '''
+        messages, req = chunk[:2]
+        if req is None:
+            # Every message of the chunk was rejected before sending
+            return chunk, [], None
+        try:
+            results = self._handle_result(_open_request(self.transport, req, retry, rate_limiter, len(messages),
+                                                        timeout, deadline), messages)
+        except URLError as err:
+            return chunk, None, err
+
+        if retry is not None:
+            attempt = 1
+            failed = retry.failed_indexes(results)
+            while failed and attempt < retry.max_attempts:
+                delay = retry.delay(attempt)
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    break
+                retry.sleep(delay)
+                attempt += 1
+                try:
+                    retried = self._handle_result(_open_request(self.transport, self._retry_request(chunk, failed),
+                                                                rate_limiter=rate_limiter, messages=len(failed),
+                                                                timeout=timeout, deadline=deadline),
+                                                  [messages[i] for i in failed])
+                except URLError:
+                    break
+                failed = self._merge_retried(results, failed, retried, retry)
+        return chunk, results, None
+
+    def _retry_request(self, chunk, failed):
+        '''
+        Build the request sending again the messages of a chunk at the
+        `failed` indexes, from their already encoded JSON.
+        '''
+        messages, req, encoded_messages, template = chunk[:4]
+        payload = self._encode_chunk([encoded_messages[i] for i in failed], template)
+        return self._build_request(payload, template)
+
+    def _merge_retried(self, results, failed, retried, retry):
+        '''
+        Put the results of retried messages back at their index in the
+        chunk's results. Returns the indexes still to retry.
+        '''
+        for i, res in zip(failed, retried):
+            results[i] = res
+        return [failed[i] for i in retry.failed_indexes(retried)]
+
+    def _collect(self, outcome, batch_result, json_results):
+        '''
+        Record the (chunk, results, error) outcome of one chunk in
+        batch_result, the results of its messages rejected before sending
+        merged in at their position, raising the matching exception for
+        errors that stop the batch. Returns True if the chunk was rejected
+        because of an inactive recipient.
+        '''
+        chunk, results, err = outcome
+        messages, rejected = chunk[0], chunk[4]
+        inactive_recipient = False
+        if err is None:
+            def record(start, stop):
+                batch_result.add(results[start:stop])
+                if json_results is not None:
+                    json_results.extend(results[start:stop])
+        else:
+            # One of the message recipients was inactive. Postmark still sends the
+            # rest of the messages that have active recipients. Continue sending
+            # the rest of the chunks.
+            inactive_recipient = _raise_send_exception(err, inactive_recipient=False)
+            if inactive_recipient:
+                error_code, message = 406, 'You tried to send email to a recipient that has been marked as inactive.'
             else:
-                endpoint_url = __POSTMARK_URL__ + 'email/batchWithTemplates'
-                payload = json.dumps({'Messages': json_message}, cls=PMJSONEncoder).encode('utf8')
-
-            req = Request(
-                endpoint_url,
-                payload,
-                {
-                    'Accept': 'application/json',
-                    'Content-Type': 'application/json',
-                    'X-Postmark-Server-Token': self.__api_key,
-                    'User-agent': self.__user_agent
-                }
-            )
+                error_code, message = getattr(err, 'code', None) or -1, str(err)
+
+            def record(start, stop):
+                if stop > start:
+                    batch_result.add_error(stop - start, error_code, message)
+
+        start = 0
+        for sent_before, result in rejected:
+            record(start, sent_before)
+            start = sent_before
+            batch_result.add([result])
+            if json_results is not None:
+                json_results.append(result)
+        record(start, len(messages))
+        return inactive_recipient
+
+    def _store_result(self, batch_result):
+        self.__result = batch_result
+
+    def _finish(self, batch_result, json_results, inactive_recipient):
+        '''
+        Store the result of a send and build its return value: False when a
+        chunk was rejected as a whole.
+        '''
+        self._store_result(batch_result)
+
+        if inactive_recipient:
+            raise PMMailInactiveRecipientException('You tried to send email to a recipient that has been marked as inactive.')
+
+        if json_results is not None:
+            return json_results
+        return not batch_result.rejected
+
+    def _send_concurrently(self, test, concurrency, retry, rate_limiter, batch_result, json_results,
+                           timeout=None, deadline=None):
+        '''
+        Post the chunks over a pool of `concurrency` threads. At most
+        `concurrency` chunks are built and in flight at any time, and the
+        responses are processed in chunk order.
+        '''
+        inactive_recipient = False
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            try:
+                for chunk in self._chunk_requests(test):
+                    pending.append(executor.submit(self._dispatch, chunk, retry, rate_limiter, timeout, deadline))
+                    if len(pending) >= concurrency:
+                        outcome = pending.popleft().result()
+                        inactive_recipient = self._collect(outcome, batch_result, json_results) or inactive_recipient
+                while pending:
+                    outcome = pending.popleft().result()
+                    inactive_recipient = self._collect(outcome, batch_result, json_results) or inactive_recipient
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+        return inactive_recipient
+
+    def _prepare_send(self, return_json):
+        '''
+        Validate the messages prior to send() and resolve return_json.
+        '''
+        # Check messages for completeness prior to attempting to send
+        self._check_values()
+
+        if return_json is None:
+            return_json = _django_setting('POSTMARK_RETURN_JSON', False)
+        return return_json
+
+    def _chunk_requests(self, test):
+        '''
+        Generator yielding (messages, request, encoded_messages, template,
+        rejected) for each chunk of the batch, with rejected as yielded by
+        _pack_chunks(). The request is None when every message of the chunk
+        was rejected. In test mode the chunks are printed instead and nothing
+        is yielded.
+        '''
+        # If test is not specified, attempt to read the Django setting
+        if test is None:
+            test = _django_setting('POSTMARK_TEST_MODE', None)
 
+        for messages, encoded_messages, rejected in self._pack_chunks(self.messages):
             # If this is a test, just print the message
             if test:
-                print('JSON message is:\n%s' % json.dumps(json_message, cls=PMJSONEncoder))
+                for sent_before, result in rejected:
+                    print('Message not sent: %s' % result['Message'])
+                if messages:
+                    payload = self._encode_chunk(encoded_messages, self._is_template_chunk(messages))
+                    print('JSON message is:\n%s' % bytes(payload).decode('utf8'))
                 continue
 
-            # Attempt send
-            try:
-                result = urlopen(req)
-                jsontxt = result.read().decode()
-                result.close()
-                if result.code == 200:
-                    results = json.loads(jsontxt)
-                    for i, res in enumerate(results):
-                        self.__messages[i].message_id = res.get("MessageID", None)
-                    return results if return_json else True
-                else:
-                    raise PMMailSendException('Return code %d: %s' % (result.code, result.msg))
-            except HTTPError as err:
-                if err.code == 401:
-                    raise PMMailUnauthorizedException('Sending Unauthorized - incorrect API key.', err)
-                elif err.code == 422:
-                    try:
-                        jsontxt = err.read().decode()
-                        jsonobj = json.loads(jsontxt)
-                        desc = jsonobj['Message']
-                        error_code = jsonobj['ErrorCode']
-                    except KeyError:
-                        raise PMMailUnprocessableEntityException('Unprocessable Entity: Description not given')
-
-                    if error_code == 406:
-                        # One of the message recipients was inactive. Postmark still sends the
-                        # rest of the messages that have active recipients. Continue sending
-                        # the rest of the chunks.
-                        inactive_recipient = True
-                        continue
-
-                    raise PMMailUnprocessableEntityException('Unprocessable Entity: %s' % desc)
-                elif err.code == 500:
-                    raise PMMailServerErrorException('Internal server error at Postmark. Admins have been alerted.', err)
-            except URLError as err:
-                if hasattr(err, 'reason'):
-                    raise PMMailURLException('URLError: Failed to reach the server: %s (See "inner_exception" for details)' % err.reason, err)
-                elif hasattr(err, 'code'):
-                    raise PMMailURLException('URLError: %d: The server couldn\'t fufill the request. (See "inner_exception" for details)' % err.code, err)
-                else:
-                    raise PMMailURLException('URLError: The server couldn\'t fufill the request. (See "inner_exception" for details)', err)
+            if not messages:
+                yield messages, None, encoded_messages, False, rejected
+                continue
+            template = self._is_template_chunk(messages)
+            payload = self._encode_chunk(encoded_messages, template)
+            yield messages, self._build_request(payload, template), encoded_messages, template, rejected
 
-        if inactive_recipient:
-            raise PMMailInactiveRecipientException('You tried to send email to a recipient that has been marked as inactive.')
+    def _is_template_chunk(self, messages):
+        '''
+        Whether a chunk goes to the batchWithTemplates endpoint.
+        '''
+        return self.__template
+
+    def _message_error(self, message):
+        '''
+        Returns why a message cannot be sent, or None. Messages of a
+        PMBatchMail are all validated before sending.
+        '''
+        return None
+
+    def _encode_message(self, message):
+        '''
+        Returns the JSON encoding of one message, as bytes or as a
+        PMJSONBody streaming its PMAttachment contents.
+        '''
+        return message._encode()
+
+    def _pack_chunks(self, messages):
+        '''
+        Generator splitting messages into chunks of at most MAX_MESSAGES
+        messages and MAX_BATCH_SIZE bytes. Yields (messages, encoded_messages,
+        rejected) where encoded_messages holds the JSON encoding of each
+        message, measured once and reused to build the request body.
+
+        A message _message_error() rejects, or larger than MAX_MESSAGE_SIZE,
+        which Postmark would reject along with the rest of its request, is not
+        sent. rejected holds a (sent_before, result) pair for each such
+        message: the number of messages of the chunk before it and its
+        result, with error code 300.
+        '''
+        # Room for the surrounding brackets / {"Messages": ...} wrapper
+        limit = self.MAX_BATCH_SIZE - 16
+        chunk, encoded_chunk, rejected, size = [], [], [], 0
+
+        for message in messages:
+            error = self._message_error(message)
+            if error is None:
+                encoded = self._encode_message(message)
+                if len(encoded) > self.MAX_MESSAGE_SIZE:
+                    error = 'Message of %d bytes is larger than the %d bytes limit' % (
+                        len(encoded), self.MAX_MESSAGE_SIZE)
+            if error is not None:
+                # 300 is Postmark's "Invalid email request" error code
+                rejected.append((len(chunk), {'ErrorCode': 300, 'Message': error}))
+                if len(rejected) >= self.MAX_MESSAGES:
+                    yield chunk, encoded_chunk, rejected
+                    chunk, encoded_chunk, rejected, size = [], [], [], 0
+                continue
+
+            # Each message after the first is preceded by a ", " separator
+            added = len(encoded) + (2 if chunk else 0)
+
+            if chunk and (len(chunk) >= self.MAX_MESSAGES or size + added > limit):
+                yield chunk, encoded_chunk, rejected
+                chunk, encoded_chunk, rejected, size = [], [], [], 0
+                added = len(encoded)
+
+            chunk.append(message)
+            encoded_chunk.append(encoded)
+            size += added
+
+        if chunk or rejected:
+            yield chunk, encoded_chunk, rejected
+
+
+class PMStreamingBatchMail(PMBatchMail):
+    '''
+    A PMBatchMail sending messages pulled from any iterable, such as a
+    generator, instead of a list.
+
+    Messages can be PMMail objects or dicts already in the Postmark API
+    format (as returned by PMMail.to_json_message()). They are validated and
+    serialized as they are pulled, and each chunk is dropped once sent, so
+    only one chunk (or `concurrency` chunks) is held in memory whatever the
+    size of the campaign. Message IDs are set on PMMail objects and are
+    available for every message in .result.
+
+    Since earlier chunks may already be sent when an invalid message is
+    pulled, invalid messages do not raise: they are skipped and recorded in
+    .result with error code 300 (Postmark's "Invalid email request") and the
+    reason they cannot be sent, and the rest of the messages are sent.
+
+    A generator can only be sent once.
+    '''
+
+    def add_message(self, message):
+        raise TypeError('Messages of a PMStreamingBatchMail come from its messages iterable')
+
+    def remove_message(self, message):
+        raise TypeError('Messages of a PMStreamingBatchMail come from its messages iterable')
+
+    def _check_values(self):
+        '''
+        Messages are validated as they are pulled from the iterable.
+        '''
+        pass
+
+    def validate(self):
+        raise TypeError('Messages of a PMStreamingBatchMail are validated as they are pulled from its messages iterable')
+
+    @staticmethod
+    def _message_error(message):
+        '''
+        Returns why a PMMail or API format dict cannot be sent, or None.
+        '''
+        if not isinstance(message, dict):
+            return message._validation_error()
+        if not message.get('From'):
+            return 'Cannot send an e-mail without a sender (From field)'
+        if not message.get('To') and not message.get('Bcc'):
+            return 'Cannot send an e-mail without at least one recipient (To field or Bcc field)'
+        for field in ('To', 'Cc', 'Bcc', 'ReplyTo'):
+            error = _address_error(field, message.get(field))
+            if error is not None:
+                return error
+        if 'TemplateId' in message or 'TemplateAlias' in message:
+            if 'TemplateModel' not in message:
+                return 'Cannot send a template e-mail without a TemplateModel'
+            return None
+        if not message.get('Subject'):
+            return 'Cannot send an e-mail without a subject'
+        if not message.get('HtmlBody') and not message.get('TextBody'):
+            return 'Cannot send an e-mail without either an HTML or text version of your e-mail body'
+        return None
+
+    @staticmethod
+    def _tracks_opens_without_html(message):
+        if isinstance(message, dict):
+            return bool(message.get('TrackOpens')) and not message.get('HtmlBody')
+        return message._tracks_opens_without_html()
+
+    def _chunk_requests(self, test):
+        '''
+        Generator yielding the chunks of PMBatchMail._chunk_requests(),
+        printing the track_opens warning once for each.
+        '''
+        for chunk in super(PMStreamingBatchMail, self)._chunk_requests(test):
+            no_html = sum(1 for message in chunk[0] if self._tracks_opens_without_html(message))
+            if no_html:
+                print('WARNING: .track_opens set to True with no .html_body set on %d message(s). '
+                      'Tracking opens will not work; messages will still send.' % no_html)
+            yield chunk
+
+    def _is_template_chunk(self, messages):
+        if self.template:
+            return True
+        for message in messages:
+            if isinstance(message, dict):
+                if 'TemplateId' in message or 'TemplateAlias' in message:
+                    return True
+            elif message.template_id or message.template_alias:
+                return True
+        return False
+
+    def _encode_message(self, message):
+        if isinstance(message, dict):
+            return _encode_json_message(message)
+        return super(PMStreamingBatchMail, self)._encode_message(message)
+
+
+class PMMergeBatchMail(PMBatchMail):
+    '''
+    A PMBatchMail for mail merges: the fields every message shares (sender,
+    subject, bodies, tag, template...) are given once as a PMMail, and the
+    fields that vary as columns holding one value per message.
+
+        batch = PMMergeBatchMail(
+            shared=PMMail(sender='news@example.com', template_id=1234, template_model={}),
+            to=addresses, template_model=models)
+        batch.send()
+
+    The shared fields are validated and encoded once. Each message is sent
+    as its own column values followed by the shared fragment, which is
+    referenced rather than copied into each message of the request body.
+    .result holds the outcome of each message in column order.
+
+    Keyword arguments are:
+    shared:         A PMMail holding the fields common to every message. Its
+                    api_key is used when api_key is not given.
+    to, cc, bcc, template_model, metadata:
+                    Sequences (lists, tuples, arrays...) of equal length giving
+                    the value of that field for each message. They override
+                    the value of the shared PMMail. A value of None leaves the
+                    field out of that message.
+    api_key, transport, timeout:
+                    As for PMBatchMail.
+    '''
+
+    # Per-message fields: (keyword argument, Postmark API name)
+    COLUMNS = (
+        ('to', 'To'),
+        ('cc', 'Cc'),
+        ('bcc', 'Bcc'),
+        ('template_model', 'TemplateModel'),
+        ('metadata', 'Metadata'),
+    )
 
-        return True
+    def __init__(self, **kwargs):
+        self.__shared = kwargs.pop('shared', None)
+        self.__columns = []
+        for field, name in self.COLUMNS:
+            column = kwargs.pop(field, None)
+            if column is not None:
+                self.__columns.append((field, name, column))
+        if self.__shared is None:
+            raise PMMailMissingValueException('A PMMergeBatchMail needs the shared fields of its messages (.shared)')
+        if not kwargs.get('api_key'):
+            kwargs['api_key'] = self.__shared.api_key
+
+        lengths = set(len(column) for field, name, column in self.__columns)
+        if len(lengths) > 1:
+            raise ValueError('The columns of a PMMergeBatchMail must all have the same length')
+        self.__count = lengths.pop() if lengths else 0
+        self.__fragment = None
+
+        super(PMMergeBatchMail, self).__init__(**kwargs)
+        self.messages = range(self.__count)
+        self.template = bool(self.__shared.template_id or self.__shared.template_alias)
+
+    def add_message(self, message):
+        raise TypeError('Messages of a PMMergeBatchMail come from its columns')
+
+    def remove_message(self, message):
+        raise TypeError('Messages of a PMMergeBatchMail come from its columns')
+
+    def validate(self):
+        '''
+        Validate the shared fields once, with the values of the first
+        message filled in, then only check that every message has a
+        recipient and, for templates, a model.
+        '''
+        if not self.__count:
+            return [], []
+        probe = copy.copy(self.__shared)
+        probe.api_key = self.api_key
+        for field, name, column in self.__columns:
+            setattr(probe, field, column[0])
+        error = probe._validation_error()
+        if error is not None:
+            # Every message shares the problem
+            return [(index, error) for index in range(self.__count)], []
+        warnings = []
+        if probe._tracks_opens_without_html():
+            warnings.append('.track_opens set to True with no .html_body set. '
+                            'Tracking opens will not work; messages will still send.')
+
+        errors = []
+        columns = dict((field, column) for field, name, column in self.__columns)
+        if 'to' in columns or 'bcc' in columns:
+            to = columns.get('to') or (None,) * self.__count
+            bcc = columns.get('bcc') or (None,) * self.__count
+            for index in range(self.__count):
+                if not to[index] and not bcc[index]:
+                    errors.append((index, 'Cannot send an e-mail without at least one recipient (to or bcc)'))
+        for field in ('to', 'cc', 'bcc'):
+            for index, value in enumerate(columns.get(field, ())):
+                error = _address_error(field, value)
+                if error is not None:
+                    errors.append((index, error))
+        if self.template and 'template_model' in columns:
+            for index, model in enumerate(columns['template_model']):
+                if not model:
+                    errors.append((index, 'Cannot send a template e-mail without a template_model'))
+        errors.sort()
+        return errors, warnings
+
+    def _shared_fragment(self):
+        '''
+        The encoded shared fields, without the ones given as columns,
+        followed by the closing brace of a message.
+        '''
+        if self.__fragment is None:
+            json_message = self.__shared.to_json_message()
+            for field, name, column in self.__columns:
+                json_message.pop(name, None)
+            encoded = get_serializer().dumps(json_message)
+            self.__fragment = encoded[1:]
+        return self.__fragment
+
+    def _encode_message(self, index):
+        row = {}
+        for field, name, column in self.__columns:
+            value = column[index]
+            if value is not None:
+                row[name] = _recipient_field(value) if field in ('to', 'cc', 'bcc') else value
+        fragment = self._shared_fragment()
+        if not row:
+            prefix = b'{'
+        elif fragment == b'}':
+            return PMJSONBody([get_serializer().dumps(row)])
+        else:
+            prefix = get_serializer().dumps(row)[:-1] + b', '
+        return PMJSONBody([prefix, fragment], len(prefix) + len(fragment))
+
+    def _encode_chunk(self, encoded_messages, template):
+        pieces = [b'{"Messages": [' if template else b'[']
+        for encoded in encoded_messages:
+            pieces.extend(encoded)
+            pieces.append(b', ')
+        if encoded_messages:
+            pieces.pop()
+        pieces.append(b']}' if template else b']')
+        return PMJSONBody(pieces)
 
 
 class PMBounceManager(object):
@@ -804,34 +2973,39 @@ class PMBounceManager(object):
     The Postmark Bounce object.
     '''
 
+    # Transport used when none is passed in
+    _get_default_transport = staticmethod(get_default_transport)
+
     def __init__(self, **kwargs):
         '''
         Keyword arguments are:
         api_key:        Your Postmark server API key
+        transport:      A PMTransport used to talk to Postmark. Defaults to the shared pooled transport.
+        retry:          A PMRetryPolicy applied to every bounce API call.
+        timeout:        A PMTimeout, or a number of seconds, limiting every bounce API call.
+                        Defaults to get_default_timeout().
         '''
         # initialize properties
         self.__api_key = None
+        self.__transport = None
+        self.__retry = None
+        self.__timeout = None
 
         acceptable_keys = (
             'api_key',
+            'transport',
+            'retry',
+            'timeout',
         )
 
         for key in kwargs:
             if key in acceptable_keys:
                 setattr(self, '_PMBounceManager__%s' % key, kwargs[key])
-
-        # Set up the user-agent
-        self.__user_agent = 'Python/%s (python-postmark library version %s)' % ('_'.join([str(var) for var in sys.version_info]), __version__)
+        self.__timeout = _coerce_timeout(self.__timeout)
 
         # Try to pull in the API key from Django
-        try:
-            from django import VERSION
-            from django.conf import settings as django_settings
-            if not self.__api_key and hasattr(django_settings, 'POSTMARK_API_KEY'):
-                self.__api_key = django_settings.POSTMARK_API_KEY
-            self.__user_agent = '%s (Django %s)' % (self.__user_agent, '_'.join([str(var) for var in VERSION]))
-        except ImportError:
-            pass
+        if not self.__api_key:
+            self.__api_key = get_config().setting('POSTMARK_API_KEY', self.__api_key)
 
     def _check_values(self):
         '''
@@ -850,35 +3024,81 @@ class PMBounceManager(object):
         '''
     )
 
-    def delivery_stats(self):
+    transport = property(
+        lambda self: self.__transport or self._get_default_transport(),
+        lambda self, value: setattr(self, '_PMBounceManager__transport', value),
+        lambda self: setattr(self, '_PMBounceManager__transport', None),
         '''
-        Returns a summary of inactive emails and bounces by type.
+        The PMTransport used to talk to the bounce API
         '''
-        self._check_values()
+    )
+
+    retry = property(
+        lambda self: self.__retry,
+        lambda self, value: setattr(self, '_PMBounceManager__retry', value),
+        lambda self: setattr(self, '_PMBounceManager__retry', None),
+        '''
+        The PMRetryPolicy applied to bounce API calls
+        '''
+    )
+
+    timeout = property(
+        lambda self: self.__timeout or _default_timeout,
+        lambda self, value: setattr(self, '_PMBounceManager__timeout', _coerce_timeout(value)),
+        lambda self: setattr(self, '_PMBounceManager__timeout', None),
+        '''
+        The PMTimeout limiting bounce API calls
+        '''
+    )
 
-        req = Request(
-            __POSTMARK_URL__ + 'deliverystats',
-            None,
+    def _build_request(self, path, data=None, method=None):
+        '''
+        Build the urllib Request for a bounce API call.
+        '''
+        return Request(
+            __POSTMARK_URL__ + path,
+            data,
             {
                 'Accept': 'application/json',
                 'Content-Type': 'application/json',
                 'X-Postmark-Server-Token': self.__api_key,
-                'User-agent': self.__user_agent
-            }
+                'User-agent': get_config().user_agent
+            },
+            method=method
         )
 
-        # Attempt send
+    def _open(self, req):
+        '''
+        Send a request built by _build_request and return the parsed JSON
+        response, or the HTTPError if Postmark answered with an error.
+        '''
         try:
             # print 'sending request to postmark:'
-            result = urlopen(req)
-            with closing(result):
-                if result.code == 200:
-                    return json.loads(result.read())
-                else:
-                    raise PMMailSendException('Return code %d: %s' % (result.code, result.msg))
-
+            timeout = self.timeout
+            result = _open_request(self.transport, req, self.__retry, timeout=timeout,
+                                   deadline=timeout and timeout.start())
         except HTTPError as err:
             return err
+        return self._parse_result(result)
+
+    @staticmethod
+    def _parse_result(result):
+        '''
+        Parse the JSON body of a bounce API response.
+        '''
+        with closing(result):
+            if result.code == 200:
+                return get_serializer().loads(result.read())
+            else:
+                raise PMMailSendException('Return code %d: %s' % (result.code, result.msg))
+
+    def delivery_stats(self):
+        '''
+        Returns a summary of inactive emails and bounces by type.
+        '''
+        self._check_values()
+
+        return self._open(self._build_request('deliverystats'))
 
     def get_all(self, inactive='', email_filter='', tag='', count=25, offset=0):
         '''
@@ -894,29 +3114,7 @@ class PMBounceManager(object):
         params = '?inactive=' + inactive + '&emailFilter=' + email_filter +'&tag=' + tag
         params += '&count=' + str(count) + '&offset=' + str(offset)
 
-        req = Request(
-            __POSTMARK_URL__ + 'bounces' + params,
-            None,
-            {
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
-                'X-Postmark-Server-Token': self.__api_key,
-                'User-agent': self.__user_agent
-            }
-        )
-
-        # Attempt send
-        try:
-            # print 'sending request to postmark:'
-            result = urlopen(req)
-            with closing(result):
-                if result.code == 200:
-                    return json.loads(result.read())
-                else:
-                    raise PMMailSendException('Return code %d: %s' % (result.code, result.msg))
-
-        except HTTPError as err:
-            return err
+        return self._open(self._build_request('bounces' + params))
 
     def get_single(self, bounce_id):
         '''
@@ -925,29 +3123,7 @@ class PMBounceManager(object):
         '''
         self._check_values()
 
-        req = Request(
-            __POSTMARK_URL__ + '/bounces/' + str(bounce_id),
-            None,
-            {
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
-                'X-Postmark-Server-Token': self.__api_key,
-                'User-agent': self.__user_agent
-            }
-        )
-
-        # Attempt send
-        try:
-            # print 'sending request to postmark:'
-            result = urlopen(req)
-            with closing(result):
-                if result.code == 200:
-                    return json.loads(result.read())
-                else:
-                    raise PMMailSendException('Return code %d: %s' % (result.code, result.msg))
-
-        except HTTPError as err:
-            return err
+        return self._open(self._build_request('bounces/' + str(bounce_id)))
 
     def get_dump(self, bounce_id):
         '''
@@ -956,32 +3132,7 @@ class PMBounceManager(object):
         '''
         self._check_values()
 
-        req_url = __POSTMARK_URL__ + '/bounces/' + str(bounce_id) + '/dump'
-        # print req_url
-
-        req = Request(
-            req_url,
-            None,
-            {
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
-                'X-Postmark-Server-Token': self.__api_key,
-                'User-agent': self.__user_agent
-            }
-        )
-
-        # Attempt send
-        try:
-            print('sending request to postmark:')
-            result = urlopen(req)
-            with closing(result):
-                if result.code == 200:
-                    return json.loads(result.read())
-                else:
-                    raise PMMailSendException('Return code %d: %s' % (result.code, result.msg))
-
-        except HTTPError as err:
-            return err
+        return self._open(self._build_request('bounces/' + str(bounce_id) + '/dump'))
 
     def get_tags(self):
         '''
@@ -989,52 +3140,16 @@ class PMBounceManager(object):
         '''
         self._check_values()
 
-        req = Request(
-            __POSTMARK_URL__ + 'bounces/tags',
-            None,
-            {
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
-                'X-Postmark-Server-Token': self.__api_key,
-                'User-agent': self.__user_agent
-            }
-        )
-
-        # Attempt send
-        try:
-            # print 'sending request to postmark:'
-            result = urlopen(req)
-            with closing(result):
-                if result.code == 200:
-                    return json.loads(result.read())
-                else:
-                    raise PMMailSendException('Return code %d: %s' % (result.code, result.msg))
-
-        except HTTPError as err:
-            return err
+        return self._open(self._build_request('bounces/tags'))
 
     def activate(self, bounce_id):
         '''
         Activates a deactivated bounce.
         '''
         self._check_values()
-        req_url = '/bounces/' + str(bounce_id) + '/activate'
-        # print req_url
-        h1 = HTTPConnection('api.postmarkapp.com')
+
         dta = urlencode({"data": "blank"}).encode('utf8')
-        h1.request(
-            'PUT',
-            req_url,
-            dta,
-            {
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
-                'X-Postmark-Server-Token': self.__api_key,
-                'User-agent': self.__user_agent
-            }
-        )
-        r = h1.getresponse()
-        return json.loads(r.read())
+        return self._open(self._build_request('bounces/' + str(bounce_id) + '/activate', dta, 'PUT'))
 
 
 #
@@ -1048,6 +3163,19 @@ class PMMailMissingValueException(Exception):
         return repr(self.parameter)
 
 
+class PMMailBatchValidationException(PMMailMissingValueException):
+    '''
+    Messages of a batch are missing required values. errors lists the
+    (index, reason) of each of them; nothing was sent.
+    '''
+
+    def __init__(self, errors):
+        index, reason = errors[0]
+        super(PMMailBatchValidationException, self).__init__(
+            '%d invalid message(s), first at index %d: %s' % (len(errors), index, reason))
+        self.errors = errors
+
+
 class PMMailSendException(Exception):
     '''
     Base Postmark send exception
@@ -1101,3 +3229,11 @@ class PMMailInactiveRecipientException(PMMailSendException):
     still sent.
     '''
     pass
+
+
+class PMMailCircuitOpenException(PMMailSendException):
+    '''
+    The request was not sent because the circuit breaker is open: Postmark
+    failed too many times in a row recently.
+    '''
+    pass
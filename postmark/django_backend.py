@@ -2,9 +2,19 @@ from django.conf import settings
 from django.core.mail.backends.base import BaseEmailBackend
 from django.core.exceptions import ImproperlyConfigured
 from django.core.mail import EmailMessage, EmailMultiAlternatives
-import base64
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
 
-from postmark.core import PMMail, PMBatchMail
+from postmark.async_core import AsyncPMBatchMail, AsyncPMMail
+from postmark.core import (
+    PMAttachment, PMMail, PMBatchMail, PMMailSendException, format_addresses, new_transport
+)
+
+logger = logging.getLogger('postmark.django_backend')
 
 
 class PMEmailMessage(EmailMessage):
@@ -56,9 +66,13 @@ class PMEmailMultiAlternatives(EmailMultiAlternatives):
 
 class EmailBackend(BaseEmailBackend):
 
-    def __init__(self, api_key=None, default_sender=None, **kwargs):
+    def __init__(self, api_key=None, default_sender=None, outbox=None, **kwargs):
         """
         Initialize the backend.
+
+        outbox is a postmark.outbox.PMOutbox, or the path of its database,
+        that messages are queued in instead of being sent right away.
+        Defaults to the POSTMARK_OUTBOX setting.
         """
         super(EmailBackend, self).__init__(**kwargs)
         self.api_key = api_key if api_key is not None else getattr(settings, 'POSTMARK_API_KEY', None)
@@ -67,6 +81,32 @@ class EmailBackend(BaseEmailBackend):
         self.default_sender = getattr(settings, 'POSTMARK_SENDER', default_sender)
         self.test_mode = getattr(settings, 'POSTMARK_TEST_MODE', False)
         self.return_message_id = getattr(settings, 'POSTMARK_RETURN_MESSAGE_ID', False)
+        # The transport opened by open(), None to use the shared default one
+        self.connection = None
+        self.outbox = outbox if outbox is not None else getattr(settings, 'POSTMARK_OUTBOX', None)
+        if isinstance(self.outbox, str):
+            from postmark.outbox import get_outbox
+            self.outbox = get_outbox(self.outbox, api_key=self.api_key,
+                                     start=getattr(settings, 'POSTMARK_OUTBOX_FLUSHER', True))
+
+    def open(self):
+        """
+        Open a pool of connections to Postmark used by every message sent
+        until close(), e.g. within a `with get_connection()` block. Returns
+        True if a new pool was opened.
+        """
+        if self.connection is not None:
+            return False
+        self.connection = new_transport()
+        return True
+
+    def close(self):
+        """
+        Close the connections opened by open().
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
     def send_messages(self, email_messages):
         """
@@ -76,21 +116,27 @@ class EmailBackend(BaseEmailBackend):
         if not email_messages:
             return
 
+        if self.outbox is not None and not self.test_mode:
+            return self._enqueue(email_messages)
+
         sent, instance = self._send(email_messages)
+        return self._sent_result(sent, instance, email_messages)
 
+    def _sent_result(self, sent, instance, email_messages):
+        """The return value of send_messages()."""
         if sent and self.return_message_id:
             return [m.message_id for m in instance.messages]
         elif sent:
             return len(email_messages)
         return 0
 
-    def _build_message(self, message):
+    def _build_message(self, message, mail_class=PMMail):
         """A helper method to convert a PMEmailMessage to a PMMail"""
         if not message.recipients():
             return False
-        recipients = ','.join(message.to)
-        recipients_cc = ','.join(message.cc)
-        recipients_bcc = ','.join(message.bcc)
+        recipients = format_addresses(message.to)
+        recipients_cc = format_addresses(message.cc)
+        recipients_bcc = format_addresses(message.bcc)
 
         text_body = message.body
         html_body = None
@@ -105,7 +151,7 @@ class EmailBackend(BaseEmailBackend):
             text_body = None
             html_body = message.body
 
-        reply_to = ','.join(message.reply_to)
+        reply_to = format_addresses(message.reply_to)
         custom_headers = {}
         if message.extra_headers and isinstance(message.extra_headers, dict):
             if 'Reply-To' in message.extra_headers:
@@ -120,18 +166,13 @@ class EmailBackend(BaseEmailBackend):
                         (f, content, m) = item
                         if isinstance(content, str):
                             content = content.encode()
-                        content = base64.b64encode(content)
-                        # b64decode returns bytes on Python 3. PMMail needs a
-                        # str (for JSON serialization). Convert on Python 3
-                        # only to avoid a useless performance hit on Python 2.
-                        if not isinstance(content, str):
-                            content = content.decode()
-                        attachments.append((f, content, m))
+                        # Base64 encoded into the request body when it is sent
+                        attachments.append(PMAttachment(content, name=f, content_type=m))
                     else:
                         attachments.append(item)
 
         message_stream = getattr(message, 'message_stream', None)
-        postmark_message = PMMail(api_key=self.api_key,
+        postmark_message = mail_class(api_key=self.api_key,
                                   subject=message.subject,
                                   sender=message.from_email,
                                   to=recipients,
@@ -142,33 +183,293 @@ class EmailBackend(BaseEmailBackend):
                                   reply_to=reply_to,
                                   custom_headers=custom_headers,
                                   attachments=attachments,
-                                  message_stream=message_stream)
+                                  message_stream=message_stream,
+                                  # open() only opens a synchronous transport
+                                  transport=self.connection if mail_class is PMMail else None)
 
         postmark_message.tag = getattr(message, 'tag', None)
         postmark_message.track_opens = getattr(message, 'track_opens', False)
 
         return postmark_message
 
+    def _enqueue(self, messages):
+        """
+        Store the messages in the outbox, to be sent by its flusher.
+        Message IDs are not known yet, so the count is returned.
+        """
+        pm_messages = [m for m in map(self._build_message, messages) if m]
+        try:
+            return self.outbox.enqueue_many(pm_messages)
+        except:
+            if self.fail_silently:
+                return 0
+            raise
+
+    def _build_send(self, messages, mail_class=PMMail, batch_class=PMBatchMail):
+        """
+        Build the mail_class object sending a single message, or the
+        batch_class object sending several. Returns False if no message has
+        recipients.
+        """
+        if len(messages) == 1:
+            # False if the message was missing recipients.
+            return self._build_message(messages[0], mail_class)
+        pm_messages = [self._build_message(m, mail_class) for m in messages]
+        pm_messages = [m for m in pm_messages if m]
+        if len(pm_messages) == 0:
+            # If after filtering, there aren't any messages
+            # to send, bail.
+            return False
+        return batch_class(messages=pm_messages, transport=self.connection if batch_class is PMBatchMail else None)
+
     def _send(self, messages):
         """A helper method that does the actual sending."""
-        if len(messages) == 1:
-            to_send = self._build_message(messages[0])
-            if to_send is False:
-                # The message was missing recipients.
-                # Bail.
-                return False, None
-        else:
-            pm_messages = list(map(self._build_message, messages))
-            pm_messages = [m for m in pm_messages if m]
-            if len(pm_messages) == 0:
-                # If after filtering, there aren't any messages
-                # to send, bail.
-                return False, None
-            to_send = PMBatchMail(messages=pm_messages)
+        to_send = self._build_send(messages)
+        if to_send is False:
+            return False, None
         try:
-            to_send.send(test=self.test_mode)
+            self._check_sent(to_send, to_send.send(test=self.test_mode))
         except:
             if self.fail_silently:
                 return False, to_send
             raise
         return True, to_send
+
+    def _check_sent(self, instance, sent):
+        """
+        Raise if a batch send returned False: a chunk of its messages was
+        rejected as a whole and the outcome of each one is in .result.
+        """
+        if sent is False:
+            raise PMMailSendException('%d of %d messages were not sent, see .result for the reason'
+                                      % (len(instance.result.failed), len(instance.messages)))
+
+
+class AsyncEmailBackend(EmailBackend):
+    """
+    An EmailBackend for async views: `await backend.asend_messages(messages)`
+    sends through the asyncio client of postmark.async_core, over keep-alive
+    connections owned by the event loop, without blocking it or using a
+    thread. send_messages() is still available to synchronous code.
+    """
+
+    async def asend_messages(self, email_messages):
+        """
+        Sends one or more EmailMessage objects and returns the number of email
+        messages sent.
+        """
+        if not email_messages:
+            return
+
+        if self.outbox is not None and not self.test_mode:
+            return self._enqueue(email_messages)
+
+        to_send = self._build_send(email_messages, AsyncPMMail, AsyncPMBatchMail)
+        if to_send is False:
+            return self._sent_result(False, None, email_messages)
+        try:
+            self._check_sent(to_send, await to_send.send(test=self.test_mode))
+        except:
+            if self.fail_silently:
+                return self._sent_result(False, to_send, email_messages)
+            raise
+        return self._sent_result(True, to_send, email_messages)
+
+
+class PMMailQueue(object):
+    """
+    A bounded queue of PMMail objects sent by a background thread.
+
+    Messages arriving within `window` seconds of each other are sent together
+    as PMBatchMail requests of up to PMBatchMail.MAX_MESSAGES messages. Send
+    errors are logged, as there is no caller left to raise them to.
+
+    Keyword arguments are:
+    maxsize:        Maximum number of messages waiting to be sent.
+    window:         Seconds to wait for more messages before sending a batch.
+    full_policy:    What put() does when the queue is full:
+                    'block' waits up to block_timeout seconds for room, then raises
+                    PMMailSendException; 'drop' discards the message and returns
+                    False; 'send' sends it right away in the calling thread.
+    block_timeout:  Seconds put() waits for room with the 'block' policy, None
+                    waits forever.
+    retry:          A PMRetryPolicy applied to the requests.
+    """
+
+    _STOP = object()
+
+    def __init__(self, maxsize=10000, window=0.05, full_policy='block', block_timeout=None, retry=None):
+        if full_policy not in ('block', 'drop', 'send'):
+            raise ValueError("full_policy must be 'block', 'drop' or 'send', not %r" % full_policy)
+        self.window = window
+        self.full_policy = full_policy
+        self.block_timeout = block_timeout
+        self.retry = retry
+        self.dropped = 0
+        self.closed = False
+        self.__queue = queue.Queue(maxsize)
+        self.__thread = threading.Thread(target=self._run, name='postmark-mail-queue', daemon=True)
+        self.__thread.start()
+
+    def put(self, message):
+        """
+        Queue a PMMail. Returns False if it was dropped because the queue is full.
+        Raises PMMailSendException once the queue is closed.
+        """
+        if self.closed:
+            raise PMMailSendException('The Postmark mail queue is closed')
+        try:
+            if self.full_policy == 'block':
+                self.__queue.put(message, timeout=self.block_timeout)
+            else:
+                self.__queue.put_nowait(message)
+        except queue.Full:
+            if self.full_policy == 'block':
+                raise PMMailSendException('The Postmark mail queue is full')
+            if self.full_policy == 'drop':
+                self.dropped += 1
+                return False
+            message.send(retry=self.retry)
+        return True
+
+    def _run(self):
+        while True:
+            message = self.__queue.get()
+            if message is self._STOP:
+                return
+            messages = [message]
+            stop = False
+            deadline = time.monotonic() + self.window
+            while len(messages) < PMBatchMail.MAX_MESSAGES:
+                try:
+                    message = self.__queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if message is self._STOP:
+                    stop = True
+                    break
+                messages.append(message)
+            self._send(messages)
+            if stop:
+                return
+
+    def _send(self, messages):
+        """
+        Send the collected messages, one batch per API key.
+        """
+        by_key = {}
+        for message in messages:
+            by_key.setdefault(message.api_key, []).append(message)
+        for api_key, group in by_key.items():
+            try:
+                if len(group) == 1:
+                    group[0].send(retry=self.retry)
+                else:
+                    PMBatchMail(api_key=api_key, messages=group).send(retry=self.retry)
+            except Exception:
+                logger.exception('Failed to send %d queued message(s) to Postmark', len(group))
+
+    def close(self, timeout=None):
+        """
+        Send the messages still queued, then stop the background thread,
+        waiting up to `timeout` seconds. No message can be queued afterwards.
+        """
+        self.closed = True
+        if self.__thread.is_alive():
+            self.__queue.put(self._STOP)
+            self.__thread.join(timeout)
+        if not self.__thread.is_alive():
+            # Messages queued by a put() racing with close()
+            messages = []
+            while True:
+                try:
+                    message = self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is not self._STOP:
+                    messages.append(message)
+            if messages:
+                self._send(messages)
+
+
+_mail_queue = None
+_mail_queue_pid = None
+_mail_queue_lock = threading.Lock()
+
+
+def get_mail_queue(**kwargs):
+    """
+    Returns the PMMailQueue of this process, creating it with kwargs the
+    first time, or once the previous one was closed. The queued messages are
+    flushed when the process exits.
+    """
+    global _mail_queue, _mail_queue_pid
+    with _mail_queue_lock:
+        # A forked child does not inherit the parent's worker thread
+        if _mail_queue is None or _mail_queue.closed or _mail_queue_pid != os.getpid():
+            _mail_queue = PMMailQueue(**kwargs)
+            _mail_queue_pid = os.getpid()
+        return _mail_queue
+
+
+@atexit.register
+def flush_mail_queue(timeout=None):
+    """
+    Send the messages waiting in this process's PMMailQueue and stop its
+    thread. Registered to run when the process exits.
+    """
+    if _mail_queue is not None and _mail_queue_pid == os.getpid():
+        _mail_queue.close(timeout)
+
+
+class QueuedEmailBackend(EmailBackend):
+    """
+    An EmailBackend whose send_messages() only queues the messages: a
+    background thread sends them, coalescing the ones sent within a short
+    window into batch requests.
+
+    send_messages() returns the number of messages queued. The queue is
+    configured with the POSTMARK_QUEUE_SIZE, POSTMARK_QUEUE_WINDOW,
+    POSTMARK_QUEUE_FULL_POLICY and POSTMARK_QUEUE_BLOCK_TIMEOUT settings
+    (see PMMailQueue) when first used.
+    """
+
+    def __init__(self, api_key=None, default_sender=None, mail_queue=None, **kwargs):
+        super(QueuedEmailBackend, self).__init__(api_key, default_sender, **kwargs)
+        self.mail_queue = mail_queue
+
+    def _get_queue(self):
+        if self.mail_queue is not None:
+            return self.mail_queue
+        return get_mail_queue(
+            maxsize=getattr(settings, 'POSTMARK_QUEUE_SIZE', 10000),
+            window=getattr(settings, 'POSTMARK_QUEUE_WINDOW', 0.05),
+            full_policy=getattr(settings, 'POSTMARK_QUEUE_FULL_POLICY', 'block'),
+            block_timeout=getattr(settings, 'POSTMARK_QUEUE_BLOCK_TIMEOUT', None),
+        )
+
+    def send_messages(self, email_messages):
+        """
+        Queue one or more EmailMessage objects and return the number of email
+        messages queued.
+        """
+        if not email_messages:
+            return
+        if self.test_mode or self.outbox is not None:
+            return super(QueuedEmailBackend, self).send_messages(email_messages)
+
+        mail_queue = self._get_queue()
+        queued = 0
+        for message in email_messages:
+            pm_message = self._build_message(message)
+            if pm_message is False:
+                continue
+            try:
+                pm_message._check_values()
+                if mail_queue.put(pm_message):
+                    queued += 1
+            except:
+                if self.fail_silently:
+                    continue
+                raise
+        return queued
@@ -0,0 +1,401 @@
+"""
+A durable local outbox for Postmark messages.
+
+enqueue() only writes the encoded message to a local SQLite database (in WAL
+mode), so it returns in a fraction of a millisecond whatever the state of the
+network. A flusher, running in a background thread of the same process or in
+another process sharing the database file, sends the queued messages through
+the batch API in groups of up to PMBatchMail.MAX_MESSAGES:
+
+    outbox = PMOutbox('/var/spool/postmark.sqlite3', api_key='...')
+    outbox.start()
+    outbox.enqueue(PMMail(sender='...', to='...', subject='...', text_body='...'))
+
+Delivery is at-least-once: a message is removed from the outbox only after
+Postmark answered for it, so a flusher crashing in between sends it again
+after a restart.
+
+A flusher can also run on its own, e.g. next to web workers that only enqueue:
+
+    python -m postmark.outbox /var/spool/postmark.sqlite3
+"""
+import logging
+import sqlite3
+import threading
+import time
+
+from postmark.core import (
+    PMBatchMail, PMMailCircuitOpenException, PMMailInactiveRecipientException, PMMailSendException,
+    PMMailServerErrorException, PMMailURLException, get_serializer
+)
+
+logger = logging.getLogger('postmark.outbox')
+
+# Error codes of a group that failed as a whole and may succeed later: HTTP
+# 429 and 5xx statuses, and -1 for connection errors
+TRANSIENT_ERRORS = frozenset((-1, 429, 500, 502, 503, 504))
+
+# Exceptions of a group that failed as a whole and may succeed later
+TRANSIENT_EXCEPTIONS = (PMMailURLException, PMMailServerErrorException, PMMailCircuitOpenException)
+
+
+class _PMOutboxBatch(PMBatchMail):
+    '''
+    A PMBatchMail sending the already encoded payloads of outbox rows, given
+    as (id, payload) tuples.
+    '''
+
+    def _check_values(self):
+        '''
+        Messages were validated when they were enqueued.
+        '''
+        pass
+
+    def _encode_message(self, row):
+        return row[1]
+
+
+class PMOutbox(object):
+    '''
+    A durable spool of messages waiting to be sent to Postmark, stored in a
+    SQLite database.
+
+    Messages are sent in groups of batch_size, each with the API key of the
+    PMMail it was enqueued from. A message Postmark rejects (e.g. an invalid
+    or inactive recipient) is kept as a dead letter. When a whole group fails
+    transiently (network error, Postmark throttling or unavailable, circuit
+    breaker open...), its messages are tried again after a backoff growing
+    with their age, until they are max_age seconds old. When it fails for
+    any other reason (e.g. an invalid API key), they are tried again up to
+    max_attempts times, then kept as dead letters.
+
+    Keyword arguments are:
+    path:           The SQLite database file, created if needed.
+    api_key:        Your Postmark server API key. Defaults to the
+                    POSTMARK_API_KEY Django setting.
+    transport:      A PMTransport used to talk to Postmark.
+    retry:          A PMRetryPolicy applied to each batch request.
+    timeout:        A PMTimeout limiting each batch request.
+    batch_size:     Maximum number of messages sent per batch request.
+    max_attempts:   Number of times a message is tried before it is kept as a
+                    dead letter. Transient failures are not counted.
+    max_age:        Seconds after which a message whose group keeps failing
+                    transiently is kept as a dead letter. None retries it until
+                    it is sent.
+    backoff:        Delay in seconds before retrying a failed group, doubled
+                    after each attempt.
+    max_backoff:    Upper bound of the delay, in seconds.
+    lease:          Seconds a group being sent is hidden from other flushers.
+                    If its flusher dies, the group is sent again afterwards.
+    synchronous:    SQLite synchronous mode. NORMAL survives a crash of the
+                    process; use FULL to also survive a power loss.
+    '''
+
+    def __init__(self, path, api_key=None, transport=None, retry=None, timeout=None,
+                 batch_size=PMBatchMail.MAX_MESSAGES, max_attempts=10, max_age=3 * 24 * 3600, backoff=1,
+                 max_backoff=300, lease=300, synchronous='NORMAL'):
+        self.path = path
+        self.api_key = api_key
+        self.transport = transport
+        self.retry = retry
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.synchronous = synchronous
+        # sqlite3 connections cannot be shared between threads
+        self.__local = threading.local()
+        self.__wakeup = threading.Event()
+        self.__stopping = threading.Event()
+        self.__thread = None
+
+        with self._transaction() as db:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload BLOB NOT NULL,
+                    template INTEGER NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL NOT NULL,
+                    dead INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    api_key TEXT,
+                    enqueued_at REAL
+                )
+            ''')
+            # Outboxes created by earlier versions
+            columns = set(row[1] for row in db.execute('PRAGMA table_info(outbox)'))
+            if 'api_key' not in columns:
+                db.execute('ALTER TABLE outbox ADD COLUMN api_key TEXT')
+            if 'enqueued_at' not in columns:
+                db.execute('ALTER TABLE outbox ADD COLUMN enqueued_at REAL')
+                db.execute('UPDATE outbox SET enqueued_at = available_at')
+            db.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (dead, available_at)')
+
+    def _transaction(self):
+        db = getattr(self.__local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=%s' % self.synchronous)
+            self.__local.db = db
+        return _Transaction(db)
+
+    @staticmethod
+    def _encode(message, now):
+        '''
+        Validate a message and return its (payload, template, api_key,
+        available_at, enqueued_at) row. Dicts are sent with the outbox's
+        api_key.
+        '''
+        if isinstance(message, dict):
+            template = 'TemplateId' in message or 'TemplateAlias' in message
+            return get_serializer().dumps(message), int(template), None, now, now
+        message._check_values()
+        template = bool(message.template_id or message.template_alias)
+        return bytes(message._encode()), int(template), message.api_key, now, now
+
+    def enqueue(self, message):
+        '''
+        Validate a PMMail, or a dict in the Postmark API format, and store it
+        until it is sent. Returns the id of the outbox entry.
+        '''
+        row = self._encode(message, time.time())
+        with self._transaction() as db:
+            row_id = db.execute(_INSERT, row).lastrowid
+        self.__wakeup.set()
+        return row_id
+
+    def enqueue_many(self, messages):
+        '''
+        Store several messages in a single transaction. Returns their count.
+        '''
+        now = time.time()
+        rows = [self._encode(message, now) for message in messages]
+        with self._transaction() as db:
+            db.executemany(_INSERT, rows)
+        self.__wakeup.set()
+        return len(rows)
+
+    def _claim(self):
+        '''
+        Lease the next group of due messages going to the same endpoint with
+        the same API key. Returns (template, api_key,
+        [(id, payload, attempts, enqueued_at), ...]).
+        '''
+        now = time.time()
+        with self._transaction() as db:
+            first = db.execute('SELECT template, api_key FROM outbox WHERE dead = 0 AND available_at <= ? '
+                               'ORDER BY id LIMIT 1', (now,)).fetchone()
+            if first is None:
+                return False, None, []
+            rows = db.execute('SELECT id, payload, attempts, enqueued_at FROM outbox WHERE dead = 0 AND available_at <= ? '
+                              'AND template = ? AND api_key IS ? ORDER BY id LIMIT ?',
+                              (now, first[0], first[1], self.batch_size)).fetchall()
+            db.executemany('UPDATE outbox SET attempts = attempts + 1, available_at = ? WHERE id = ?',
+                           [(now + self.lease, row[0]) for row in rows])
+        return bool(first[0]), first[1], rows
+
+    def flush(self):
+        '''
+        Send one group of due messages. Returns the number of messages
+        handled, 0 once nothing is due.
+        '''
+        template, api_key, rows = self._claim()
+        if not rows:
+            return 0
+
+        batch = _PMOutboxBatch(api_key=api_key or self.api_key, messages=rows, transport=self.transport,
+                               timeout=self.timeout)
+        batch.template = template
+        try:
+            batch.send(test=False, retry=self.retry)
+        except PMMailInactiveRecipientException:
+            # Other messages were sent, the outcome of each one is in .result
+            pass
+        except PMMailSendException as err:
+            self._reschedule(rows, str(err), transient=isinstance(err, TRANSIENT_EXCEPTIONS))
+            return len(rows)
+        except Exception as err:
+            # Not sent, e.g. a missing API key: count the attempt rather than
+            # leave the group leased
+            self._reschedule(rows, repr(err), transient=False)
+            raise
+
+        sent, rejected, transient = [], [], []
+        for row, outcome in zip(rows, batch.result):
+            error_code = outcome['ErrorCode']
+            if not error_code:
+                sent.append((row[0],))
+            elif error_code in TRANSIENT_ERRORS:
+                # The group failed as a whole (throttled, Postmark unavailable,
+                # connection error...): try it again later
+                transient.append(row)
+                transient_error = '%s: %s' % (error_code, outcome['Message'])
+            else:
+                rejected.append(('%s: %s' % (error_code, outcome['Message']), row[0]))
+        with self._transaction() as db:
+            db.executemany('DELETE FROM outbox WHERE id = ?', sent)
+            db.executemany('UPDATE outbox SET dead = 1, last_error = ? WHERE id = ?', rejected)
+        if transient:
+            self._reschedule(transient, transient_error, transient=True)
+        return len(rows)
+
+    def _reschedule(self, rows, error, transient):
+        '''
+        Make a group that failed as a whole due again after a backoff, or
+        keep its messages as dead letters once out of attempts, or too old
+        for a transient failure.
+
+        A transient failure does not count as an attempt: its backoff grows
+        with the age of each message instead, roughly doubling it.
+        '''
+        now = time.time()
+        with self._transaction() as db:
+            for row_id, payload, attempts, enqueued_at in rows:
+                if transient:
+                    age = now - enqueued_at
+                    if self.max_age is not None and age >= self.max_age:
+                        db.execute('UPDATE outbox SET dead = 1, last_error = ? WHERE id = ?', (error, row_id))
+                        continue
+                    delay = min(self.max_backoff, max(self.backoff, age))
+                    # Give back the attempt counted when the group was claimed
+                    db.execute('UPDATE outbox SET attempts = ?, available_at = ?, last_error = ? WHERE id = ?',
+                               (attempts, now + delay, error, row_id))
+                    continue
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    db.execute('UPDATE outbox SET dead = 1, last_error = ? WHERE id = ?', (error, row_id))
+                else:
+                    delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+                    db.execute('UPDATE outbox SET available_at = ?, last_error = ? WHERE id = ?',
+                               (now + delay, error, row_id))
+
+    def drain(self):
+        '''
+        Send due messages until none is left. Returns the number of messages
+        handled.
+        '''
+        total = 0
+        while True:
+            handled = self.flush()
+            if not handled:
+                return total
+            total += handled
+
+    def stats(self):
+        '''
+        Returns the number of pending messages and dead letters.
+        '''
+        with self._transaction() as db:
+            pending, dead = db.execute('SELECT COALESCE(SUM(dead = 0), 0), COALESCE(SUM(dead), 0) FROM outbox').fetchone()
+        return {'pending': pending, 'dead': dead}
+
+    def requeue_dead(self):
+        '''
+        Give every dead letter a fresh set of attempts. Returns their count.
+        '''
+        with self._transaction() as db:
+            count = db.execute('UPDATE outbox SET dead = 0, attempts = 0, available_at = ? WHERE dead = 1',
+                               (time.time(),)).rowcount
+        self.__wakeup.set()
+        return count
+
+    def _run(self, interval):
+        while not self.__stopping.is_set():
+            try:
+                handled = self.drain()
+            except Exception:
+                logger.exception('Failed to flush the Postmark outbox %s', self.path)
+                handled = 0
+            if not handled:
+                self.__wakeup.wait(interval)
+                self.__wakeup.clear()
+
+    def start(self, interval=1.0):
+        '''
+        Start flushing in a background daemon thread. Enqueued messages are
+        sent right away; due retries are looked for every `interval` seconds.
+        '''
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stopping.clear()
+        self.__thread = threading.Thread(target=self._run, args=(interval,), name='postmark-outbox', daemon=True)
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        '''
+        Stop the background flusher, waiting up to `timeout` seconds for the
+        group being sent. Messages left in the outbox are sent by the next
+        flusher.
+        '''
+        self.__stopping.set()
+        self.__wakeup.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            self.__thread = None
+
+
+class _Transaction(object):
+    '''
+    Runs the statements of a `with` block in one IMMEDIATE transaction, so
+    concurrent flushers never lease the same messages.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+_INSERT = 'INSERT INTO outbox (payload, template, api_key, available_at, enqueued_at) VALUES (?, ?, ?, ?, ?)'
+
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+
+def get_outbox(path, **kwargs):
+    '''
+    Returns the PMOutbox of this process for the database at path, creating
+    it with kwargs and starting its background flusher the first time.
+    Pass start=False to only enqueue from this process.
+    '''
+    start = kwargs.pop('start', True)
+    with _outboxes_lock:
+        outbox = _outboxes.get(path)
+        if outbox is None:
+            outbox = _outboxes[path] = PMOutbox(path, **kwargs)
+            if start:
+                outbox.start()
+    return outbox
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Send the messages of a Postmark outbox.')
+    parser.add_argument('path', help='SQLite database of the outbox')
+    parser.add_argument('--api-key', help='Postmark server API key')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between checks for due retries')
+    parser.add_argument('--once', action='store_true', help='Send the due messages and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    outbox = PMOutbox(args.path, api_key=args.api_key)
+    if args.once:
+        logger.info('Sent %d messages', outbox.drain())
+    else:
+        outbox.start(args.interval)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            outbox.stop()
@@ -1,21 +1,103 @@
 """
 Postmark Mixin
 """
+import asyncio
+from io import BytesIO
+from urllib.error import HTTPError, URLError
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
 from tornado.options import options as opt
-import postmark
+from postmark.async_core import AsyncPMBatchMail, AsyncPMMail
+from postmark.core import PMResponse
+
+
+class PMTornadoTransport(object):
+    '''
+    An async transport sending requests with Tornado's AsyncHTTPClient, for
+    use with the objects of postmark.async_core on a Tornado IOLoop.
+
+    The curl based client keeps connections to Postmark alive between
+    requests, so it is used when pycurl is installed. Otherwise Tornado's
+    default client opens a connection per request.
+
+    Keyword arguments are:
+    http_client:    The AsyncHTTPClient to use. Defaults to the client shared
+                    by the current IOLoop.
+    '''
+
+    def __init__(self, http_client=None):
+        self.__http_client = http_client
+
+    @property
+    def http_client(self):
+        if self.__http_client is not None:
+            return self.__http_client
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            return CurlAsyncHTTPClient()
+        except ImportError:
+            return AsyncHTTPClient()
+
+    async def open(self, req, timeout=None):
+        request = HTTPRequest(
+            req.get_full_url(),
+            method=req.get_method(),
+            headers=dict(req.header_items()),
+            body=bytes(req.data) if req.data is not None else None,
+            connect_timeout=timeout.connect if timeout is not None else None,
+            request_timeout=timeout.read if timeout is not None else None,
+        )
+        try:
+            response = await self.http_client.fetch(request, raise_error=False)
+        except HTTPClientError as err:
+            if err.response is None or err.code == 599:
+                # Tornado's code for connection errors and timeouts
+                raise URLError(err)
+            response = err.response
+        except OSError as err:
+            # Connection refused, DNS failure...
+            raise URLError(err)
+        if 200 <= response.code < 300:
+            return PMResponse(response.code, response.reason, response.headers, response.body)
+        raise HTTPError(req.get_full_url(), response.code, response.reason, response.headers,
+                        BytesIO(response.body or b''))
+
+    def close(self):
+        pass
+
 
 class PostmarkMixin(object):
+    '''
+    Tornado RequestHandler mixin sending mail with the postmark_signature
+    (API key) and postmark_sendemail (sender) options.
+
+    send_email() and send_batch_email() do not block the IOLoop: they return
+    a Future, already running, that can be awaited to get the result or the
+    Postmark exception.
+    '''
+
+    postmark_transport = PMTornadoTransport()
+
+    def _build_email(self, **kwargs):
+        sender = AsyncPMMail(transport=self.postmark_transport)
+        sender.sender = opt.postmark_sendemail
+        sender.api_key = opt.postmark_signature
+        sender.to = kwargs.get('to')
+        sender.html_body = kwargs.get('body')
+        sender.subject = kwargs.get('subject')
+        return sender
+
     def send_email(self, **kwargs):
-        subject=kwargs.get('subject')
-        body=kwargs.get('body')
-        to=kwargs.get('to')
-        postsig = opt.postmark_signature
-        postemail = opt.postmark_sendemail
-
-        sender = postmark.PMMail()
-        sender.sender = postemail
-        sender.api_key = postsig
-        sender.to = to
-        sender.html_body = body
-        sender.subject = subject
-        sender.send(test=False)
+        '''
+        Send one email given its subject, (HTML) body and to.
+        '''
+        return asyncio.ensure_future(self._build_email(**kwargs).send(test=False))
+
+    def send_batch_email(self, emails):
+        '''
+        Send a list of emails, each a dict of subject, body and to, through
+        the batch API.
+        '''
+        batch = AsyncPMBatchMail(api_key=opt.postmark_signature, transport=self.postmark_transport,
+                                 messages=[self._build_email(**email) for email in emails])
+        return asyncio.ensure_future(batch.send(test=False))
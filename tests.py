@@ -1,5 +1,12 @@
+import asyncio
+import base64
+import http.client
 import json
+import mmap
+import os
+import tempfile
 import sys
+import time
 import unittest
 from email.mime.image import MIMEImage
 
@@ -8,28 +15,45 @@ from io import BytesIO
 from django.core import mail
 from django.core.mail import EmailMultiAlternatives, EmailMessage
 from django.test import TestCase
+from django.utils.functional import lazy
 
-from postmark.django_backend import EmailBackend
+from postmark.async_core import (
+    AsyncPMBatchMail, AsyncPMBounceManager, AsyncPMMail, AsyncPMPooledTransport, get_default_async_transport
+)
+from postmark.django_backend import AsyncEmailBackend, EmailBackend, PMMailQueue, QueuedEmailBackend
+from postmark.outbox import PMOutbox
 
 if sys.version_info[0] < 3:
     from StringIO import StringIO
     from urllib2 import HTTPError
 else:
     from io import StringIO
-    from urllib.error import HTTPError
+    from urllib.error import HTTPError, URLError
 
 import mock
 
+import postmark.core
+
 from unittest.mock import MagicMock
 
 from postmark import (
     PMBatchMail, PMMail, PMMailInactiveRecipientException,
     PMMailUnprocessableEntityException, PMMailServerErrorException,
-    PMMailMissingValueException, PMBounceManager
+    PMMailMissingValueException, PMBounceManager, PMJSONBody, PMPooledTransport, PMStreamingBatchMail,
+    PMMergeBatchMail, PMAttachment, PMAttachmentCache, get_default_attachment_cache,
+    set_default_attachment_cache, PMMailBatchValidationException, parse_addresses, format_addresses,
+    PMUrllibTransport, PMMailURLException, set_default_transport, get_serializer,
+    set_serializer, PMJSONEncoder, PMRetryPolicy, PMRateLimiter, PMFileRateLimiter,
+    PMCircuitBreaker, PMMailCircuitOpenException, set_default_circuit_breaker, PMTimeout,
+    PMMailSendException, get_config, reload_config
 )
 
 from django.conf import settings
 
+# The tests below fake the network by patching postmark.core.urlopen, so route
+# requests through the urlopen based transport instead of the connection pool.
+set_default_transport(PMUrllibTransport())
+
 
 def make_fake_response(payload, code=200):
     """Helper to fake an HTTP response object."""
@@ -41,6 +65,78 @@ def make_fake_response(payload, code=200):
 
 
 class PMMailTests(unittest.TestCase):
+    def test_compact_representation(self):
+        import pickle
+        message = PMMail(sender='from@example.com', to='to@example.com', subject='Subject', text_body='Body')
+        self.assertFalse(hasattr(message, '__dict__'))
+        self.assertFalse(hasattr(AsyncPMMail(), '__dict__'))
+
+        # Empty collections are created on access and can be mutated in place
+        self.assertNotIn('Headers', message.to_json_message())
+        message.custom_headers['X-Test'] = '1'
+        message.metadata['key'] = 'value'
+        message.attachments.append(('a.txt', 'YQ==', 'text/plain'))
+        json_message = message.to_json_message()
+        self.assertEqual([{'Name': 'X-Test', 'Value': '1'}], json_message['Headers'])
+        self.assertEqual({'key': 'value'}, json_message['Metadata'])
+        self.assertEqual('a.txt', json_message['Attachments'][0]['Name'])
+
+        del message.metadata
+        self.assertEqual({}, message.metadata)
+        self.assertEqual(message.to_json_message(), pickle.loads(pickle.dumps(message)).to_json_message())
+
+    def test_cached_json_message(self):
+        message = PMMail(sender='from@example.com', to='to@example.com', subject='Subject', text_body='Body',
+                         api_key='test')
+
+        with mock.patch.object(PMMail, '_build_json_message', autospec=True,
+                               side_effect=PMMail._build_json_message) as build:
+            with mock.patch('postmark.core.urlopen', return_value=make_fake_response({'MessageID': 'id'})) as transport:
+                message.send()
+                message.send()
+            self.assertEqual(1, build.call_count)
+            self.assertIs(transport.call_args_list[0][0][0].data, transport.call_args_list[1][0][0].data)
+
+            # The returned dict is a copy
+            message.to_json_message()['Subject'] = 'Changed'
+            self.assertEqual('Subject', message.to_json_message()['Subject'])
+            message.message_id = 'other'
+            self.assertEqual(1, build.call_count)
+
+            message.subject = 'New subject'
+            self.assertEqual('New subject', message.to_json_message()['Subject'])
+            self.assertIn(b'New subject', message._encode())
+            message.custom_headers['X-Test'] = '1'
+            self.assertEqual([{'Name': 'X-Test', 'Value': '1'}], message.to_json_message()['Headers'])
+            json_message = message.to_json_message()
+            json_message['Headers'].append({'Name': 'X-Other', 'Value': '2'})
+            json_message['Headers'][0]['Value'] = 'changed'
+            self.assertEqual([{'Name': 'X-Test', 'Value': '1'}], message.to_json_message()['Headers'])
+            del message.to
+            self.assertIsNone(message.to_json_message()['To'])
+            self.assertEqual(4, build.call_count)
+
+            message.attachments = [('a.txt', 'YQ==', 'text/plain')]
+            message.to_json_message()['Attachments'].append({'Name': 'b.txt'})
+            self.assertEqual(['a.txt'], [a['Name'] for a in message.to_json_message()['Attachments']])
+
+    def test_changed_dicts_are_encoded(self):
+        message = PMMail(sender='from@example.com', to='to@example.com', template_id=1,
+                         template_model={'name': 'x'}, api_key='test')
+        metadata = message.metadata
+        message._encode()
+
+        message.template_model['name'] = 'y'
+        self.assertIn(b'"y"', message._encode())
+        self.assertEqual({'name': 'y'}, message.to_json_message()['TemplateModel'])
+
+        # A dict held from before the encoding cannot change what is sent
+        metadata['row'] = '1'
+        self.assertNotIn(b'row', message._encode())
+        self.assertNotIn('Metadata', message.to_json_message())
+        message.to_json_message()['TemplateModel']['name'] = 'z'
+        self.assertNotIn(b'z', message._encode())
+
     def test_406_error_inactive_recipient(self):
         json_payload = BytesIO()
         json_payload.write(b'{"Message": "", "ErrorCode": 406}')
@@ -181,6 +277,67 @@ class PMMailTests(unittest.TestCase):
             for k, v in orig.items():
                 assert orig[k] == attachment[k].rstrip()
 
+    def test_streamed_attachments(self):
+        # Without an attachment cache (the default), attachments are streamed
+        self.assertIsNone(get_default_attachment_cache())
+        content = os.urandom(PMAttachment.CHUNK_SIZE * 2 + 100)
+        self.assertGreater(len(list(PMAttachment(content))), 1)
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.unlink, f.name)
+
+        class ShortReads(BytesIO):
+            def read(self, size=-1):
+                return super(ShortReads, self).read(min(size, 1000))
+
+        source = BytesIO(b'skipped' + content)
+        source.seek(7)
+        with open(f.name, 'rb') as mapped_file:
+            mapped = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.addCleanup(mapped.close)
+        attachments = [
+            PMAttachment(f.name),
+            PMAttachment(source, name='report.pdf'),
+            PMAttachment(mapped, name='mapped.bin', content_id='cid:mapped'),
+            PMAttachment(ShortReads(content), name='short.pdf'),
+        ]
+        message = PMMail(sender='from@example.com', to='to@example.com', subject='Subject', text_body='Body',
+                         api_key='test', attachments=attachments)
+
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response({'MessageID': 'id'})) as transport:
+            message.send(retry=None)
+            message.send()
+        req = transport.call_args[0][0]
+        body = bytes(req.data)
+        self.assertIsInstance(req.data, PMJSONBody)
+        self.assertEqual(str(len(body)), req.get_header('Content-length'))
+
+        sent = json.loads(body.decode('utf-8'))['Attachments']
+        self.assertEqual([os.path.basename(f.name), 'report.pdf', 'mapped.bin', 'short.pdf'], [a['Name'] for a in sent])
+        self.assertEqual(['application/pdf', 'application/pdf', 'application/octet-stream', 'application/pdf'],
+                         [a['ContentType'] for a in sent])
+        self.assertEqual('cid:mapped', sent[2]['ContentID'])
+        for attachment in sent:
+            self.assertEqual(content, base64.b64decode(attachment['Content']))
+
+    def test_unseekable_attachment(self):
+        read_end, write_end = os.pipe()
+        with os.fdopen(read_end, 'rb') as pipe:
+            os.close(write_end)
+            self.assertRaises(TypeError, PMAttachment, pipe, name='report.pdf')
+
+    def test_streamed_attachment_in_batch(self):
+        message = PMMail(sender='from@example.com', to='to@example.com', subject='Subject', text_body='Body',
+                         api_key='test', attachments=[PMAttachment(b'abcd', name='a.txt')])
+        batch = PMBatchMail(api_key='test', messages=[message, message])
+
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response([{}, {}])) as transport:
+            batch.send()
+        sent = json.loads(bytes(transport.call_args[0][0].data).decode('utf-8'))
+        self.assertEqual(['YWJjZA==', 'YWJjZA=='], [m['Attachments'][0]['Content'] for m in sent])
+        # Without splicing, e.g. in test mode, the content is encoded inline
+        self.assertEqual(b'"YWJjZA=="', get_serializer().dumps(PMAttachment(b'abcd')))
+
     def test_send_metadata(self):
         message = PMMail(api_key='test', sender='from@example.com', to='to@example.com',
                          subject='test', text_body='test', metadata={'test': 'test'})
@@ -321,19 +478,1152 @@ class PMBatchMailTests(unittest.TestCase):
             self.assertEqual(results_json[0]["ErrorCode"], 0)
 
 
+    def make_batch(self, count):
+        messages = [
+            PMMail(sender='from@example.com', to='to%d@example.com' % i,
+                   subject='Subject', text_body='Body', api_key='test')
+            for i in range(count)
+        ]
+        return PMBatchMail(messages=messages, api_key='test')
+
+    def fake_batch_urlopen(self, fail_chunk=None):
+        """Answer each batch request with one MessageID per message, derived from its To address."""
+        def urlopen(req, timeout=None):
+            sent = json.loads(bytes(req.data).decode('utf-8'))
+            if fail_chunk is not None and sent[0]['To'] == fail_chunk:
+                json_payload = BytesIO(b'{"Message": "", "ErrorCode": 406}')
+                raise HTTPError('', 422, '', {}, json_payload)
+            return make_fake_response([{'MessageID': 'id-' + m['To'], 'ErrorCode': 0} for m in sent])
+        return urlopen
+
+    def test_validate_collects_errors(self):
+        batch = self.make_batch(5)
+        batch.messages[1].subject = None
+        batch.messages[3].to = None
+        for message in batch.messages:
+            message.track_opens = True
+
+        errors, warnings = batch.validate()
+        self.assertEqual([1, 3], [index for index, reason in errors])
+        self.assertIn('subject', errors[0][1])
+        self.assertEqual(1, len(warnings))
+        self.assertIn('3 message(s)', warnings[0])
+
+        with mock.patch('postmark.core.urlopen') as transport, mock.patch('sys.stdout', new_callable=StringIO) as out:
+            with self.assertRaises(PMMailBatchValidationException) as raised:
+                batch.send()
+        self.assertFalse(transport.called)
+        self.assertEqual(errors, raised.exception.errors)
+        self.assertIsInstance(raised.exception, PMMailMissingValueException)
+        self.assertEqual(1, out.getvalue().count('WARNING'))
+
+    def test_send_all_chunks(self):
+        batch = self.make_batch(1201)
+
+        with mock.patch('postmark.core.urlopen', side_effect=self.fake_batch_urlopen()) as transport:
+            results = batch.send(return_json=True)
+
+        self.assertEqual(3, transport.call_count)
+        self.assertEqual(1201, len(results))
+        self.assertEqual('id-to1200@example.com', batch.messages[1200].message_id)
+        self.assertEqual('id-to500@example.com', batch.messages[500].message_id)
+        self.assertEqual(1201, len(batch.result))
+        self.assertEqual(1201, batch.result.sent)
+        self.assertEqual({'MessageID': 'id-to700@example.com', 'ErrorCode': 0, 'Message': None}, batch.result[700])
+
+    def test_result_records_rejected_chunk(self):
+        batch = self.make_batch(1201)
+
+        with mock.patch('postmark.core.urlopen', side_effect=self.fake_batch_urlopen(fail_chunk='to500@example.com')):
+            self.assertRaises(PMMailInactiveRecipientException, batch.send)
+
+        self.assertEqual(list(range(500, 1000)), batch.result.failed)
+        self.assertEqual(701, batch.result.sent)
+        self.assertEqual(406, batch.result[999]['ErrorCode'])
+        self.assertIsNone(batch.result[999]['MessageID'])
+        self.assertEqual('id-to1000@example.com', batch.result.message_ids[1000])
+
+    def test_rejected_chunk_returns_false(self):
+        batch = self.make_batch(2)
+
+        with mock.patch('postmark.core.urlopen', side_effect=HTTPError('', 503, '', {}, None)):
+            self.assertFalse(batch.send())
+        self.assertEqual(0, batch.result.sent)
+        self.assertEqual(503, batch.result[0]['ErrorCode'])
+
+    def test_result_kept_when_a_chunk_raises(self):
+        batch = self.make_batch(1201)
+        fake_urlopen = self.fake_batch_urlopen()
+
+        def urlopen(req, timeout=None):
+            if json.loads(bytes(req.data).decode('utf-8'))[0]['To'] == 'to500@example.com':
+                raise HTTPError('', 500, '', {}, None)
+            return fake_urlopen(req)
+
+        with mock.patch('postmark.core.urlopen', side_effect=urlopen):
+            self.assertRaises(PMMailServerErrorException, batch.send)
+        self.assertEqual(500, len(batch.result))
+        self.assertEqual(500, batch.result.sent)
+
+    def test_chunks_split_by_size(self):
+        batch = self.make_batch(10)
+        batch.messages[7].text_body = 'x' * 400
+        size = len(get_serializer().dumps(batch.messages[0].to_json_message()))
+
+        with mock.patch.multiple(PMBatchMail, MAX_BATCH_SIZE=4 * size, MAX_MESSAGE_SIZE=300):
+            with mock.patch('postmark.core.urlopen', side_effect=self.fake_batch_urlopen()) as transport:
+                batch.send()
+
+        chunks = [json.loads(bytes(call[0][0].data).decode('utf-8')) for call in transport.call_args_list]
+        self.assertEqual([3, 3, 3], [len(chunk) for chunk in chunks])
+        self.assertTrue(all(len(call[0][0].data) <= 4 * size for call in transport.call_args_list))
+        # The oversized message is not sent and fails on its own
+        self.assertEqual(['to6@example.com', 'to8@example.com', 'to9@example.com'], [m['To'] for m in chunks[2]])
+        self.assertEqual([7], batch.result.failed)
+        self.assertEqual(300, batch.result[7]['ErrorCode'])
+        self.assertIsNone(batch.messages[7].message_id)
+        self.assertEqual('id-to8@example.com', batch.result.message_ids[8])
+
+    def test_oversized_messages_not_sent(self):
+        batch = self.make_batch(1200)
+        batch.messages[100].text_body = 'x' * 400
+
+        with mock.patch.object(PMBatchMail, 'MAX_MESSAGE_SIZE', 300):
+            with mock.patch('postmark.core.urlopen', side_effect=self.fake_batch_urlopen()) as transport:
+                self.assertTrue(batch.send())
+
+        self.assertEqual(3, transport.call_count)
+        self.assertEqual([100], batch.result.failed)
+        self.assertEqual(1199, batch.result.sent)
+        self.assertEqual('id-to101@example.com', batch.result.message_ids[101])
+
+    def test_template_chunk_body(self):
+        message = PMMail(sender='from@example.com', to='to@example.com', api_key='test',
+                         template_id=1, template_model={'name': 'value'})
+        batch = PMBatchMail(messages=[message, message], api_key='test')
+
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response([{}, {}])) as transport:
+            batch.send()
+
+        req = transport.call_args[0][0]
+        self.assertTrue(req.get_full_url().endswith('/email/batchWithTemplates'))
+        self.assertEqual({'Messages': [message.to_json_message()] * 2}, json.loads(bytes(req.data).decode('utf-8')))
+        # The body is sent as the individually encoded messages, never joined
+        self.assertIsInstance(req.data, PMJSONBody)
+        self.assertEqual(5, len(req.data.pieces))
+        self.assertEqual(str(len(bytes(req.data))), req.get_header('Content-length'))
+
+    def test_concurrent_send_preserves_order(self):
+        batch = self.make_batch(1201)
+
+        with mock.patch('postmark.core.urlopen', side_effect=self.fake_batch_urlopen()) as transport:
+            results = batch.send(return_json=True, concurrency=3)
+
+        self.assertEqual(3, transport.call_count)
+        self.assertEqual(1201, len(results))
+        self.assertEqual(['id-to%d@example.com' % i for i in range(1201)], [r['MessageID'] for r in results])
+        self.assertEqual(['id-to%d@example.com' % i for i in range(1201)], [m.message_id for m in batch.messages])
+
+    def test_concurrent_send_inactive_recipient_continues(self):
+        batch = self.make_batch(1201)
+
+        with mock.patch('postmark.core.urlopen', side_effect=self.fake_batch_urlopen(fail_chunk='to500@example.com')) as transport:
+            self.assertRaises(PMMailInactiveRecipientException, batch.send, concurrency=2)
+
+        self.assertEqual(3, transport.call_count)
+        self.assertEqual('id-to1200@example.com', batch.messages[1200].message_id)
+        self.assertIsNone(batch.messages[500].message_id)
+
+
+class PMStreamingBatchMailTests(unittest.TestCase):
+    fake_batch_urlopen = PMBatchMailTests.fake_batch_urlopen
+
+    def test_streaming_send(self):
+        pulled = []
+        sent_after = []
+
+        def source():
+            for i in range(1201):
+                pulled.append(i)
+                if i % 2:
+                    yield {'From': 'from@example.com', 'To': 'to%d@example.com' % i, 'Subject': 'Subject', 'TextBody': 'Body'}
+                else:
+                    yield PMMail(sender='from@example.com', to='to%d@example.com' % i,
+                                 subject='Subject', text_body='Body', api_key='test')
+
+        fake_urlopen = self.fake_batch_urlopen()
+
+        def urlopen(req, timeout=None):
+            sent_after.append(len(pulled))
+            return fake_urlopen(req)
+
+        batch = PMStreamingBatchMail(messages=source(), api_key='test')
+        with mock.patch('postmark.core.urlopen', side_effect=urlopen):
+            self.assertTrue(batch.send())
+
+        # Only one chunk (plus the message closing it) is pulled before each request
+        self.assertEqual([501, 1001, 1201], sent_after)
+        self.assertEqual(1201, batch.result.sent)
+        self.assertEqual('id-to1200@example.com', batch.result.message_ids[1200])
+        self.assertEqual('id-to1@example.com', batch.result.message_ids[1])
+
+    def test_streaming_validates_messages(self):
+        messages = iter([PMMail(sender='from@example.com', to='to@example.com', api_key='test', text_body='Body')])
+        batch = PMStreamingBatchMail(messages=messages, api_key='test')
+
+        with mock.patch('postmark.core.urlopen') as transport:
+            self.assertTrue(batch.send())
+        self.assertFalse(transport.called)
+        self.assertEqual([0], batch.result.failed)
+        self.assertEqual(300, batch.result[0]['ErrorCode'])
+        self.assertEqual('Cannot send an e-mail without a subject', batch.result[0]['Message'])
+
+    def test_streaming_records_invalid_messages(self):
+        def source():
+            for i in range(6):
+                message = {'From': 'from@example.com', 'To': 'to%d@example.com' % i, 'Subject': 'Subject',
+                           'TextBody': 'Body', 'TrackOpens': True}
+                if i == 2:
+                    del message['From']
+                elif i == 4:
+                    message['To'] = 'not an address'
+                yield message
+
+        batch = PMStreamingBatchMail(messages=source(), api_key='test')
+        with mock.patch('postmark.core.urlopen', side_effect=self.fake_batch_urlopen()) as transport, \
+                mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            self.assertTrue(batch.send())
+
+        # Valid messages around the invalid ones are still sent, in order
+        self.assertEqual(1, transport.call_count)
+        self.assertEqual([2, 4], batch.result.failed)
+        self.assertEqual(4, batch.result.sent)
+        self.assertEqual('id-to5@example.com', batch.result.message_ids[5])
+        self.assertEqual('Cannot send an e-mail without a sender (From field)', batch.result[2]['Message'])
+        self.assertIn('Invalid e-mail address', batch.result[4]['Message'])
+        # One warning per chunk sent
+        self.assertEqual(1, stdout.getvalue().count('WARNING'))
+
+    def test_streaming_invalid_messages_do_not_split_chunks(self):
+        messages = ({'From': 'from@example.com', 'To': 'to%d@example.com' % i, 'Subject': 'Subject',
+                     'TextBody': 'Body' if i % 10 else None} for i in range(1000))
+        batch = PMStreamingBatchMail(messages=messages, api_key='test')
+
+        with mock.patch('postmark.core.urlopen', side_effect=self.fake_batch_urlopen()) as transport:
+            batch.send()
+
+        self.assertEqual(2, transport.call_count)
+        self.assertEqual(list(range(0, 1000, 10)), batch.result.failed)
+        self.assertEqual('id-to999@example.com', batch.result.message_ids[999])
+
+    def test_streaming_template_chunk(self):
+        messages = iter([{'From': 'from@example.com', 'To': 'to@example.com', 'TemplateId': 1, 'TemplateModel': {}}])
+        batch = PMStreamingBatchMail(messages=messages, api_key='test')
+
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response([{}])) as transport:
+            batch.send()
+        req = transport.call_args[0][0]
+        self.assertTrue(req.get_full_url().endswith('/email/batchWithTemplates'))
+        self.assertEqual(1, len(json.loads(bytes(req.data).decode('utf-8'))['Messages']))
+
+
+class AttachmentCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = PMAttachmentCache(max_bytes=64, max_entry_size=32)
+        previous = get_default_attachment_cache()
+        set_default_attachment_cache(self.cache)
+        self.addCleanup(set_default_attachment_cache, previous)
+
+    def test_repeated_attachment_encoded_once(self):
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
+            f.write(b'terms and conditions')
+        self.addCleanup(os.unlink, f.name)
+
+        messages = [PMMail(sender='from@example.com', to='to%d@example.com' % i, subject='Subject',
+                           text_body='Body', api_key='test', attachments=[PMAttachment(f.name)])
+                    for i in range(3)]
+        batch = PMBatchMail(api_key='test', messages=messages)
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response([{}] * 3)) as transport:
+            batch.send()
+        sent = json.loads(bytes(transport.call_args[0][0].data).decode('utf-8'))
+        self.assertEqual([b'terms and conditions'] * 3,
+                         [base64.b64decode(m['Attachments'][0]['Content']) for m in sent])
+        self.assertEqual({'entries': 1, 'bytes': 28, 'hits': 2, 'misses': 1}, self.cache.stats())
+
+        # A changed file is hashed and encoded again
+        with open(f.name, 'wb') as changed:
+            changed.write(b'new terms')
+        os.utime(f.name, ns=(0, 0))
+        self.assertEqual([b'bmV3IHRlcm1z'], list(PMAttachment(f.name)))
+        self.assertEqual(2, self.cache.stats()['misses'])
+
+    def test_eviction(self):
+        encoded = [self.cache.encode(content) for content in (b'a' * 18, b'b' * 18, b'c' * 18)]
+        self.assertEqual(base64.b64encode(b'a' * 18), encoded[0])
+        # Three encodings of 24 bytes do not fit in 64, the least recently used goes
+        self.assertEqual({'entries': 2, 'bytes': 48, 'hits': 0, 'misses': 3}, self.cache.stats())
+        self.cache.encode(b'b' * 18)
+        self.assertEqual(1, self.cache.stats()['hits'])
+
+        # Larger than max_entry_size: streamed without being cached
+        self.assertEqual(base64.b64encode(b'd' * 30), b''.join(PMAttachment(b'd' * 30)))
+        self.assertEqual(2, self.cache.stats()['entries'])
+
+
+class AddressTests(unittest.TestCase):
+    def test_parse_addresses(self):
+        self.assertEqual([('A', 'A@example.com'), ('Last, First', 'b@example.org')],
+                         parse_addresses('A <A@Example.COM>, a@example.com, "Last, First" <b@example.org>'))
+        self.assertEqual([('', 'a@example.com'), ('B', 'b@example.com')],
+                         parse_addresses(['a@example.com', 'B <b@example.com>', 'A@EXAMPLE.com']))
+        self.assertEqual([], parse_addresses(None))
+        for value in ('a@example.com,', 'a@example.com, ', ' , a@example.com'):
+            self.assertEqual([('', 'a@example.com')], parse_addresses(value))
+            self.assertIsNone(postmark.core._address_error('to', value))
+        self.assertEqual('a@example.com, "Last, First" <b@example.org>',
+                         format_addresses(['a@example.com', '"Last, First" <b@example.org>', 'a@example.com']))
+
+        postmark.core._parse_address_list.cache_clear()
+        parse_addresses('A <a@example.com>')
+        parse_addresses('A <a@example.com>')
+        self.assertEqual(1, postmark.core._parse_address_list.cache_info().hits)
+
+    def test_recipients_checked_before_sending(self):
+        def message(**kwargs):
+            return PMMail(sender='from@example.com', subject='Subject', text_body='Body', api_key='test', **kwargs)
+
+        too_many = ', '.join('to%d@example.com' % i for i in range(51))
+        with mock.patch('postmark.core.urlopen') as transport:
+            self.assertRaises(PMMailMissingValueException, message(to=too_many).send)
+            self.assertRaises(PMMailMissingValueException, message(to='to@example.com', cc='not an address').send)
+        self.assertFalse(transport.called)
+
+        # Duplicates are counted once
+        self.assertIsNone(message(to=', '.join(['to@example.com'] * 51))._validation_error())
+        self.assertIsNone(message(to='To <to@example.com>', bcc=['a@example.com', 'b@example.com'])._validation_error())
+
+        batch = PMBatchMail(api_key='test', messages=[message(to='to@example.com'), message(bcc=too_many)])
+        errors, warnings = batch.validate()
+        self.assertEqual([1], [index for index, reason in errors])
+        self.assertIn('.bcc', errors[0][1])
+
+    def test_sends_validated_recipients(self):
+        def message(**kwargs):
+            return PMMail(sender='from@example.com', subject='Subject', text_body='Body', api_key='test', **kwargs)
+
+        # 60 entries, 40 of them unique: what is sent is what was counted
+        to = ', '.join('to%d@example.com' % (i % 40) for i in range(60))
+        sent = message(to=to)
+        self.assertIsNone(sent._validation_error())
+        self.assertEqual(', '.join('to%d@example.com' % i for i in range(40)), sent.to_json_message()['To'])
+
+        # Lists are sent as a comma separated str
+        json_message = message(to=['x@example.com', 'Y <y@example.com>'], cc=['c@example.com'],
+                               reply_to=['r@example.com']).to_json_message()
+        self.assertEqual('x@example.com, Y <y@example.com>', json_message['To'])
+        self.assertEqual('c@example.com', json_message['Cc'])
+        self.assertEqual('r@example.com', json_message['ReplyTo'])
+
+        batch = PMMergeBatchMail(shared=message(), to=[['a@example.com', 'b@example.com']])
+        self.assertEqual('a@example.com, b@example.com', json.loads(bytes(batch._encode_message(0)))['To'])
+
+
+class PMMergeBatchMailTests(unittest.TestCase):
+    fake_batch_urlopen = PMBatchMailTests.fake_batch_urlopen
+
+    def make_batch(self, count, **kwargs):
+        shared = PMMail(sender='from@example.com', subject='Subject', text_body='Body',
+                        tag='news', api_key='test', **kwargs)
+        return PMMergeBatchMail(shared=shared, to=['to%d@example.com' % i for i in range(count)],
+                                metadata=[{'row': str(i)} for i in range(count)])
+
+    def test_merge_body(self):
+        batch = self.make_batch(2)
+
+        with mock.patch('postmark.core.urlopen', side_effect=self.fake_batch_urlopen()) as transport:
+            batch.send()
+        sent = json.loads(bytes(transport.call_args[0][0].data).decode('utf-8'))
+        self.assertEqual([
+            {'From': 'from@example.com', 'To': 'to%d@example.com' % i, 'Subject': 'Subject', 'Tag': 'news',
+             'TextBody': 'Body', 'Metadata': {'row': str(i)}}
+            for i in range(2)
+        ], sent)
+
+    def test_send_all_chunks(self):
+        batch = self.make_batch(1201)
+
+        with mock.patch('postmark.core.urlopen', side_effect=self.fake_batch_urlopen()) as transport:
+            self.assertTrue(batch.send())
+
+        self.assertEqual(3, transport.call_count)
+        self.assertEqual(1201, batch.result.sent)
+        self.assertEqual('id-to1200@example.com', batch.result[1200]['MessageID'])
+
+    def test_validates_shared_fields_once(self):
+        batch = PMMergeBatchMail(shared=PMMail(sender='from@example.com', api_key='test', text_body='Body'),
+                                 to=['to@example.com'])
+        with mock.patch('postmark.core.urlopen') as transport:
+            self.assertRaises(PMMailMissingValueException, batch.send)
+        self.assertFalse(transport.called)
+
+        batch = PMMergeBatchMail(shared=PMMail(sender='from@example.com', api_key='test', subject='Subject',
+                                               text_body='Body'), to=['to@example.com', None])
+        self.assertRaises(PMMailMissingValueException, batch.send)
+
+        batch = PMMergeBatchMail(shared=PMMail(sender='from@example.com', api_key='test', subject='Subject',
+                                               text_body='Body'), to=['to@example.com', 'invalid'])
+        self.assertEqual([1], [index for index, reason in batch.validate()[0]])
+
+        self.assertRaises(ValueError, PMMergeBatchMail, shared=PMMail(), to=['to@example.com'], metadata=[])
+        self.assertRaises(TypeError, batch.add_message, PMMail())
+
+    def test_template_chunk(self):
+        shared = PMMail(sender='from@example.com', template_id=1, template_model={'name': ''}, api_key='test')
+        batch = PMMergeBatchMail(shared=shared, to=['a@example.com', 'b@example.com'],
+                                 template_model=[{'name': 'A'}, {'name': 'B'}])
+
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response([{}, {}])) as transport:
+            batch.send()
+        req = transport.call_args[0][0]
+        self.assertTrue(req.get_full_url().endswith('/email/batchWithTemplates'))
+        sent = json.loads(bytes(req.data).decode('utf-8'))['Messages']
+        self.assertEqual([{'name': 'A'}, {'name': 'B'}], [m['TemplateModel'] for m in sent])
+        self.assertEqual([1, 1], [m['TemplateId'] for m in sent])
+
+
+class RetryPolicyTests(unittest.TestCase):
+    def make_message(self):
+        return PMMail(sender='from@example.com', to='to@example.com',
+                      subject='Subject', text_body='Body', api_key='test')
+
+    def make_policy(self, **kwargs):
+        policy = PMRetryPolicy(jitter=False, **kwargs)
+        policy.sleep = MagicMock()
+        return policy
+
+    def test_delay(self):
+        policy = PMRetryPolicy(backoff=0.5, multiplier=2, max_backoff=1.5, jitter=False)
+        self.assertEqual([0.5, 1.0, 1.5], [policy.delay(attempt) for attempt in (1, 2, 3)])
+
+        policy = PMRetryPolicy(backoff=1, jitter=True)
+        self.assertTrue(all(0 <= policy.delay(2) <= 2 for i in range(20)))
+
+    def test_retry_after(self):
+        policy = PMRetryPolicy(jitter=False)
+        err = HTTPError('', 429, '', {'Retry-After': '7'}, None)
+        self.assertEqual(7.0, policy.delay(1, err))
+        policy.respect_retry_after = False
+        self.assertEqual(0.5, policy.delay(1, err))
+
+    def test_long_retry_after_not_waited(self):
+        policy = PMRetryPolicy(jitter=False, max_backoff=30)
+        err = HTTPError('', 429, '', {'Retry-After': '3600'}, None)
+        self.assertFalse(policy.should_retry(err, 1))
+        self.assertEqual(30, policy.delay(1, err))
+        self.assertTrue(policy.should_retry(HTTPError('', 429, '', {'Retry-After': '30'}, None), 1))
+
+    def test_send_retries_transient_errors(self):
+        policy = self.make_policy()
+        responses = [
+            HTTPError('', 500, '', {}, None),
+            HTTPError('', 429, '', {'Retry-After': '2'}, None),
+            make_fake_response({'MessageID': 'abc'}),
+        ]
+
+        with mock.patch('postmark.core.urlopen', side_effect=responses) as transport:
+            message = self.make_message()
+            self.assertTrue(message.send(retry=policy))
+
+        self.assertEqual('abc', message.message_id)
+        self.assertEqual([mock.call(0.5), mock.call(2.0)], policy.sleep.call_args_list)
+        # The same request, and so the same encoded body, is sent each time
+        requests = [call[0][0] for call in transport.call_args_list]
+        self.assertTrue(all(req is requests[0] for req in requests))
+
+    def test_send_gives_up(self):
+        policy = self.make_policy(max_attempts=2)
+
+        with mock.patch('postmark.core.urlopen', side_effect=HTTPError('', 500, '', {}, None)) as transport:
+            self.assertRaises(PMMailServerErrorException, self.make_message().send, retry=policy)
+        self.assertEqual(2, transport.call_count)
+
+    def test_send_does_not_retry_client_errors(self):
+        policy = self.make_policy()
+        json_payload = BytesIO(b'{"Message": "", "ErrorCode": 422}')
+
+        with mock.patch('postmark.core.urlopen', side_effect=HTTPError('', 422, '', {}, json_payload)) as transport:
+            self.assertRaises(PMMailUnprocessableEntityException, self.make_message().send, retry=policy)
+        self.assertEqual(1, transport.call_count)
+
+    def test_batch_resends_only_failed_messages(self):
+        policy = self.make_policy(retry_error_codes=[100])
+        messages = [self.make_message() for i in range(3)]
+        for i, message in enumerate(messages):
+            message.to = 'to%d@example.com' % i
+        responses = [
+            make_fake_response([{'MessageID': 'a', 'ErrorCode': 0}, {'ErrorCode': 100}, {'ErrorCode': 100}]),
+            make_fake_response([{'ErrorCode': 100}, {'MessageID': 'c', 'ErrorCode': 0}]),
+            make_fake_response([{'MessageID': 'b', 'ErrorCode': 0}]),
+        ]
+
+        batch = PMBatchMail(messages=messages, api_key='test')
+        with mock.patch('postmark.core.urlopen', side_effect=responses) as transport:
+            batch.send(retry=policy)
+
+        sent = [[m['To'] for m in json.loads(bytes(call[0][0].data).decode('utf-8'))] for call in transport.call_args_list]
+        self.assertEqual([['to0@example.com', 'to1@example.com', 'to2@example.com'],
+                          ['to1@example.com', 'to2@example.com'],
+                          ['to1@example.com']], sent)
+        self.assertEqual(['a', 'b', 'c'], [m.message_id for m in messages])
+        self.assertEqual(3, batch.result.sent)
+
+    def test_bounce_manager_retries(self):
+        policy = self.make_policy()
+        bounce = PMBounceManager(api_key='test', retry=policy)
+
+        with mock.patch('postmark.core.urlopen', side_effect=[HTTPError('', 503, '', {}, None), make_fake_response({'Tags': []})]):
+            self.assertEqual({'Tags': []}, bounce.get_tags())
+
+
+class RateLimiterTests(unittest.TestCase):
+    def make_limiter(self, cls=PMRateLimiter, *args, **kwargs):
+        limiter = cls(*args, **kwargs)
+        limiter._now = MagicMock(return_value=100.0)
+        limiter.sleep = MagicMock()
+        return limiter
+
+    def test_requests_per_second(self):
+        limiter = self.make_limiter(requests_per_second=2)
+        self.assertEqual([0, 0, 0.5, 1.0], [limiter._reserve() for i in range(4)])
+
+        # Tokens come back over time
+        limiter._now.return_value = 102.0
+        self.assertEqual(0, limiter._reserve())
+
+    def test_messages_per_second(self):
+        limiter = self.make_limiter(messages_per_second=100)
+        self.assertEqual(0, limiter._reserve(100))
+        self.assertEqual(4.0, limiter._reserve(400))
+
+    def test_send_waits(self):
+        limiter = self.make_limiter(requests_per_second=1, messages_per_second=500)
+        messages = [PMMail(sender='from@example.com', to='to@example.com', subject='Subject',
+                           text_body='Body', api_key='test') for i in range(600)]
+
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response({})):
+            messages[0].send(rate_limiter=limiter)
+        with mock.patch('postmark.core.urlopen', side_effect=lambda req, timeout=None: make_fake_response([{}] * 500)):
+            PMBatchMail(messages=messages, api_key='test').send(rate_limiter=limiter)
+
+        # 1 request + 1 message, then 500 messages, then 100 more
+        self.assertEqual([mock.call(1.0), mock.call(2.0)], limiter.sleep.call_args_list)
+
+    def test_file_limiter_shared(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + '/postmark.rate'
+            first = self.make_limiter(PMFileRateLimiter, path, requests_per_second=1)
+            second = self.make_limiter(PMFileRateLimiter, path, requests_per_second=1)
+            self.assertEqual(0, first._reserve())
+            self.assertEqual(1.0, second._reserve())
+            self.assertEqual(2.0, first._reserve())
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.breaker = PMCircuitBreaker(failure_threshold=2, reset_timeout=10,
+                                        on_state_change=MagicMock())
+        self.breaker._now = MagicMock(return_value=100.0)
+        set_default_circuit_breaker(self.breaker)
+        self.addCleanup(set_default_circuit_breaker, None)
+        self.message = PMMail(sender='from@example.com', to='to@example.com', subject='Subject',
+                              text_body='Body', api_key='test')
+
+    def fail_send(self):
+        error = HTTPError('', 500, '', {}, BytesIO(b'{}'))
+        with mock.patch('postmark.core.urlopen', side_effect=error):
+            with self.assertRaises(PMMailServerErrorException):
+                self.message.send()
+
+    def test_opens_and_fails_fast(self):
+        self.fail_send()
+        self.assertEqual(PMCircuitBreaker.CLOSED, self.breaker.state)
+        self.fail_send()
+        self.assertEqual(PMCircuitBreaker.OPEN, self.breaker.state)
+
+        with mock.patch('postmark.core.urlopen') as urlopen:
+            with self.assertRaises(PMMailCircuitOpenException):
+                self.message.send()
+            with self.assertRaises(PMMailCircuitOpenException):
+                PMBatchMail(messages=[self.message], api_key='test').send()
+        self.assertFalse(urlopen.called)
+        self.assertEqual({'state': 'open', 'consecutive_failures': 2, 'trips': 1, 'rejected': 2},
+                         self.breaker.stats())
+        self.breaker.on_state_change.assert_called_once_with('closed', 'open')
+
+    def test_local_deadline_does_not_count(self):
+        limiter = MagicMock()
+        limiter.acquire.side_effect = lambda messages: time.sleep(0.02)
+
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response({})) as urlopen:
+            for i in range(2):
+                with self.assertRaises(PMMailURLException):
+                    self.message.send(rate_limiter=limiter, timeout=PMTimeout(deadline=0.01))
+        self.assertFalse(urlopen.called)
+        self.assertEqual({'state': 'closed', 'consecutive_failures': 0, 'trips': 0, 'rejected': 0},
+                         self.breaker.stats())
+
+    def test_client_errors_do_not_count(self):
+        for i in range(3):
+            error = HTTPError('', 422, '', {}, BytesIO(b'{"ErrorCode": 300, "Message": ""}'))
+            with mock.patch('postmark.core.urlopen', side_effect=error):
+                with self.assertRaises(PMMailUnprocessableEntityException):
+                    self.message.send()
+        self.assertEqual(PMCircuitBreaker.CLOSED, self.breaker.state)
+
+    def test_half_open_probe(self):
+        self.fail_send()
+        self.fail_send()
+        self.breaker._now.return_value = 110.0
+        self.assertEqual(PMCircuitBreaker.HALF_OPEN, self.breaker.state)
+
+        # A single probe at a time
+        self.breaker.before_request()
+        with self.assertRaises(PMMailCircuitOpenException):
+            self.breaker.before_request()
+        self.breaker.release()
+
+        # A failed probe opens the breaker again
+        self.fail_send()
+        self.assertEqual(PMCircuitBreaker.OPEN, self.breaker.state)
+
+        # A successful one closes it
+        self.breaker._now.return_value = 120.0
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response({})):
+            self.message.send()
+        self.assertEqual(PMCircuitBreaker.CLOSED, self.breaker.state)
+        self.assertEqual(2, self.breaker.stats()['trips'])
+
+
+class TimeoutTests(unittest.TestCase):
+    def make_message(self, **kwargs):
+        return PMMail(sender='from@example.com', to='to@example.com', subject='Subject',
+                      text_body='Body', api_key='test', **kwargs)
+
+    def test_timeout_passed_to_urlopen(self):
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response({})) as urlopen:
+            self.make_message().send()
+            self.make_message(timeout=5).send()
+            self.make_message(timeout=5).send(timeout=(1, 2))
+            PMBounceManager(api_key='test', timeout=3).get_tags()
+        self.assertEqual([30, 5, 2, 3], [call[1]['timeout'] for call in urlopen.call_args_list])
+
+    def test_deadline_bounds_retries(self):
+        policy = PMRetryPolicy(backoff=10, jitter=False)
+        policy.sleep = MagicMock()
+        error = HTTPError('', 500, '', {}, BytesIO(b'{}'))
+
+        with mock.patch('postmark.core.urlopen', side_effect=error) as urlopen:
+            with self.assertRaises(PMMailServerErrorException):
+                self.make_message().send(retry=policy, timeout=PMTimeout(deadline=5))
+        self.assertEqual(1, urlopen.call_count)
+        self.assertFalse(policy.sleep.called)
+
+    def test_deadline_bounds_batch(self):
+        clock = [0.0]
+        fake_urlopen = PMBatchMailTests.fake_batch_urlopen(None)
+
+        def urlopen(req, timeout=None):
+            clock[0] += 3
+            return fake_urlopen(req)
+
+        batch = PMBatchMailTests.make_batch(None, 1201)
+        with mock.patch('postmark.core.time.monotonic', side_effect=lambda: clock[0]):
+            with mock.patch('postmark.core.urlopen', side_effect=urlopen) as transport:
+                with self.assertRaises(PMMailURLException):
+                    batch.send(timeout=PMTimeout(connect=1, read=10, deadline=5))
+
+        # The second chunk only had 2 seconds left, the third one was not sent
+        self.assertEqual([5, 2], [call[1]['timeout'] for call in transport.call_args_list])
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        import tempfile
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name + '/outbox.sqlite3'
+
+    def make_message(self, i=0):
+        return PMMail(sender='from@example.com', to='to%d@example.com' % i, subject='Subject',
+                      text_body='Body', api_key='test')
+
+    def test_enqueue_and_drain(self):
+        outbox = PMOutbox(self.path, api_key='test', batch_size=2)
+        for i in range(3):
+            outbox.enqueue(self.make_message(i))
+        outbox.enqueue({'From': 'from@example.com', 'To': 'to3@example.com', 'TemplateId': 1, 'TemplateModel': {}})
+
+        # Survives the process: a new outbox sees the queued messages
+        outbox = PMOutbox(self.path, api_key='test', batch_size=2)
+        self.assertEqual({'pending': 4, 'dead': 0}, outbox.stats())
+
+        def urlopen(req, timeout=None):
+            sent = json.loads(bytes(req.data).decode('utf-8'))
+            return make_fake_response([{'ErrorCode': 0}] * len(sent['Messages'] if isinstance(sent, dict) else sent))
+
+        with mock.patch('postmark.core.urlopen', side_effect=urlopen) as transport:
+            self.assertEqual(4, outbox.drain())
+
+        requests = [call[0][0] for call in transport.call_args_list]
+        self.assertEqual(['https://api.postmarkapp.com/email/batch'] * 2 + ['https://api.postmarkapp.com/email/batchWithTemplates'],
+                         [req.get_full_url() for req in requests])
+        self.assertEqual(['to0@example.com', 'to1@example.com'],
+                         [m['To'] for m in json.loads(bytes(requests[0].data).decode('utf-8'))])
+        self.assertEqual({'pending': 0, 'dead': 0}, outbox.stats())
+
+    def test_rejected_messages_kept(self):
+        outbox = PMOutbox(self.path, api_key='test')
+        outbox.enqueue_many([self.make_message(0), self.make_message(1)])
+        response = make_fake_response([{'MessageID': 'a', 'ErrorCode': 0},
+                                       {'ErrorCode': 300, 'Message': 'Invalid email request'}])
+
+        with mock.patch('postmark.core.urlopen', return_value=response):
+            outbox.drain()
+        self.assertEqual({'pending': 0, 'dead': 1}, outbox.stats())
+
+        self.assertEqual(1, outbox.requeue_dead())
+        self.assertEqual({'pending': 1, 'dead': 0}, outbox.stats())
+
+    def test_failed_group_retried_later(self):
+        outbox = PMOutbox(self.path, api_key='test', max_attempts=2, max_age=100, backoff=60)
+        outbox.enqueue(self.make_message())
+        now = time.time()
+
+        with mock.patch('postmark.core.urlopen', side_effect=URLError('unreachable')) as transport:
+            self.assertEqual(1, outbox.drain())
+            # Not due again before the backoff
+            self.assertEqual(0, outbox.drain())
+            self.assertEqual({'pending': 1, 'dead': 0}, outbox.stats())
+
+            # Transient failures do not use up max_attempts
+            with mock.patch('postmark.outbox.time.time', return_value=now + 61):
+                outbox.drain()
+            self.assertEqual({'pending': 1, 'dead': 0}, outbox.stats())
+            with mock.patch('postmark.outbox.time.time', return_value=now + 200):
+                outbox.drain()
+        self.assertEqual(3, transport.call_count)
+        self.assertEqual({'pending': 0, 'dead': 1}, outbox.stats())
+
+    def test_throttled_or_unavailable_group_retried_later(self):
+        outbox = PMOutbox(self.path, api_key='test', backoff=60)
+        outbox.enqueue_many([self.make_message(0), self.make_message(1)])
+
+        for status in (503, 429):
+            def urlopen(req, timeout=None):
+                raise HTTPError('', status, 'Unavailable', {}, BytesIO(b''))
+
+            with mock.patch('postmark.core.urlopen', side_effect=urlopen), \
+                    mock.patch('postmark.outbox.time.time', return_value=time.time() + 61 * (status == 429)):
+                self.assertEqual(2, outbox.drain())
+            self.assertEqual({'pending': 2, 'dead': 0}, outbox.stats())
+
+        with outbox._transaction() as db:
+            self.assertEqual([(0, '429: HTTP Error 429: Unavailable')],
+                             db.execute('SELECT DISTINCT attempts, last_error FROM outbox').fetchall())
+
+    def test_unexpected_error_counts_attempt(self):
+        outbox = PMOutbox(self.path, max_attempts=1)
+        outbox.enqueue({'From': 'from@example.com', 'To': 'to@example.com', 'Subject': 'Subject', 'TextBody': 'Body'})
+
+        with mock.patch('postmark.core.urlopen', side_effect=TypeError('no API key')):
+            self.assertRaises(TypeError, outbox.flush)
+        self.assertEqual({'pending': 0, 'dead': 1}, outbox.stats())
+
+    def test_messages_sent_with_their_api_key(self):
+        outbox = PMOutbox(self.path, api_key='outbox-key')
+        message = self.make_message(0)
+        message.api_key = 'other-key'
+        outbox.enqueue_many([self.make_message(1), message, self.make_message(2)])
+
+        with mock.patch('postmark.core.urlopen', side_effect=lambda req, timeout=None: make_fake_response(
+                [{'ErrorCode': 0}] * len(json.loads(bytes(req.data).decode('utf-8'))))) as transport:
+            self.assertEqual(3, outbox.drain())
+        self.assertEqual([('test', 2), ('other-key', 1)],
+                         [(call[0][0].get_header('X-postmark-server-token'), len(json.loads(bytes(call[0][0].data))))
+                          for call in transport.call_args_list])
+
+    def test_background_flusher(self):
+        outbox = PMOutbox(self.path, api_key='test')
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response([{'ErrorCode': 0}])) as transport:
+            outbox.start(interval=0.01)
+            outbox.enqueue(self.make_message())
+            for i in range(100):
+                if outbox.stats()['pending'] == 0:
+                    break
+                time.sleep(0.01)
+            outbox.stop()
+        self.assertEqual(1, transport.call_count)
+        self.assertEqual({'pending': 0, 'dead': 0}, outbox.stats())
+
+    def test_django_backend_outbox(self):
+        outbox = PMOutbox(self.path)
+        backend = EmailBackend(api_key='dummy', outbox=outbox)
+        message = EmailMessage(connection=backend, from_email='from@test.com', to=['recipient@test.com'],
+                               subject='outbox test', body='hello')
+
+        with mock.patch('postmark.core.urlopen') as transport:
+            self.assertEqual(1, message.send())
+        self.assertFalse(transport.called)
+        self.assertEqual({'pending': 1, 'dead': 0}, outbox.stats())
+
+
+class ConfigTests(TestCase):
+    def tearDown(self):
+        reload_config()
+
+    def test_settings_read_once(self):
+        reload_config()
+        self.assertIsNone(get_config().setting('POSTMARK_SENDER'))
+        settings.POSTMARK_SENDER = 'from@example.com'
+        self.addCleanup(delattr, settings, 'POSTMARK_SENDER')
+
+        self.assertIsNone(PMMail().sender)
+        reload_config()
+        self.assertEqual('from@example.com', PMMail().sender)
+
+    def test_override_settings_reloads(self):
+        self.assertIn('Django', get_config().user_agent)
+        with self.settings(POSTMARK_SENDER='override@example.com'):
+            self.assertEqual('override@example.com', PMMail().sender)
+        self.assertIsNone(PMMail().sender)
+
+
+class SerializerTests(TestCase):
+    def tearDown(self):
+        postmark.core._serializer = None
+
+    def test_backends_roundtrip(self):
+        message = PMMail(sender='from@example.com', to='to@example.com', subject=lazy(str, str)('Subject'),
+                         text_body='Body \u2713', api_key='test', metadata={1: 'one'})
+        payload = message.to_json_message()
+
+        for name in ('json', 'simplejson', 'orjson', 'ujson'):
+            try:
+                set_serializer(name)
+            except ImportError:
+                continue
+            serializer = get_serializer()
+            decoded = serializer.loads(serializer.dumps(payload))
+            self.assertEqual('Subject', decoded['Subject'])
+            self.assertEqual('Body \u2713', decoded['TextBody'])
+            self.assertEqual({'1': 'one'}, decoded['Metadata'])
+            self.assertEqual(decoded, serializer.loads(serializer.dumps(payload).decode('utf-8')))
+
+    def test_selected_from_environment(self):
+        postmark.core._serializer = None
+        with mock.patch.dict('os.environ', {'POSTMARK_JSON_BACKEND': 'json'}):
+            self.assertIsInstance(get_serializer(), postmark.core.PMStdlibJSONSerializer)
+
+    def test_selected_from_setting(self):
+        postmark.core._serializer = None
+        with mock.patch.dict('os.environ', {'POSTMARK_JSON_BACKEND': ''}):
+            with self.settings(POSTMARK_JSON_BACKEND='json'):
+                self.assertIsInstance(get_serializer(), postmark.core.PMStdlibJSONSerializer)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, set_serializer, 'nope')
+
+    def test_encoder_lazy_string(self):
+        self.assertEqual('"text"', json.dumps(lazy(str, str)('text'), cls=PMJSONEncoder))
+
 
 class PMBounceManagerTests(unittest.TestCase):
     def test_activate(self):
         bounce = PMBounceManager(api_key='test')
 
-        with mock.patch('postmark.core.HTTPConnection.request') as mock_request:
-            with mock.patch('postmark.core.HTTPConnection.getresponse') as mock_response:
-                mock_response.return_value = StringIO('{"test": "test"}')
-                self.assertEqual(bounce.activate(1), {'test': 'test'})
+        with mock.patch('postmark.core.urlopen') as transport:
+            transport.return_value = make_fake_response({'test': 'test'})
+            self.assertEqual(bounce.activate(1), {'test': 'test'})
+            req = transport.call_args[0][0]
+            self.assertEqual('PUT', req.get_method())
+            self.assertEqual('https://api.postmarkapp.com/bounces/1/activate', req.get_full_url())
+
+
+def make_fake_connection(status=200, body=b'{}', will_close=False):
+    """Helper to fake an http.client connection object."""
+    conn = MagicMock()
+    conn.getresponse.return_value.status = status
+    conn.getresponse.return_value.reason = 'OK'
+    conn.getresponse.return_value.read.return_value = body
+    conn.getresponse.return_value.will_close = will_close
+    return conn
+
+
+class PMPooledTransportTests(unittest.TestCase):
+    def make_message(self, transport):
+        return PMMail(sender='from@example.com', to='to@example.com', subject='Subject',
+                      text_body='Body', api_key='test', transport=transport)
+
+    def test_connection_reused(self):
+        transport = PMPooledTransport()
+        conn = make_fake_connection(body=b'{"MessageID": "abc"}')
+
+        with mock.patch('postmark.core.HTTPSConnection', return_value=conn) as factory:
+            self.make_message(transport).send()
+            self.make_message(transport).send()
+
+        factory.assert_called_once_with('api.postmarkapp.com')
+        self.assertEqual(2, conn.request.call_count)
+        method, path, body, headers = conn.request.call_args[0]
+        self.assertEqual(('POST', '/email'), (method, path))
+        self.assertEqual('test', headers['X-postmark-server-token'])
+
+    def test_max_requests_per_connection(self):
+        transport = PMPooledTransport(max_requests=1)
+
+        with mock.patch('postmark.core.HTTPSConnection', side_effect=lambda host: make_fake_connection()) as factory:
+            self.make_message(transport).send()
+            self.make_message(transport).send()
+
+        self.assertEqual(2, factory.call_count)
+
+    def test_idle_timeout(self):
+        transport = PMPooledTransport(idle_timeout=0)
+
+        with mock.patch('postmark.core.HTTPSConnection', side_effect=lambda host: make_fake_connection()) as factory:
+            with mock.patch('postmark.core.time.monotonic', side_effect=[0, 0, 1, 1]):
+                self.make_message(transport).send()
+                self.make_message(transport).send()
+
+        self.assertEqual(2, factory.call_count)
+
+    def test_stale_connection_retried(self):
+        transport = PMPooledTransport()
+        stale = make_fake_connection()
+        fresh = make_fake_connection()
+
+        with mock.patch('postmark.core.HTTPSConnection', side_effect=[stale, fresh]):
+            self.make_message(transport).send()
+            stale.request.side_effect = ConnectionResetError()
+            self.make_message(transport).send()
+
+        self.assertTrue(stale.close.called)
+        self.assertEqual(1, fresh.request.call_count)
+
+    def test_request_not_resent_once_written(self):
+        transport = PMPooledTransport()
+        stale = make_fake_connection()
+        fresh = make_fake_connection()
+
+        with mock.patch('postmark.core.HTTPSConnection', side_effect=[stale, fresh]):
+            self.make_message(transport).send()
+            stale.getresponse.side_effect = http.client.RemoteDisconnected()
+            self.assertRaises(PMMailURLException, self.make_message(transport).send)
+
+        self.assertTrue(stale.close.called)
+        self.assertFalse(fresh.request.called)
+
+    def test_http_error(self):
+        transport = PMPooledTransport()
+        conn = make_fake_connection(status=500)
+
+        with mock.patch('postmark.core.HTTPSConnection', return_value=conn):
+            self.assertRaises(PMMailServerErrorException, self.make_message(transport).send)
+
+    def test_timeouts(self):
+        transport = PMPooledTransport()
+        conn = make_fake_connection()
+        conn.sock = None
+
+        def connect():
+            conn.sock = MagicMock()
+        conn.connect.side_effect = connect
+
+        with mock.patch('postmark.core.HTTPSConnection', return_value=conn):
+            self.make_message(transport).send(timeout=PMTimeout(connect=2, read=7))
+
+        self.assertEqual(2, conn.timeout)
+        conn.sock.settimeout.assert_called_once_with(7)
+
+    def test_connection_error(self):
+        transport = PMPooledTransport()
+        conn = make_fake_connection()
+        conn.request.side_effect = OSError('unreachable')
+
+        with mock.patch('postmark.core.HTTPSConnection', return_value=conn):
+            self.assertRaises(PMMailURLException, self.make_message(transport).send)
+
+
+class FakePostmarkServer(object):
+    """A minimal keep-alive HTTP server answering every request with one canned response."""
+
+    def __init__(self, payload, code=200, delay=0):
+        self.body = json.dumps(payload).encode('utf-8')
+        self.code = code
+        self.delay = delay
+        self.connections = 0
+        self.requests = []
+        self.writers = []
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.append(writer)
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line == b'\r\n':
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            self.requests.append((request_line.decode('latin-1').split()[:2], headers, body))
+            try:
+                await asyncio.sleep(self.delay)
+            except asyncio.CancelledError:
+                break
+            writer.write(b'HTTP/1.1 %d Status\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                         % (self.code, len(self.body)) + self.body)
+            await writer.drain()
+        writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return 'http://127.0.0.1:%d/' % self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for writer in self.writers:
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+        await asyncio.sleep(0.01)
+
+
+class AsyncClientTests(unittest.TestCase):
+    def run_with_server(self, server, func):
+        async def main():
+            url = await server.start()
+            transport = AsyncPMPooledTransport()
+            try:
+                with mock.patch('postmark.core.__POSTMARK_URL__', url):
+                    return await func(transport)
+            finally:
+                transport.close()
+                await server.stop()
+        return asyncio.run(main())
+
+    def make_message(self, transport):
+        return AsyncPMMail(sender='from@example.com', to='to@example.com', subject='Subject',
+                           text_body='Body', api_key='test', transport=transport)
+
+    def test_send_reuses_connection(self):
+        server = FakePostmarkServer({'MessageID': 'abc', 'ErrorCode': 0, 'Message': 'OK'})
+
+        async def send(transport):
+            messages = [self.make_message(transport) for i in range(5)]
+            results = await asyncio.gather(*[m.send(return_json=True) for m in messages])
+            results.append(await self.make_message(transport).send())
+            return messages, results
+
+        messages, results = self.run_with_server(server, send)
+        self.assertEqual('abc', messages[0].message_id)
+        self.assertEqual(0, results[0]['ErrorCode'])
+        self.assertTrue(results[-1])
+        self.assertEqual(6, len(server.requests))
+        self.assertLessEqual(server.connections, 5)
+        (method, path), headers, body = server.requests[0]
+        self.assertEqual(['POST', '/email'], [method, path])
+        self.assertEqual('test', headers['x-postmark-server-token'])
+        self.assertEqual('to@example.com', json.loads(body.decode('utf-8'))['To'])
+
+    def test_request_not_resent_once_written(self):
+        server = FakePostmarkServer({'MessageID': 'abc'})
+
+        async def send(transport):
+            await self.make_message(transport).send()
+            with mock.patch.object(AsyncPMPooledTransport, '_read_response', side_effect=ConnectionResetError()):
+                with self.assertRaises(PMMailURLException):
+                    await self.make_message(transport).send()
+            # Let the server read the request
+            await asyncio.sleep(0.05)
+
+        self.run_with_server(server, send)
+        self.assertEqual(2, len(server.requests))
+
+    def test_send_timeout(self):
+        server = FakePostmarkServer({'MessageID': 'abc'}, delay=1)
+
+        async def send(transport):
+            await self.make_message(transport).send(timeout=0.05)
+
+        self.assertRaises(PMMailURLException, self.run_with_server, server, send)
+
+    def test_send_inactive_recipient(self):
+        server = FakePostmarkServer({'Message': '', 'ErrorCode': 406}, code=422)
+
+        async def send(transport):
+            await self.make_message(transport).send()
+
+        self.assertRaises(PMMailInactiveRecipientException, self.run_with_server, server, send)
+
+    def test_batch_send(self):
+        server = FakePostmarkServer([{'MessageID': 'a'}, {'MessageID': 'b'}])
+
+        async def send(transport):
+            batch = AsyncPMBatchMail(api_key='test', transport=transport,
+                                     messages=[self.make_message(transport), self.make_message(transport)])
+            self.assertTrue(await batch.send())
+            return batch
+
+        batch = self.run_with_server(server, send)
+        self.assertEqual(['a', 'b'], [m.message_id for m in batch.messages])
+        self.assertEqual('/email/batch', server.requests[0][0][1])
+
+    def test_batch_send_concurrently(self):
+        server = FakePostmarkServer([{'MessageID': 'a'}])
+
+        async def send(transport):
+            batch = AsyncPMBatchMail(api_key='test', transport=transport,
+                                     messages=[self.make_message(transport) for i in range(3)])
+            with mock.patch.object(AsyncPMBatchMail, 'MAX_MESSAGES', 1):
+                return await batch.send(return_json=True, concurrency=2)
+
+        self.assertEqual([{'MessageID': 'a'}] * 3, self.run_with_server(server, send))
+        self.assertEqual(3, len(server.requests))
+
+    def test_bounce_manager(self):
+        server = FakePostmarkServer({'Tags': ['a']})
+
+        async def fetch(transport):
+            bounce = AsyncPMBounceManager(api_key='test', transport=transport)
+            return await bounce.get_tags()
+
+        self.assertEqual({'Tags': ['a']}, self.run_with_server(server, fetch))
+        self.assertEqual(['GET', '/bounces/tags'], server.requests[0][0])
+
+    def test_connection_error(self):
+        async def send():
+            transport = AsyncPMPooledTransport()
+            with mock.patch('postmark.core.__POSTMARK_URL__', 'http://127.0.0.1:1/'):
+                await self.make_message(transport).send()
+
+        self.assertRaises(PMMailURLException, asyncio.run, send())
 
 
 class EmailBackendTests(TestCase):
 
+    def test_rejected_batch_not_reported_sent(self):
+        messages = [EmailMessage(from_email='from@test.com', to=['to%d@test.com' % i], subject='Subject', body='Body')
+                    for i in range(2)]
+
+        with mock.patch('postmark.core.urlopen', side_effect=HTTPError('', 503, '', {}, None)):
+            self.assertEqual(0, EmailBackend(api_key='dummy', fail_silently=True).send_messages(messages))
+            self.assertRaises(PMMailSendException, EmailBackend(api_key='dummy').send_messages, messages)
+
     def test_send_multi_alternative_html_email(self):
         # build a message and send it
         message = EmailMultiAlternatives(
@@ -546,8 +1836,11 @@ class EmailBackendTests(TestCase):
         f = StringIO(u'1,2,3')
         message.attach('filename.csv', f.read(), 'text/csv')
 
-        with mock.patch('postmark.core.urlopen', side_effect=HTTPError('', 200, '', {}, None)):
+        with mock.patch('postmark.core.urlopen', side_effect=HTTPError('', 200, '', {}, None)) as transport:
             message.send()
+        data = json.loads(bytes(transport.call_args[0][0].data).decode('utf-8'))
+        self.assertEqual([{'Name': 'filename.csv', 'Content': 'MSwyLDM=', 'ContentType': 'text/csv'}],
+                         data['Attachments'])
 
     def test_message_stream(self):
         message = EmailMultiAlternatives(
@@ -564,6 +1857,181 @@ class EmailBackendTests(TestCase):
             self.assertEqual('hello there', data['TextBody'])
             self.assertEqual('<b>hello</b> there', data['HtmlBody'])
 
+    def test_recipients_normalized(self):
+        message = EmailMessage(
+            connection=EmailBackend(api_key='dummy'), from_email='from@test.com', subject='Subject', body='Body',
+            to=['recipient@test.com', 'Recipient <RECIPIENT@Test.com>', '"Last, First" <other@test.com>'],
+        )
+
+        with mock.patch('postmark.core.urlopen', side_effect=HTTPError('', 200, '', {}, None)) as transport:
+            message.send()
+        data = json.loads(transport.call_args[0][0].data.decode('utf-8'))
+        self.assertEqual('recipient@test.com, "Last, First" <other@test.com>', data['To'])
+
+
+    def test_connection_reused_between_open_and_close(self):
+        transport = MagicMock()
+        transport.open.return_value = make_fake_response({'MessageID': 'abc'})
+
+        with mock.patch('postmark.django_backend.new_transport', return_value=transport):
+            with EmailBackend(api_key='dummy') as backend:
+                for i in range(2):
+                    EmailMessage(connection=backend, from_email='from@test.com', to=['recipient@test.com'],
+                                 subject='test', body='hello').send()
+                self.assertIs(transport, backend.connection)
+                self.assertFalse(backend.open())
+
+        self.assertEqual(2, transport.open.call_count)
+        transport.close.assert_called_once_with()
+        self.assertIsNone(backend.connection)
+
+
+class AsyncEmailBackendTests(TestCase):
+    def test_asend_messages(self):
+        server = FakePostmarkServer([{'MessageID': 'a', 'ErrorCode': 0}, {'MessageID': 'b', 'ErrorCode': 0}])
+        messages = [EmailMessage(from_email='from@test.com', to=['recipient%d@test.com' % i],
+                                 subject='async test', body='hello') for i in range(2)]
+
+        async def main():
+            url = await server.start()
+            try:
+                with mock.patch('postmark.core.__POSTMARK_URL__', url):
+                    return await backend.asend_messages(messages)
+            finally:
+                get_default_async_transport().close()
+                await server.stop()
+
+        with self.settings(POSTMARK_RETURN_MESSAGE_ID=True):
+            backend = AsyncEmailBackend(api_key='dummy')
+            self.assertEqual(['a', 'b'], asyncio.run(main()))
+        (method, path), headers, body = server.requests[0]
+        self.assertEqual(['POST', '/email/batch'], [method, path])
+        self.assertEqual(2, len(json.loads(body.decode('utf-8'))))
+
+
+try:
+    from postmark.tornado_mixin import PostmarkMixin
+except ImportError:
+    PostmarkMixin = None
+
+
+@unittest.skipIf(PostmarkMixin is None, 'Tornado is not installed')
+class TornadoMixinTests(unittest.TestCase):
+    def setUp(self):
+        from tornado.options import define, options
+        for name, value in (('postmark_signature', 'test'), ('postmark_sendemail', 'from@example.com')):
+            if name not in options:
+                define(name, default=value)
+
+    def run_with_server(self, server, func):
+        async def main():
+            url = await server.start()
+            try:
+                with mock.patch('postmark.core.__POSTMARK_URL__', url):
+                    return await func(PostmarkMixin())
+            finally:
+                await server.stop()
+        return asyncio.run(main())
+
+    def test_send_email(self):
+        server = FakePostmarkServer({'MessageID': 'abc', 'ErrorCode': 0, 'Message': 'OK'})
+
+        async def send(handler):
+            return await handler.send_email(subject='Subject', body='<b>Hi</b>', to='to@example.com')
+
+        self.assertTrue(self.run_with_server(server, send))
+        (method, path), headers, body = server.requests[0]
+        self.assertEqual(['POST', '/email'], [method, path])
+        self.assertEqual('<b>Hi</b>', json.loads(body.decode('utf-8'))['HtmlBody'])
+
+    def test_send_batch_email(self):
+        server = FakePostmarkServer([{'MessageID': 'a'}, {'MessageID': 'b'}])
+
+        async def send(handler):
+            return await handler.send_batch_email([{'subject': 'Subject', 'body': 'Hi', 'to': 'to%d@example.com' % i}
+                                                   for i in range(2)])
+
+        self.assertTrue(self.run_with_server(server, send))
+        (method, path), headers, body = server.requests[0]
+        self.assertEqual(['POST', '/email/batch'], [method, path])
+
+    def test_send_email_error(self):
+        server = FakePostmarkServer({'Message': '', 'ErrorCode': 406}, code=422)
+
+        async def send(handler):
+            await handler.send_email(subject='Subject', body='Hi', to='to@example.com')
+
+        self.assertRaises(PMMailInactiveRecipientException, self.run_with_server, server, send)
+
+    def test_connection_error(self):
+        async def send():
+            with mock.patch('postmark.core.__POSTMARK_URL__', 'http://127.0.0.1:1/'):
+                await PostmarkMixin().send_email(subject='Subject', body='Hi', to='to@example.com')
+
+        self.assertRaises(PMMailURLException, asyncio.run, send())
+
+
+class QueuedEmailBackendTests(TestCase):
+    def make_message(self, backend, i=0):
+        return EmailMessage(connection=backend, from_email='from@test.com', to=['recipient%d@test.com' % i],
+                            subject='queued test', body='hello')
+
+    def test_messages_coalesced(self):
+        mail_queue = PMMailQueue(window=0.5)
+        backend = QueuedEmailBackend(api_key='dummy', mail_queue=mail_queue)
+
+        with mock.patch('postmark.core.urlopen', side_effect=PMBatchMailTests.fake_batch_urlopen(None)) as transport:
+            for i in range(3):
+                self.assertEqual(1, self.make_message(backend, i).send())
+            mail_queue.close()
+
+        self.assertEqual(1, transport.call_count)
+        req = transport.call_args[0][0]
+        self.assertEqual('https://api.postmarkapp.com/email/batch', req.get_full_url())
+        self.assertEqual(3, len(json.loads(bytes(req.data).decode('utf-8'))))
+
+    def test_full_queue_policies(self):
+        import threading
+        sending, release = threading.Event(), threading.Event()
+
+        def urlopen(req, timeout=None):
+            sending.set()
+            release.wait(5)
+            return make_fake_response({})
+
+        with mock.patch('postmark.core.urlopen', side_effect=urlopen) as transport:
+            mail_queue = PMMailQueue(maxsize=1, window=0, full_policy='drop')
+            backend = QueuedEmailBackend(api_key='dummy', mail_queue=mail_queue)
+            self.assertEqual(1, self.make_message(backend).send())
+            sending.wait(5)
+            # The worker is busy sending: one message fits, the next is dropped
+            self.assertEqual(1, self.make_message(backend).send())
+            self.assertEqual(0, self.make_message(backend).send())
+            self.assertEqual(1, mail_queue.dropped)
+
+            mail_queue.full_policy = 'block'
+            mail_queue.block_timeout = 0.01
+            self.assertRaises(PMMailSendException, self.make_message(backend).send)
+
+            release.set()
+            mail_queue.close()
+        self.assertEqual(2, transport.call_count)
+
+    def test_closed_queue_replaced(self):
+        from postmark import django_backend
+
+        self.addCleanup(setattr, django_backend, '_mail_queue', django_backend._mail_queue)
+        backend = QueuedEmailBackend(api_key='dummy')
+        with mock.patch('postmark.core.urlopen', return_value=make_fake_response({})) as transport:
+            closed = django_backend.get_mail_queue()
+            django_backend.flush_mail_queue()
+            self.assertRaises(PMMailSendException, closed.put, backend._build_message(self.make_message(backend)))
+
+            # The backend queues on a new queue, whose thread sends the message
+            self.assertEqual(1, self.make_message(backend).send())
+            self.assertIsNot(closed, django_backend.get_mail_queue())
+            django_backend.flush_mail_queue()
+        self.assertEqual(1, transport.call_count)
 
 
 if __name__ == '__main__':